@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+#
+# Natural Language Toolkit: corpus reader cache for the book doctests
+#
+# Copyright (C) 2001-2012 NLTK Project
+# URL: <http://www.nltk.org/>
+# For license information, see LICENSE.TXT
+
+"""
+Remember the results of nltk corpus reader calls (such as
+``brown.words(categories='news')``) in a directory of cache files, so
+that later doctest runs don't re-read & re-tokenize the same corpus
+files.  Usage::
+
+    import corpus_cache
+    corpus_cache.install('corpus-cache')
+
+After `install`, the methods named in `CACHED_METHODS` of every nltk
+corpus reader class look up their results by reader class, corpus
+root, file ids, configuration (encoding, tokenizers, etc.), method
+and arguments.  A result is cached if it is a string
+(e.g. ``raw()``), or a list or corpus view whose items are strings,
+tuples of strings, or (nested) lists of them (e.g. ``words()``,
+``tagged_sents()``, ``paras()``); other results (such as trees) are
+not cached.
+
+Each cache file holds one result.  Its tokens are stored as an array
+of ids into the file's own table of (interned) strings, and the file
+is memory-mapped when it is read, so a corpus view served from the
+cache only decodes the items that are used.  An entry is only used if
+the modification times of the corpus's files (under nltk_data) and
+the nltk version are unchanged.  Filling the cache reads each result
+in full (even if only a slice of it is used), so the first run with
+an empty cache is slower than a run without the cache.
+"""
+
+import os, sys, json, hashlib, mmap, struct, tempfile, types, weakref
+from array import array
+
+import nltk
+from nltk.collections import AbstractLazySequence
+from nltk.corpus.reader.api import CorpusReader
+
+CACHED_METHODS = ['raw', 'words', 'sents', 'paras', 'tagged_words',
+                  'tagged_sents', 'tagged_paras']
+"""The corpus reader methods whose results are cached."""
+
+MAGIC = b'NLTKCC1\n'
+"""The first bytes of every cache file."""
+
+_KEY_TYPES = (str, int, float, bool, type(None))
+
+SKIPPED_ATTRIBUTES = set(['_root', '_fileids', '_f2c', '_c2f'])
+"""Reader attributes that are not part of its configuration: the
+   root & file ids (which are keyed separately), and the category maps
+   that categorized readers build lazily."""
+
+FINGERPRINT_DEPTH = 4
+"""How deeply nested a reader's configuration may be (e.g. a reader's
+   tokenizer's parameters) before the reader is not cached."""
+
+class Unencodable(Exception):
+    """Raised if a result can't be stored in the cache."""
+
+class Unfingerprintable(Exception):
+    """Raised if a reader's configuration can't be fingerprinted."""
+
+######################################################################
+#{ Encoding
+######################################################################
+
+def _is_sequence(value):
+    return type(value) is list or isinstance(value, AbstractLazySequence)
+
+def _shape(value):
+    """
+    Return `(depth, width)` for a result: `depth` is the number of
+    levels of lists (including the result itself), and `width` is the
+    length of the tuples at the bottom level (0 for strings).  The
+    shape is found from the first item at each level.
+    """
+    depth = 0
+    while _is_sequence(value):
+        if len(value) == 0:
+            raise Unencodable('empty list')
+        depth += 1
+        value = value[0]
+    if isinstance(value, str):
+        return depth, 0
+    if type(value) is tuple and value and all(isinstance(v, str)
+                                              for v in value):
+        return depth, len(value)
+    raise Unencodable(type(value).__name__)
+
+def encode(value):
+    """
+    Return a `(header, payload)` pair for a result: `header` is a
+    JSON-able dict, and `payload` is a list of `array`s (or a single
+    `bytes`, for a string).  Raise `Unencodable` if the result can't be
+    stored.
+    """
+    if isinstance(value, str):
+        return {'kind': 'str'}, value.encode('utf-8')
+    if not _is_sequence(value):
+        raise Unencodable(type(value).__name__)
+    depth, width = _shape(value)
+    vocab, index = [], {}
+    ids = array('i')
+    # bounds[c][i] is where the i-th list at level c starts in the
+    # level below (so each has one more entry than there are lists).
+    bounds = [None] + [array('i', [0]) for c in range(1, depth)]
+
+    def intern(token):
+        if not isinstance(token, str):
+            raise Unencodable(type(token).__name__)
+        i = index.get(token)
+        if i is None:
+            i = index[token] = len(vocab)
+            vocab.append(token)
+        ids.append(i)
+
+    def emit(items, c):
+        if c == depth-1:
+            for leaf in items:
+                if width == 0: intern(leaf)
+                elif type(leaf) is tuple and len(leaf) == width:
+                    for token in leaf: intern(token)
+                else: raise Unencodable(type(leaf).__name__)
+        else:
+            for child in items:
+                if not _is_sequence(child):
+                    raise Unencodable(type(child).__name__)
+                emit(child, c+1)
+        if c > 0:
+            if c == depth-1: bounds[c].append(len(ids) // max(width, 1))
+            else: bounds[c].append(len(bounds[c+1]) - 1)
+
+    emit(value, 0)
+    header = {'kind': 'seq', 'depth': depth, 'width': width,
+              'view': isinstance(value, AbstractLazySequence),
+              'vocab': vocab, 'byteorder': sys.byteorder,
+              'sizes': [len(ids)] + [len(b) for b in bounds[1:]]}
+    return header, [ids] + bounds[1:]
+
+class CachedCorpusView(AbstractLazySequence):
+    """
+    A corpus view whose items are decoded, as they are needed, from a
+    memory-mapped cache file.
+    """
+    def __init__(self, header, arrays):
+        self._vocab = header['vocab']
+        self._depth = header['depth']
+        self._width = header['width']
+        self._ids = arrays[0]
+        self._bounds = [None] + arrays[1:]
+        if self._depth > 1: self._len = len(self._bounds[1]) - 1
+        else: self._len = len(self._ids) // max(self._width, 1)
+
+    def __len__(self):
+        return self._len
+
+    def iterate_from(self, start):
+        if self._depth > 1:
+            for i in range(start, self._len):
+                yield self._list(1, i)
+        else:
+            for i in range(start, self._len):
+                yield self._leaf(i)
+
+    def _leaf(self, i):
+        if self._width == 0:
+            return self._vocab[self._ids[i]]
+        w = self._width
+        return tuple(self._vocab[j] for j in self._ids[i*w:(i+1)*w])
+
+    def _list(self, c, i):
+        bounds = self._bounds[c]
+        items = range(bounds[i], bounds[i+1])
+        if c == self._depth-1:
+            return [self._leaf(j) for j in items]
+        return [self._list(c+1, j) for j in items]
+
+######################################################################
+#{ Cache files
+######################################################################
+
+def write_entry(filename, header, payload):
+    """Write a cache file atomically (so that concurrent doctest
+    processes never see a partly-written one)."""
+    head = json.dumps(header).encode('utf-8')
+    head += b' ' * (-(len(MAGIC) + 4 + len(head)) % 4) # align the arrays
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(MAGIC + struct.pack('<I', len(head)) + head)
+            if isinstance(payload, bytes):
+                f.write(payload)
+            else:
+                for a in payload: a.tofile(f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+def read_entry(filename):
+    """Return `(header, value)` for a cache file, or None if it can't
+    be read.  Sequences are served by a `CachedCorpusView` over the
+    memory-mapped file."""
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        if f.read(len(MAGIC)) != MAGIC: return None
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size).decode('utf-8'))
+        start = len(MAGIC) + 4 + size
+        if header['kind'] == 'str':
+            return header, f.read().decode('utf-8')
+        if header['byteorder'] != sys.byteorder: return None
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    finally:
+        f.close()
+    arrays = []
+    for n in header['sizes']:
+        arrays.append(data[start:start+4*n].cast('i'))
+        start += 4*n
+    view = CachedCorpusView(header, arrays)
+    if header['view']: return header, view
+    return header, list(view)
+
+######################################################################
+#{ Reader configuration
+######################################################################
+
+def _is_regexp(value):
+    # A compiled regexp (from re, or regex, or a wrapper for one)?
+    return (isinstance(getattr(value, 'pattern', None), (str, bytes)) and
+            isinstance(getattr(value, 'flags', None), int))
+
+def _fingerprint(value, depth=0):
+    """
+    Return a string that identifies a value in a reader's
+    configuration: simple values by their repr; containers by their
+    items; compiled regexps by their pattern; functions & classes by
+    their qualified names; and other objects by their class and
+    attributes (see below).  Raise `Unfingerprintable` for anything
+    else (such as open files), or if the value is nested too deeply.
+    """
+    if depth > FINGERPRINT_DEPTH:
+        raise Unfingerprintable('too deep')
+    if isinstance(value, _KEY_TYPES):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_fingerprint(v, depth+1) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ','.join(sorted(_fingerprint(v, depth+1)
+                                        for v in value))
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(sorted(
+            '%s:%s' % (_fingerprint(k, depth+1), _fingerprint(v, depth+1))
+            for (k, v) in value.items()))
+    if _is_regexp(value):
+        return 're(%r,%d)' % (value.pattern, value.flags)
+    if isinstance(value, types.MethodType):
+        return '%s<%s>' % (_fingerprint(value.__func__, depth+1),
+                           _fingerprint(value.__self__, depth+1))
+    if isinstance(value, (type, types.FunctionType,
+                          types.BuiltinFunctionType)):
+        return '%s.%s' % (value.__module__, value.__qualname__)
+    if hasattr(value, '__dict__'):
+        # Tokenizers compile their pattern strings lazily, when they're
+        # first used (which they aren't, if results come from the
+        # cache); so None & compiled regexp attributes are skipped.
+        return '%s.%s(%s)' % (
+            type(value).__module__, type(value).__qualname__,
+            ','.join(sorted('%s=%s' % (name, _fingerprint(v, depth+1))
+                            for (name, v) in vars(value).items()
+                            if v is not None and not _is_regexp(v))))
+    raise Unfingerprintable(type(value).__name__)
+
+def reader_fingerprint(reader):
+    """
+    Return a string that identifies a corpus reader's configuration
+    (its file ids, encoding, tokenizers, and so on), or None if it
+    can't be fingerprinted (in which case its results aren't cached).
+    """
+    try:
+        config = dict((name, value) for (name, value) in vars(reader).items()
+                      if name not in SKIPPED_ATTRIBUTES and value is not None)
+        return '%s %s' % (_fingerprint(reader.fileids()),
+                          _fingerprint(config))
+    except Unfingerprintable:
+        return None
+
+######################################################################
+#{ Cache
+######################################################################
+
+def _root_path(root):
+    # The file or directory that a corpus reader's root points to.
+    if hasattr(root, 'path'): return root.path
+    if hasattr(root, 'zipfile'): return root.zipfile.filename
+    return str(root)
+
+class CorpusCache:
+    """
+    A directory of cached corpus reader results.  `hits` & `misses`
+    count lookups by this process.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._stamps = {}          # root path -> stamp
+        self._unencodable = set()  # keys of results that can't be cached
+        # reader -> fingerprint.  A reader is fingerprinted once, when
+        # it's first used, since some readers & tokenizers fill in
+        # attributes lazily.
+        self._fingerprints = weakref.WeakKeyDictionary()
+        self.hits = self.misses = 0
+
+    def stamp(self, root):
+        """A fingerprint of the files under a corpus root (their
+        number, and their latest modification time)."""
+        path = _root_path(root)
+        if path not in self._stamps:
+            count, latest = 0, 0
+            if os.path.isdir(path):
+                for (dirpath, dirnames, filenames) in os.walk(path):
+                    for filename in filenames:
+                        st = os.stat(os.path.join(dirpath, filename))
+                        count += 1
+                        latest = max(latest, st.st_mtime)
+            elif os.path.exists(path):
+                count, latest = 1, os.stat(path).st_mtime
+            self._stamps[path] = '%s %d %s' % (nltk.__version__, count,
+                                                 latest)
+        return self._stamps[path]
+
+    def fingerprint(self, reader):
+        """The (memoized) L{reader_fingerprint} of a reader."""
+        try:
+            return self._fingerprints[reader]
+        except KeyError:
+            fingerprint = self._fingerprints[reader] = \
+                          reader_fingerprint(reader)
+            return fingerprint
+        except TypeError: # (the reader isn't weakly referenceable.)
+            return reader_fingerprint(reader)
+
+    def key(self, reader, method, args, kwargs):
+        """The cache key for a reader call, or None if its arguments
+        aren't simple values, or the reader's configuration can't be
+        fingerprinted."""
+        values = list(args) + list(kwargs.values())
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                if not all(isinstance(v, _KEY_TYPES) for v in value):
+                    return None
+            elif not isinstance(value, _KEY_TYPES):
+                return None
+        fingerprint = self.fingerprint(reader)
+        if fingerprint is None:
+            return None
+        text = repr((type(reader).__name__, _root_path(reader._root),
+                     fingerprint, method, args, sorted(kwargs.items())))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def call(self, reader, method, func, args, kwargs):
+        """Return the (cached) result of `func(reader, *args, **kwargs)`."""
+        key = self.key(reader, method, args, kwargs)
+        if key is None or key in self._unencodable:
+            return func(reader, *args, **kwargs)
+        filename = os.path.join(self.directory, key)
+        stamp = self.stamp(reader._root)
+        entry = read_entry(filename)
+        if entry is not None and entry[0].get('stamp') == stamp:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = func(reader, *args, **kwargs)
+        try:
+            header, payload = encode(value)
+        except Unencodable:
+            self._unencodable.add(key)
+            return value
+        header['stamp'] = stamp
+        try:
+            write_entry(filename, header, payload)
+        except (IOError, OSError):
+            pass # don't fail a test because the cache can't be written.
+        return value
+
+_cache = None
+_active = False # are we inside a cached call?  (see _cached_method)
+
+def _cached_method(method, func):
+    def cached(self, *args, **kwargs):
+        global _active
+        # A reader method that calls another (cached) one is cached
+        # as a whole; the inner call isn't cached separately.
+        if _active or not hasattr(self, '_root'):
+            return func(self, *args, **kwargs)
+        _active = True
+        try:
+            return _cache.call(self, method, func, args, kwargs)
+        finally:
+            _active = False
+    cached.__name__ = func.__name__
+    cached.__doc__ = func.__doc__
+    cached.uncached = func
+    return cached
+
+def _reader_classes():
+    import nltk.corpus.reader
+    for value in vars(nltk.corpus.reader).values():
+        if isinstance(value, type) and issubclass(value, CorpusReader):
+            yield value
+
+def install(directory):
+    """
+    Cache the results of the corpus reader methods named in
+    `CACHED_METHODS` in `directory`; and return the `CorpusCache`.
+    """
+    global _cache
+    _cache = CorpusCache(directory)
+    for cls in _reader_classes():
+        for method in CACHED_METHODS:
+            func = cls.__dict__.get(method)
+            if func is not None and not hasattr(func, 'uncached'):
+                setattr(cls, method, _cached_method(method, func))
+    return _cache
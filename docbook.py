@@ -21,12 +21,11 @@ __docformat__ = 'reStructuredText'
 
 import re
 import textwrap
+from itertools import chain
 from docutils import writers, nodes, languages
-from PIL import Image
-
-# XML entity definitions are similar to HTML ones. we use them to
-# escape special charicters.
-import html.entities
+from imageinfo import image_info
+from escaping import (escape_xml, escape_nonascii, escape_entities,
+                      replace_callouts)
 
 class Writer(writers.Writer):
 
@@ -84,9 +83,9 @@ class DocBookTranslator(nodes.NodeVisitor):
         self.section = 0
         self.context = []
         self.colnames = []
-        self.footnotes = {}
-        self.footnote_map = {}
-        self.docinfo = []
+        # footnote_reference id -> footnote, for the first reference
+        # to each footnote (later references become footnoterefs).
+        self.first_footnote_refs = resolve_footnotes(document)
         self.title = ''
         self.subtitle = ''
         self.table_tag_stack = []
@@ -117,54 +116,19 @@ class DocBookTranslator(nodes.NodeVisitor):
             return None
 
     def astext(self):
-        return ''.join(self.doc_header
-                    + self.docinfo
-                    + self.body
-                    + self.doc_footer)
+        return ''.join(chain(self.doc_header, self.body, self.doc_footer))
 
     def encode(self, text):
         """Encode special characters in `text` & return."""
-        # @@@ A codec to do these and all other 
-        # HTML entities would be nice.
-        text = text.replace("&", "&amp;")
-        text = text.replace("<", "&lt;")
-        text = text.replace('"', "&quot;")
-        text = text.replace(">", "&gt;")
-        return text
+        return escape_xml(text)
 
     def encodeattr(self, text):
         """Encode attributes characters > 128 as &#XXX;"""
-        buff = []
-        for c in text:
-            if ord(c) >= 128:
-                buff.append('&#%d;' % ord(c))
-            else:
-                buff.append(c)
-        return ''.join(buff)
-
-    def rearrange_footnotes(self):
-        """
-        Replaces ``foonote_reference`` placeholders with
-        ``footnote`` element content as DocBook and reST
-        handle footnotes differently.
-
-        DocBook defines footnotes inline, whereas they
-        may be anywere in reST.  This function replaces the 
-        first instance of a ``footnote_reference`` with 
-        the ``footnote`` element itself, and later 
-        references of the same a  footnote with 
-        ``footnoteref`` elements.
-        """
-        for (footnote_id,refs) in list(self.footnote_map.items()):
-            ref_id, context, pos = refs[0]
-            context[pos] = ''.join(self.footnotes[footnote_id])
-            for ref_id, context, pos in refs[1:]:
-                context[pos] = '<footnoteref linkend="%s"/>' \
-                    % (footnote_id,)
+        return escape_nonascii(text)
 
     def attval(self, text, transtable=None):
         """Cleanse, encode, and return attribute value text."""
-        return self.encode(re.sub(r'\n\r\t\v\f', text))
+        return self.encode(re.sub(r'[\n\r\t\v\f]', ' ', text))
 
     def starttag(self, node, tagname, suffix='\n', infix='', **attributes):
         """
@@ -334,9 +298,6 @@ class DocBookTranslator(nodes.NodeVisitor):
     def visit_citation(self, node):
         self.visit_footnote(node)
 
-    def depart_citation(self, node):
-        self.depart_footnote(node)
-
     def visit_citation_reference(self, node):
         self.visit_footnote_reference(node)
 
@@ -540,7 +501,9 @@ class DocBookTranslator(nodes.NodeVisitor):
         if len(docinfo) > 1:
             docinfo.append('</%sinfo>\n' % self.doctype)
 
-        self.docinfo = docinfo
+        # The docinfo comes before any of the document's body, so it
+        # can go straight into the output.
+        self.body.extend(docinfo)
 
         raise nodes.SkipChildren
 
@@ -548,30 +511,13 @@ class DocBookTranslator(nodes.NodeVisitor):
         pass
 
     def visit_doctest_block(self, node):
-        def strip_doctest_directives(text):
-            return self._OPTION_DIRECTIVE_RE.sub('', text)
-
-        def replace_html_entity(c):
-            try:
-                return str("&%s;" % html.entities.codepoint2name[ord(c)])
-            except KeyError:
-                return c
-
-        def create_anchors(text, callouts):
-            for name, line in list(callouts.items()):
-                text = re.sub("# *\[_%s\]" % name, 
-                              "<co id=\"ref-%s\"/>" % name, 
-                              text)
-            return text
-
         self.body.append('\n<programlisting>')
 
-        text = ''.join(str(c).encode('utf8') for c in node)
+        text = ''.join(str(c) for c in node)
         text = textwrap.dedent(text)
-        text = strip_doctest_directives(text)
-        text = text.decode('utf8')
-        text = ''.join(map(replace_html_entity, text))
-        text = create_anchors(text, node['callouts'])
+        text = self._OPTION_DIRECTIVE_RE.sub('', text)
+        text = escape_entities(text)
+        text = replace_callouts(text, node['callouts'], '<co id="ref-%s"/>')
         
         self.body.append(text)
         self.body.append('</programlisting>\n')
@@ -584,7 +530,7 @@ class DocBookTranslator(nodes.NodeVisitor):
         pass
 
     def depart_document(self, node):
-        self.rearrange_footnotes()
+        pass
 
     def visit_emphasis(self, node):
         self.body.append('<emphasis>')
@@ -693,50 +639,25 @@ class DocBookTranslator(nodes.NodeVisitor):
         pass
 
     def visit_footnote(self, node):
-        self.footnotes[node['ids'][0]] = []
-        atts = {'xml:id': node['ids'][0]}
-        if isinstance(node[0], nodes.label):
-            atts['label'] = node[0].astext()
-        self.footnotes[node['ids'][0]].append(
-            self.starttag(node, 'footnote', **atts))
-
-        # replace body with this with a footnote collector list
-        # which will hold all the contents for this footnote.
-        # This needs to be kept separate so it can be used to replace
-        # the first ``footnote_reference`` as DocBook defines 
-        # ``footnote`` elements inline. 
-        self._body = self.body
-        self.body = self.footnotes[node['ids'][0]]
-
-    def depart_footnote(self, node):
-        # finish footnote and then replace footnote collector
-        # with real body list.
-        self.footnotes[node['ids'][0]].append('</footnote>')
-        self.body = self._body
-        self._body = None
+        # DocBook defines footnotes inline, so each footnote is
+        # rendered at its first reference (see
+        # ``visit_footnote_reference``), not where it is in the doctree.
+        raise nodes.SkipNode
 
     def visit_footnote_reference(self, node):
-        if 'refid' in node:
-            refid = node['refid']
-        else:
-            refid = self.document.nameids[node['refname']]
-
-        # going to replace this footnote reference with the actual
-        # footnote later on, so store the footnote id to replace
-        # this reference with and the list and position to replace it
-        # in. Both list and position are stored in case a footnote
-        # reference is within a footnote, in which case ``self.body``
-        # won't really be ``self.body`` but a footnote collector
-        # list.
-        refs = self.footnote_map.get(refid, [])
-        refs.append((node['ids'][0], self.body, len(self.body),))
-        self.footnote_map[refid] = refs
-
-        # add place holder list item which should later be 
-        # replaced with the contents of the footnote element
-        # and it's child elements
-        self.body.append('<!-- REPLACE WITH FOOTNOTE -->')
-
+        footnote = self.first_footnote_refs.get(node['ids'][0])
+        if footnote is None:
+            refid = footnote_refid(node, self.document)
+            if refid is not None:
+                self.body.append('<footnoteref linkend="%s"/>' % refid)
+            raise nodes.SkipNode
+        atts = {'xml:id': footnote['ids'][0]}
+        if isinstance(footnote[0], nodes.label):
+            atts['label'] = footnote[0].astext()
+        self.body.append(self.starttag(footnote, 'footnote', **atts))
+        for child in footnote.children:
+            child.walkabout(self)
+        self.body.append('</footnote>')
         raise nodes.SkipNode
 
     def visit_header(self, node):
@@ -793,9 +714,9 @@ class DocBookTranslator(nodes.NodeVisitor):
                 raise ValueError(
                     "docbook.py doesn't handle specifying image width in ReST")
             scale = node.attributes['scale']
-            im = Image.open(node.attributes['uri'])
-            atts['width'] = atts['contentwidth'] = "%fcm" % docbook_scale_image(im.size[0], scale)
-            atts['depth'] = atts['contentdepth'] = "%fcm" % docbook_scale_image(im.size[1], scale)
+            info = image_info(node.attributes['uri'])
+            atts['width'] = atts['contentwidth'] = "%fcm" % docbook_scale_image(info.width, scale)
+            atts['depth'] = atts['contentdepth'] = "%fcm" % docbook_scale_image(info.height, scale)
 
         # Don't wrap the image in a para, this breaks when the image
         # is in a figure tag.  I don't know if it breaks anywhere
@@ -1278,6 +1199,52 @@ def child_of_instance(node, object):
             return child_idx, child 
     return None, None
 
+def footnote_refid(node, document):
+    """
+    Return the id of the footnote (or citation) that the given
+    ``footnote_reference`` (or ``citation_reference``) refers to, or
+    None if it is unresolved.
+    """
+    if 'refid' in node:
+        return node['refid']
+    return document.nameids.get(node.get('refname'))
+
+def resolve_footnotes(document):
+    """
+    Decide where each footnote (and citation) should be rendered.
+    DocBook defines footnotes inline, whereas they may be anywhere in
+    reST; so a footnote is rendered in place of its first reference,
+    and later references become ``footnoteref`` elements.  Return a
+    dictionary mapping the id of each first reference to its footnote.
+
+    The document is walked in the same order as the translator will
+    walk it: footnotes are skipped where they are defined, and entered
+    at their first reference (so references within footnotes are
+    ordered correctly).  Unreferenced footnotes are not rendered.
+    """
+    footnotes = {}
+    for node in document.findall(
+        lambda n: isinstance(n, (nodes.footnote, nodes.citation))):
+        for ident in node['ids']:
+            footnotes[ident] = node
+    first_refs = {}
+    seen = set()
+    def walk(node):
+        for child in node.children:
+            if isinstance(child, (nodes.footnote, nodes.citation)):
+                continue
+            elif isinstance(child, (nodes.footnote_reference,
+                                    nodes.citation_reference)):
+                refid = footnote_refid(child, document)
+                if refid in footnotes and refid not in seen:
+                    seen.add(refid)
+                    first_refs[child['ids'][0]] = footnotes[refid]
+                    walk(footnotes[refid])
+            elif isinstance(child, nodes.Element):
+                walk(child)
+    walk(document)
+    return first_refs
+
 def item_to_front(list, index):
     """
     Move the item at index of the list to the front of the list.  This
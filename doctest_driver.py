@@ -25,8 +25,10 @@ A number of other flags can be given; call the driver with the
 from __future__ import print_function
 
 import codecs
-import os, os.path, sys, unittest, pdb, bdb, re, tempfile, traceback
-import textwrap
+import os, os.path, sys, unittest, pdb, bdb, re, traceback, linecache
+import textwrap, hashlib, json, time, pickle, signal, bisect, gc
+import tracemalloc, resource, types, ast, builtins, difflib, inspect, dis
+import marshal, importlib.util
 from doctest import *
 from doctest import DocTestCase, DocTestRunner
 from optparse import OptionParser, OptionGroup, Option
@@ -86,6 +88,31 @@ class _SpoofOut(StringIO):
         if hasattr(self, "softspace"):
             del self.softspace
 
+class _OutputRedirectingPdb(pdb.Pdb):
+    def __init__(self, out):
+        self.__out = out
+        self.__debugger_used = False
+        pdb.Pdb.__init__(self, stdout=out, nosigint=True)
+        self.use_rawinput = 1
+
+    def set_trace(self, frame=None):
+        self.__debugger_used = True
+        if frame is None:
+            frame = sys._getframe().f_back
+        pdb.Pdb.set_trace(self, frame)
+
+    def set_continue(self):
+        if self.__debugger_used:
+            pdb.Pdb.set_continue(self)
+
+    def trace_dispatch(self, *args):
+        save_stdout = sys.stdout
+        sys.stdout = self.__out
+        try:
+            return pdb.Pdb.trace_dispatch(self, *args)
+        finally:
+            sys.stdout = save_stdout
+
 ###########################################################################
 # MyParser
 ###########################################################################
@@ -109,6 +136,16 @@ class MyDocTestParser(DocTestParser):
         (.*\S.*\n)*                          # non-blank lines
         ''', re.VERBOSE+re.MULTILINE)
 
+    # A per-example time limit: "# doctest: +TIMEOUT(30)".  It isn't a
+    # doctest option flag, so it's removed before options are parsed.
+    TIMEOUT_RE = re.compile(r'\+TIMEOUT\(\s*([0-9.]+)\s*\)')
+    TIMEOUT_DIRECTIVE_RE = re.compile(r'#\s*doctest:[^\n]*'
+                                      r'\+TIMEOUT\(\s*([0-9.]+)\s*\)')
+
+    def _find_options(self, source, name, lineno):
+        return DocTestParser._find_options(self, self.TIMEOUT_RE.sub('', source),
+                                           name, lineno)
+
     def parse(self, string, name='<string>'):
         output = []
         lineno_offset = 0
@@ -152,6 +189,10 @@ class MyDocTestParser(DocTestParser):
         #        print ex.source
         #output = []
 
+        for example in output:
+            if isinstance(example, Example):
+                m = self.TIMEOUT_DIRECTIVE_RE.search(example.source)
+                example.timeout = m and float(m.group(1))
         return output
 
     def get_examples(self, string, name='<string>'):
@@ -189,10 +230,10 @@ class UpdateRunner(DocTestRunner):
     However, care must be taken not to update an example's expected
     output with an incorrect value.
     """
-    def __init__(self, verbose=False, mark_updates=False):
+    def __init__(self, verbose=False, mark_updates=False, optionflags=0):
         '''Construct a new update runner'''
         self._mark_updates = mark_updates
-        DocTestRunner.__init__(self, verbose=verbose)
+        DocTestRunner.__init__(self, verbose=verbose, optionflags=optionflags)
 
     def run(self, test, compileflags=None, out=None, clear_globs=True):
         '''Run the update runner'''
@@ -298,24 +339,42 @@ class UpdateRunner(DocTestRunner):
 def _indent(s, indent=4):
     return re.sub('(?m)^(?!$)', indent*' ', s)
 
-import keyword, token, tokenize
 class Debugger:
+    """
+    Run a test's examples, and enter the python debugger whenever an
+    example's actual output does not match its expected output (or it
+    raises an unexpected exception, in which case the debugger is
+    entered post-mortem).
+
+    Each example is compiled from memory when it's reached, under a
+    synthetic filename (C{<doctest NAME>}) whose line numbers are the
+    test's; the test's text is registered in C{linecache} under that
+    name the first time the debugger is entered, so pdb can list it.
+    Code objects are cached by the debugger, and for a text file, in
+    its L{PARSE_CACHE} entry, so debugging it again doesn't compile
+    its examples again.  If `start_at` is given, then the examples
+    before the one on that line are run silently, without checking
+    their output.
+    """
     # Just using this for reporting:
     runner = DocTestRunner()
 
-    def __init__(self, checker=None, set_trace=None):
+    def __init__(self, checker=None, set_trace=None, optionflags=0,
+                 start_at=None):
         if checker is None:
             checker = OutputChecker()
         self.checker = checker
         if set_trace is None:
             set_trace = pdb.Pdb().set_trace
         self.set_trace = set_trace
+        self.optionflags = optionflags
+        self.start_at = start_at
+        self._code = {} # (filename, lineno, source) -> code object
 
     def _check_output(self, example):
         want = example.want
         optionflags = self._get_optionflags(example)
         got = sys.stdout.getvalue()
-        sys.stdout.truncate(0)
         if not self.checker.check_output(want, got, optionflags):
             self.runner.report_failure(self.save_stdout.write,
                                        self.test, example, got)
@@ -323,10 +382,9 @@ class Debugger:
         else:
             return True
 
-    def _check_exception(self, example):
+    def _check_exception(self, example, exc_info):
         want_exc_msg = example.exc_msg
         optionflags = self._get_optionflags(example)
-        exc_info = sys.exc_info()
         got_exc_msg = traceback.format_exception_only(*exc_info[:2])[-1]
         if not self.checker.check_output(want_exc_msg, got_exc_msg,
                                          optionflags):
@@ -337,133 +395,8 @@ class Debugger:
         else:
             return True
 
-    def _print_if_not_none(self, *args):
-        if args == (None,):
-            pass
-        elif len(args) == 1:
-            print(repr(args[0]))
-        else:
-            print(repr(args)) # not quite right: >>> 1,
-
-    def _comment_line(self, line):
-        "Return a commented form of the given line"
-        line = line.rstrip()
-        if line:
-            return '# '+line
-        else:
-            return '#'
-
-    def _script_from_examples(self, s):
-        output = []
-        examplenum = 0
-        for piece in MyDocTestParser().parse(s):
-            if isinstance(piece, Example):
-                self._script_from_example(piece, examplenum, output)
-                examplenum += 1
-            else:
-                # Add non-example text.
-                output += [self._comment_line(l)
-                           for l in piece.split('\n')[:-1]]
-        # Combine the output, and return it.
-        return '\n'.join(output)
-
-    _CHK_OUT = 'if not CHECK_OUTPUT(__examples__[%d]): __set_trace__()'
-    _CHK_EXC = 'if not CHECK_EXCEPTION(__examples__[%d]): __set_trace__()'
-
-    def _script_from_example(self, example, i, output):
-        source = self._simulate_compile_singlemode(example.source)[:-1]
-
-        if example.exc_msg is None:
-            output.append(source)
-            output.append(self._CHK_OUT % i)
-        else:
-            output.append('try:')
-            output.append(_indent(source))
-            output.append('    '+self._CHK_OUT % i)
-            output.append('except:')
-            output.append('    '+self._CHK_EXC % i)
-
-    def _simulate_compile_singlemode(self, s):
-        # Calculate line offsets
-        lines = [0, 0]
-        pos = 0
-        while True:
-            pos = s.find('\n', pos)+1
-            if not pos: break
-            lines.append(pos)
-        lines.append(len(s))
-
-        oldpos = 0
-        parenlevel = 0
-        deflevel = 0
-        output = []
-        stmt = []
-
-        text = StringIO(s)
-        tok_gen = tokenize.generate_tokens(text.readline)
-        for toktype, tok, (srow,scol), (erow,ecol), line in tok_gen:
-            newpos = lines[srow] + scol
-            stmt.append(s[oldpos:newpos])
-            if tok != '':
-                stmt.append(tok)
-            oldpos = newpos + len(tok)
-
-            # Update the paren level.
-            if tok in '([{':
-                parenlevel += 1
-            if tok in '}])':
-                parenlevel -= 1
-
-            if tok in ('def', 'class') and deflevel == 0:
-                deflevel = 1
-            if deflevel and toktype == token.INDENT:
-                deflevel += 1
-            if deflevel and toktype == token.DEDENT:
-                deflevel -= 1
-
-            # Are we starting a statement?
-            if ((toktype in (token.NEWLINE, tokenize.NL, tokenize.COMMENT,
-                             token.INDENT, token.ENDMARKER) or
-                 tok==':') and parenlevel == 0):
-                if deflevel == 0 and self._is_expr(stmt[1:-2]):
-                    output += stmt[0]
-                    output.append('__print__((')
-                    output += stmt[1:-2]
-                    output.append('))')
-                    output += stmt[-2:]
-                else:
-                    output += stmt
-                stmt = []
-        return ''.join(output)
-
-    def _is_expr(self, stmt):
-        stmt = [t for t in stmt if t]
-        if not stmt:
-            return False
-
-        # An assignment signifies a non-exception, *unless* it
-        # appears inside of parens (eg, ``f(x=1)``.)
-        parenlevel = 0
-        for tok in stmt:
-            if tok in '([{': parenlevel += 1
-            if tok in '}])': parenlevel -= 1
-            if (parenlevel == 0 and
-                tok in ('=', '+=', '-=', '*=', '/=', '%=', '&=', '+=',
-                       '^=', '<<=', '>>=', '**=', '//=')):
-                return False
-
-        # Any keywords *except* "not", "or", "and", "lambda", "in", "is"
-        # signifies a non-expression.
-        if stmt[0] in ("assert", "break", "class", "continue", "def",
-                       "del", "elif", "else", "except", "exec",
-                       "finally", "for", "from", "global", "if",
-                       "import", "pass", "print", "raise", "return",
-                       "try", "while", "yield"):
-            return False
-        return True
-
     def _get_optionflags(self, example):
-        optionflags = 0
+        optionflags = self.optionflags
         for (flag, val) in example.options.items():
             if val:
                 optionflags |= flag
@@ -471,65 +404,119 @@ class Debugger:
                 optionflags &= ~flag
         return optionflags
 
+    def _cached_code(self, test, filename):
+        """
+        Return the dict (example line -> marshalled code object) kept
+        in the L{PARSE_CACHE} entry for the test's file, or None if the
+        test doesn't come from a (whole) text file.  The dict is
+        discarded if the python version or the filename has changed.
+        """
+        if not (isinstance(test, CachedDocTest) and test.section is None):
+            return None
+        entry, text = PARSE_CACHE.entry(test.filename)
+        key = (importlib.util.MAGIC_NUMBER, filename, COMPILER_FLAGS)
+        if entry.get('code', (None,))[0] != key:
+            PARSE_CACHE.store(entry, 'code', (key, {}))
+        self._entry = entry
+        return entry['code'][1]
+
+    def _compile(self, example, filename, offset, cached):
+        # Compile an example as an interactive statement (so the
+        # value of an expression is printed), on its line of the test.
+        key = (filename, example.lineno, example.source)
+        code = self._code.get(key)
+        if code is None and cached is not None and example.lineno in cached:
+            code = marshal.loads(cached[example.lineno])
+        if code is None:
+            tree = compile(example.source, filename, 'single',
+                           COMPILER_FLAGS | ast.PyCF_ONLY_AST, True)
+            ast.increment_lineno(tree, offset + example.lineno)
+            code = compile(tree, filename, 'single', COMPILER_FLAGS, True)
+            if cached is not None:
+                cached[example.lineno] = marshal.dumps(code)
+                PARSE_CACHE.store(self._entry, 'code', self._entry['code'])
+        self._code[key] = code
+        return code
+
+    def _register_source(self, test, filename, offset):
+        if filename in linecache.cache: return
+        lines = ['\n'] * offset + test.docstring.splitlines(True)
+        linecache.cache[filename] = (sum(map(len, lines)), None, lines,
+                                     filename)
+
     def debug(self, test, pm=False):
         self.test = test
 
         # Save the old stdout
         self.save_stdout = sys.stdout
 
-        # Convert the source docstring to a script.
-        script = self._script_from_examples(test.docstring)
+        filename = '<doctest %s>' % test.name
+        offset = test.lineno or 0
+        cached = self._cached_code(test, filename)
 
         # Create a debugger.
         debugger = _OutputRedirectingPdb(sys.stdout)
 
         # Patch pdb.set_trace to restore sys.stdout during interactive
-        # debugging (so it's not still redirected to self._fakeout).
+        # debugging (so it's not still redirected to a _SpoofOut).
         save_set_trace = pdb.set_trace
         pdb.set_trace = debugger.set_trace
-
-        # Write the script to a temporary file.  Note that
-        # tempfile.NameTemporaryFile() cannot be used.  As the docs
-        # say, a file so created cannot be opened by name a second
-        # time on modern Windows boxes, and execfile() needs to open
-        # it.
-        srcfilename = tempfile.mktemp(".py", "doctestdebug_")
-        f = open(srcfilename, 'w')
-        f.write(script)
-        f.close()
-
-        # Set up the globals
-        test.globs['CHECK_OUTPUT'] = self._check_output
-        test.globs['CHECK_EXCEPTION'] = self._check_exception
-        test.globs['__print__'] = self._print_if_not_none
         test.globs['__set_trace__'] = debugger.set_trace
-        test.globs['__examples__'] = self.test.examples
         try:
-            if pm is False:
-                debugger.run("execfile(%r)" % srcfilename,
-                             test.globs, test.globs)
-            else:
+            sys.stdout = _SpoofOut()
+            for example in test.examples:
+                if self._get_optionflags(example) & SKIP:
+                    continue
+                lineno = offset + example.lineno + 1
+                quiet = (self.start_at is not None and
+                         lineno + example.source.count('\n') <=
+                         self.start_at)
+                sys.stdout.seek(0)
+                sys.stdout.truncate(0)
                 try:
-                    sys.stdout = _SpoofOut()
-                    try:
-                        exec(compile(open(srcfilename).read(), srcfilename, 'exec'), test.globs)
-                    except bdb.BdbQuit:
-                        return
-                    except:
+                    code = self._compile(example, filename, offset, cached)
+                    if pm is False and not quiet:
+                        self._register_source(test, filename, offset)
+                        debugger.run(code, test.globs, test.globs)
+                    else:
+                        exec(code, test.globs)
+                except bdb.BdbQuit:
+                    return
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    exc_info = sys.exc_info()
+                    if quiet:
+                        continue
+                    if example.exc_msg is not None:
+                        if not self._check_exception(example, exc_info):
+                            self._stop(test, filename, offset, lineno)
+                        continue
+                    self._register_source(test, filename, offset)
+                    self.runner.report_unexpected_exception(
+                        self.save_stdout.write, test, example, exc_info)
+                    # (A syntax error has no frame to examine.)
+                    if exc_info[2].tb_next is not None:
                         sys.stdout = self.save_stdout
-                        exc_info = sys.exc_info()
-                        exc_msg = traceback.format_exception_only(
-                            exc_info[0], exc_info[1])[-1]
-                        self.save_stdout.write(self.runner.DIVIDER+'\n')
-                        self.save_stdout.write('Unexpected exception:\n' +
-                                               _indent(exc_msg))
-                        raise
-                        #self.post_mortem(debugger, exc_info[2])
-                finally:
-                    sys.stdout = self.save_stdout
+                        self.post_mortem(debugger, exc_info[2])
+                        sys.stdout = _SpoofOut()
+                        if debugger.quitting:
+                            return
+                else:
+                    if not quiet and not self._check_output(example):
+                        self._stop(test, filename, offset, lineno)
         finally:
-            sys.set_trace = save_set_trace
-            os.remove(srcfilename)
+            sys.stdout = self.save_stdout
+            pdb.set_trace = save_set_trace
+            test.globs.pop('__set_trace__', None)
+
+    def _stop(self, test, filename, offset, lineno):
+        # Enter the debugger in the test's globals, on the line of the
+        # example that failed.
+        self._register_source(test, filename, offset)
+        code = compile('\n' * (lineno-1) + '__set_trace__()\n', filename,
+                       'exec')
+        exec(code, test.globs)
 
     def post_mortem(self, debugger, t):
         debugger.reset()
@@ -546,8 +533,10 @@ class Debugger:
 #   - The filename of a python file
 #   - The dotted name of a python module
 
-# Return a list of test!
-def find(name):
+# Return a list of test!  (If `split` is true, then a text file is
+# split into sections, and a generator of tests is returned instead;
+# see find_sections for `replay` & `only`.)
+def find(name, split=False, replay=False, only=None):
     # Check for test names
     if ':' in name:
         (name, testname) = name.split(':')
@@ -562,8 +551,15 @@ def find(name):
             if testname is not None:
                 raise ValueError("test names can't be specified "
                                  "for text files")
-            s = codecs.open(filename, encoding="utf-8").read()
-            test = MyDocTestParser().get_doctest(s, {}, name, filename, 0)
+            entry, s = PARSE_CACHE.entry(filename)
+            if split:
+                return find_sections(entry, s, name, filename, replay, only)
+            if 'whole' not in entry:
+                if s is None: s = read_text(filename)
+                PARSE_CACHE.store(entry, 'whole', pack_examples(
+                    MyDocTestParser().get_examples(s, name)))
+            test = CachedDocTest(unpack_examples(entry['whole']), name,
+                                 filename, 0, docstring=s)
             return [test]
         else:
             # It's a python file; import it.  Make sure to set the
@@ -587,6 +583,62 @@ def find(name):
             raise ValueError("test not found")
     return tests
 
+def find_sections(entry, text, name, filename, replay=False, only=None):
+    """
+    Generate a test for each section of the file `filename`, split as
+    doctest_split.py splits it; but without writing the sections out.
+    Each test is named after the file doctest_split.py would write
+    (e.g. C{ch01-3}), and starts with the examples of
+    L{SECTION_PRELUDE}.  Its line numbers are those of the original
+    file (the prelude's examples are on the line where the section
+    starts).  Sections are only parsed as they are needed: `entry` is
+    the file's entry in L{PARSE_CACHE}, and if its sections weren't
+    all cached, then they are parsed from `text` (the file's contents,
+    or None if they haven't been read yet).
+
+    If `replay` is true, then each test's C{setup} attribute is the
+    list of examples from earlier sections that it depends on (see
+    L{replay_examples}), which the runner runs first.  If `only` is
+    given, then only the test for that section (numbered from 1) is
+    generated.
+    """
+    parser = MyDocTestParser()
+    basename = os.path.splitext(name)[0]
+    earlier = [] # [(example, ExampleNames)] of the sections so far.
+    if 'sections' in entry:
+        sections = [(lineno, None, packed)
+                    for (lineno, packed) in entry['sections']]
+    else:
+        if text is None: text = read_text(filename)
+        sections = [(lineno, section, None)
+                    for (lineno, section) in split_sections(text)]
+    parsed = [] # [(lineno, packed examples)], to be cached.
+    for (k, (lineno, section, packed)) in enumerate(sections):
+        if only is not None and k+1 > only: return
+        if only is not None and k+1 != only and not replay: continue
+        if packed is None:
+            packed = pack_examples(parser.get_examples(section, name))
+            parsed.append((lineno, packed))
+            if len(parsed) == len(sections):
+                PARSE_CACHE.store(entry, 'sections', parsed)
+        test = CachedDocTest(unpack_examples(packed),
+                             '%s-%d' % (basename, k+1), filename, lineno,
+                             docstring=section, section=k)
+        examples = test.examples
+        if replay:
+            names = [(ex, ExampleNames(ex.source)) for ex in examples]
+        if not examples or (only is not None and k+1 != only):
+            if replay: earlier.extend(names)
+            continue
+        prelude = parser.get_examples(SECTION_PRELUDE)
+        for example in prelude:
+            example.lineno = 0
+        test.examples = prelude + examples
+        if replay:
+            test.setup = replay_examples(earlier, test.examples)
+            earlier.extend(names)
+        yield test
+
 def import_from_name(name):
     try:
         return __import__(name, globals(), locals(), ['*'])
@@ -679,35 +731,779 @@ class MyOutputChecker(OutputChecker):
             want = self.CALLOUT_RE.sub('', want)
             return OutputChecker.check_output(self, want, got, optionflags)
 
+###########################################################################
+# Result Cache
+###########################################################################
+
+CACHE_FILE = 'doctest_driver.cache'
+
+def environment_fingerprint():
+    """
+    Return a hash of the parts of the environment that the results of
+    the tests depend on (besides the tests themselves): the python
+    version, the version & location of nltk, the names, sizes and
+    modification times of nltk's own C{.py} files (so that editing an
+    nltk checkout invalidates the cache), and those of the files in
+    the nltk_data directories.
+    """
+    parts = ['python %s' % sys.version]
+    try:
+        import nltk
+    except ImportError:
+        nltk = None
+    if nltk is not None:
+        nltk_dir = os.path.dirname(nltk.__file__)
+        parts.append('nltk %s %s' % (getattr(nltk, '__version__', '?'),
+                                     nltk_dir))
+        parts.extend(_file_stats(nltk_dir, '.py'))
+        data = getattr(nltk, 'data', None)
+        for data_dir in getattr(data, 'path', []):
+            if not os.path.isdir(data_dir): continue
+            parts.extend(_file_stats(data_dir))
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def _file_stats(directory, ext=''):
+    """Return the path, modification time and size of each file under
+    `directory` whose name ends with `ext`, in a fixed order."""
+    stats = []
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(ext): continue
+            path = os.path.join(dirpath, filename)
+            try: st = os.stat(path)
+            except OSError: continue
+            stats.append('%s %d %d' % (path, st.st_mtime, st.st_size))
+    return stats
+
+class ResultCache:
+    """
+    A record of the tests that passed, so that they need not be run
+    again.  A test is identified by a hash of the source, expected
+    output, options and timeout of each of its examples (and of the
+    driver's option flags and --timeout, and of any examples it
+    replays first); since each test is run with its own globals, its
+    results can't depend on any other test.  The whole cache is
+    discarded if the environment (see L{environment_fingerprint})
+    changes.
+
+    Only the tests of text files are cached: a python module's tests
+    exercise the module's own code, which isn't part of the key.
+    """
+    def __init__(self, optionflags, timeout=None, filename=CACHE_FILE):
+        self.optionflags = optionflags
+        self.timeout = timeout
+        self.filename = filename
+        self.environment = environment_fingerprint()
+        self.passed = self._load()   # key -> number of examples
+        self.added = {}
+        self.hits = self.misses = 0
+        self.examples_skipped = 0
+
+    def _load(self):
+        try:
+            f = open(self.filename)
+            try: contents = json.load(f)
+            finally: f.close()
+        except (IOError, ValueError):
+            return {}
+        if contents.get('environment') != self.environment:
+            return {}
+        return contents.get('passed', {})
+
+    def key(self, test):
+        """Return the key for `test`, or None if it can't be cached."""
+        if not isinstance(test, CachedDocTest): return None
+        h = hashlib.sha1(('%d\0%r\0' % (self.optionflags, self.timeout)
+                          ).encode('utf-8'))
+        for example in getattr(test, 'setup', []) + test.examples:
+            h.update(('%s\0%s\0%s\0%r\0%r\0' % (
+                example.source, example.want, example.exc_msg,
+                sorted(example.options.items()),
+                getattr(example, 'timeout', None))).encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key):
+        """Return true if the test with the given key is known to
+        pass (and count it as a hit or a miss)."""
+        if key in self.passed:
+            self.hits += 1
+            self.examples_skipped += self.passed[key]
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key, test):
+        self.added[key] = len(test.examples)
+
+    def save(self):
+        if not self.added: return
+        # Another driver (e.g., for another chapter) may have saved
+        # the cache since we loaded it, so merge with what's there.
+        passed = self._load()
+        passed.update(self.added)
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'w')
+            try: json.dump({'environment': self.environment,
+                            'passed': passed}, f)
+            finally: f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as e:
+            print('%s: Could not save the result cache -- %s' %
+                  (sys.argv[0], e), file=sys.stderr)
+
+    def report(self):
+        total = self.hits + self.misses
+        print('Result cache: %d of %d test(s) cached (%d example(s) '
+              'not run)' % (self.hits, total, self.examples_skipped),
+              file=sys.stderr)
+
+###########################################################################
+# Parse Cache
+###########################################################################
+
+PARSE_CACHE_FILE = 'doctest_driver.parsed'
+
+PARSER_VERSION = 1
+"""The version of L{MyDocTestParser}'s output: change it whenever the
+   parser changes, so that cached examples are parsed again."""
+
+def read_text(filename):
+    return codecs.open(filename, encoding="utf-8").read()
+
+def pack_examples(examples):
+    """Return a compact, picklable form of a list of examples (see
+    L{unpack_examples})."""
+    return [(ex.source, ex.want, ex.exc_msg, ex.lineno, ex.indent,
+             sorted(ex.options.items()), getattr(ex, 'timeout', None))
+            for ex in examples]
+
+def unpack_examples(packed):
+    """Return (new) examples from the output of L{pack_examples}."""
+    examples = []
+    for (source, want, exc_msg, lineno, indent, options, timeout) in packed:
+        example = Example(source, want, exc_msg, lineno, indent,
+                          dict(options))
+        example.timeout = timeout
+        examples.append(example)
+    return examples
+
+class CachedDocTest(DocTest):
+    """
+    A test made from cached examples.  Its docstring (the text its
+    examples were parsed from, which L{update} and L{Debugger} need) is
+    only read from its file if it's used; `section` is the index of
+    that text in the file's sections (see L{split_sections}), or None
+    if it's the whole file.
+    """
+    def __init__(self, examples, name, filename, lineno, docstring=None,
+                 section=None):
+        self.section = section
+        DocTest.__init__(self, examples, {}, name, filename, lineno,
+                         docstring)
+
+    def _get_docstring(self):
+        if self._docstring is None:
+            text = read_text(self.filename)
+            if self.section is not None:
+                text = split_sections(text)[self.section][1]
+            self._docstring = text
+        return self._docstring
+
+    def _set_docstring(self, docstring):
+        self._docstring = docstring
+
+    docstring = property(_get_docstring, _set_docstring)
+
+class ParseCache:
+    """
+    The examples parsed from each text file (as a whole, and section
+    by section), so that an unchanged file need not be read or parsed
+    again.  An entry is used if the file's modification time & size
+    are unchanged (so only a stat is needed), or if they changed but
+    the hash of its contents didn't; and if L{PARSER_VERSION} is
+    unchanged.
+    """
+    def __init__(self, filename=PARSE_CACHE_FILE):
+        self.filename = filename
+        self._entries = None # path -> entry
+        self._changed = {}   # the entries that were changed
+
+    def _load(self):
+        try:
+            f = open(self.filename, 'rb')
+            try: entries = pickle.load(f)
+            finally: f.close()
+        except Exception:
+            entries = {} # a missing or corrupt cache is just discarded.
+        return entries
+
+    def entry(self, path):
+        """
+        Return `(entry, text)`: the entry for the file `path` (a dict
+        that may have a C{'whole'} or C{'sections'} item, with packed
+        examples); and the file's contents, or None if they weren't
+        read (because the entry was fresh).
+        """
+        if self._entries is None: self._entries = self._load()
+        st = os.stat(path)
+        stat = (st.st_mtime, st.st_size)
+        entry = self._entries.get(path)
+        if (entry is not None and entry['version'] == PARSER_VERSION and
+            entry['stat'] == stat):
+            return entry, None
+        text = read_text(path)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        if (entry is None or entry['version'] != PARSER_VERSION or
+            entry['digest'] != digest):
+            entry = {'version': PARSER_VERSION, 'digest': digest}
+        entry['stat'] = stat
+        self._entries[path] = self._changed[path] = entry
+        return entry, text
+
+    def store(self, entry, kind, packed):
+        """Record packed examples in an entry returned by `entry()`."""
+        entry[kind] = packed
+        for (path, e) in self._entries.items():
+            if e is entry: self._changed[path] = entry
+
+    def save(self):
+        if not self._changed: return
+        # Another driver may have saved the cache since we loaded it.
+        entries = self._load()
+        entries.update(self._changed)
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try: pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+            finally: f.close()
+            os.rename(tmp, self.filename)
+            self._changed = {}
+        except (IOError, OSError) as e:
+            print('%s: Could not save the parse cache -- %s' %
+                  (sys.argv[0], e), file=sys.stderr)
+
+PARSE_CACHE = ParseCache()
+
+###########################################################################
+# Section Dependencies
+###########################################################################
+
+MUTATING_METHODS = set("""append extend insert remove pop clear sort
+    reverse update setdefault popitem add discard difference_update
+    intersection_update symmetric_difference_update inc""".split())
+"""Methods that are assumed to modify the object they're called on
+   (e.g. C{tags.append(t)}), so that an example calling one must be
+   replayed before a later section that uses the object."""
+
+BUILTIN_NAMES = set(dir(builtins))
+
+class ExampleNames(ast.NodeVisitor):
+    """
+    The global names that an example's source binds, modifies & reads,
+    found by walking its syntax tree.  Names that are bound inside
+    functions, classes, lambdas & comprehensions are local to them, so
+    they aren't counted as bound (but the names they read are counted
+    as read).  Names read in the body of a function or lambda are
+    C{late_reads}, since they're read when it's called, not when the
+    example runs.  `star` is true if the example contains a C{from m
+    import *}.  Source that can't be parsed binds & reads nothing
+    (since it can't be run either).
+    """
+    def __init__(self, source):
+        self.binds, self.modifies, self.reads = set(), set(), set()
+        self.late_reads = set()
+        self.star = False
+        self._depth = 0
+        self._deferred = 0
+        try: tree = ast.parse(source)
+        except SyntaxError: return
+        self.visit(tree)
+
+    def _bind(self, name):
+        if self._depth == 0: self.binds.add(name)
+
+    def _modify(self, node):
+        # The name at the base of an attribute/subscript expression.
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        if isinstance(node, ast.Name) and self._depth == 0:
+            self.modifies.add(node.id)
+
+    def _visit_scope(self, nodes, deferred=False):
+        self._depth += 1
+        self._deferred += deferred
+        for node in nodes: self.visit(node)
+        self._deferred -= deferred
+        self._depth -= 1
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load): self._bind(node.id)
+        elif self._deferred: self.late_reads.add(node.id)
+        else: self.reads.add(node.id)
+
+    def visit_FunctionDef(self, node):
+        for child in node.decorator_list: self.visit(child)
+        self.visit(node.args)
+        if node.returns is not None: self.visit(node.returns)
+        self._bind(node.name)
+        self._visit_scope(node.body, deferred=True)
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        for child in node.decorator_list + node.bases + node.keywords:
+            self.visit(child)
+        self._bind(node.name)
+        self._visit_scope(node.body)
+
+    def visit_Lambda(self, node):
+        self.visit(node.args)
+        self._visit_scope([node.body], deferred=True)
+
+    def visit_ListComp(self, node):
+        self._visit_scope([node.elt] + node.generators)
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self._visit_scope([node.key, node.value] + node.generators)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._bind(alias.asname or alias.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == '*': self.star = True
+            else: self._bind(alias.asname or alias.name)
+
+    def visit_ExceptHandler(self, node):
+        if node.name: self._bind(node.name)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        # "x += 1" reads & modifies x; it doesn't replace it.
+        if isinstance(node.target, ast.Name):
+            self.reads.add(node.target.id)
+            if self._depth == 0: self.modifies.add(node.target.id)
+        else:
+            self._modify(node.target)
+            self.visit(node.target)
+        self.visit(node.value)
+
+    def visit_Assign(self, node):
+        for target in node.targets: self._modify_targets(target)
+        self.generic_visit(node)
+
+    def visit_Delete(self, node):
+        for target in node.targets: self._modify_targets(target)
+        self.generic_visit(node)
+
+    def _modify_targets(self, target):
+        if isinstance(target, (ast.Tuple, ast.List)):
+            for elt in target.elts: self._modify_targets(elt)
+        elif isinstance(target, (ast.Attribute, ast.Subscript)):
+            self._modify(target)
+
+    def visit_Call(self, node):
+        if (isinstance(node.func, ast.Attribute) and
+            node.func.attr in MUTATING_METHODS):
+            self._modify(node.func.value)
+        self.generic_visit(node)
+
+def replay_examples(earlier, examples):
+    """
+    Return the examples of `earlier` (a list of C{(example,
+    ExampleNames)} pairs, in order) that must be run before `examples`
+    for the global names they read to have the values they would have
+    had if every earlier example had been run.  Working backwards, an
+    earlier example is needed if it binds or modifies a name that is
+    still needed (or if it's a C{*} import and some needed name isn't a
+    builtin); the names it reads are then needed too, and the names it
+    binds are no longer needed (earlier values were replaced).  The
+    late reads of a needed function are needed by `examples` (which
+    may call it), so the search is repeated until they're all found.
+    """
+    wanted, bound = set(), set()
+    for example in examples:
+        names = ExampleNames(example.source)
+        wanted |= (names.reads | names.late_reads) - bound
+        bound |= names.binds
+    while True:
+        needed, late_reads = set(wanted), set()
+        replay = []
+        for (example, names) in reversed(earlier):
+            if not needed: break
+            if (needed & (names.binds | names.modifies) or
+                (names.star and needed - BUILTIN_NAMES)):
+                replay.append(example)
+                needed -= names.binds
+                needed |= names.reads
+                late_reads |= names.late_reads
+        if late_reads <= wanted: break
+        wanted |= late_reads
+    replay.reverse()
+    return replay
+
+###########################################################################
+# Profiling
+###########################################################################
+
+class ExampleProfile:
+    """
+    The time taken by each example that was run (as recorded by
+    L{MyDocTestRunner}): written to a file as JSON lines, summarized as
+    a list of the slowest examples, and checked against a time budget.
+    If `memory` is true, then the examples' memory use is recorded too,
+    and the examples that allocate the most memory, and the sections
+    that retain the most, are listed.  If `trace_api` is given, then
+    the nltk functions called by each chapter's examples (see
+    L{ApiTracer}) are written to that file, as JSON.
+    """
+    MEMORY_REPORT_SIZE = 10
+    """The number of examples & sections listed by the memory report."""
+
+    def __init__(self, filename=None, slowest=0, budget=None, memory=False,
+                 trace_api=None):
+        self.filename = filename
+        self.slowest = slowest
+        self.budget = budget
+        self.memory = memory
+        self.trace_api = trace_api
+        self.timings = []
+        self.api_usage = {} # chapter -> function -> [calls, seconds]
+
+    def add(self, timings, api_usage=None):
+        self.timings.extend(timings)
+        if api_usage:
+            merge_api_usage(self.api_usage, api_usage)
+
+    def finish(self):
+        """Write & report the profile; return the number of examples
+        that took longer than the time budget."""
+        if self.filename:
+            out = open(self.filename, 'w')
+            for timing in self.timings:
+                out.write(json.dumps(timing, sort_keys=True) + '\n')
+            out.close()
+        if self.slowest:
+            print('Slowest %d example(s):' % self.slowest, file=sys.stderr)
+            self._report(sorted(self.timings, key=lambda t: -t['wall'])
+                         [:self.slowest])
+        if self.memory:
+            self._report_memory()
+        if self.trace_api:
+            write_api_usage(self.trace_api, self.api_usage)
+        if self.budget is None:
+            return 0
+        over = [t for t in self.timings if t['wall'] > self.budget]
+        if over:
+            print('%d example(s) took longer than %gs:' %
+                  (len(over), self.budget), file=sys.stderr)
+            self._report(over)
+        return len(over)
+
+    def _report(self, timings):
+        for t in timings:
+            where = '%s:%s' % (os.path.relpath(t['file'] or t['test']),
+                               t['line'] or '?')
+            source = t['source']
+            if len(source) > 40: source = source[:37]+'...'
+            print('  %8.3fs wall %8.3fs cpu  %s  %s' %
+                  (t['wall'], t['cpu'], where, source), file=sys.stderr)
+
+    def _report_memory(self):
+        n = self.MEMORY_REPORT_SIZE
+        timings = [t for t in self.timings if 'peak' in t]
+        print('Top %d allocating example(s):' % n, file=sys.stderr)
+        for t in sorted(timings, key=lambda t: -t['peak'])[:n]:
+            where = '%s:%s' % (os.path.relpath(t['file'] or t['test']),
+                               t['line'] or '?')
+            source = t['source']
+            if len(source) > 40: source = source[:37]+'...'
+            print('  %8.1fM peak %8.1fM kept  %s  %s' %
+                  (t['peak']/2.0**20, t['retained']/2.0**20, where, source),
+                  file=sys.stderr)
+        # Retained memory per section: (file, section) -> [bytes, line]
+        sections = {}
+        for t in timings:
+            key = (t['file'] or t['test'], t['section'])
+            if key not in sections: sections[key] = [0, t['line']]
+            sections[key][0] += t['retained']
+        print('Top %d section(s) by retained memory:' % n, file=sys.stderr)
+        for (key, (retained, line)) in sorted(
+                sections.items(), key=lambda item: -item[1][0])[:n]:
+            print('  %8.1fM kept  %s, section %d (line %s)' %
+                  (retained/2.0**20, os.path.relpath(key[0]), key[1],
+                   line or '?'), file=sys.stderr)
+        if timings:
+            print('Maximum resident set size: %.1fM' %
+                  (max(t['maxrss'] for t in timings)/1024.0), file=sys.stderr)
+
+class ApiTracer:
+    """
+    Count the calls to each nltk function (by module & qualified
+    name), and the time spent in them (including the functions they
+    call), while it's started.  On Python 3.12+, it uses
+    C{sys.monitoring}, and disables the events for each function
+    outside of nltk the first time it's seen, so that the rest of the
+    code runs at full speed; otherwise, it uses C{sys.setprofile}.
+    """
+    def __init__(self):
+        import nltk
+        self.prefix = os.path.dirname(os.path.abspath(nltk.__file__))
+        self.root = os.path.dirname(self.prefix)
+        self.usage = {} # function -> [calls, seconds]
+        self._names = {} # code -> function name, or None if not nltk
+        self._stack = [] # [(code, start time)] of active nltk functions
+        self._depth = {} # code -> number of active calls
+        self._offsets = {} # generator code -> first offset
+        self.method = None
+
+    def _name(self, code):
+        try:
+            return self._names[code]
+        except KeyError:
+            name = None
+            if code.co_filename.startswith(self.prefix):
+                module = os.path.splitext(os.path.relpath(
+                    code.co_filename, self.root))[0].replace(os.sep, '.')
+                if module.endswith('.__init__'): module = module[:-9]
+                name = '%s.%s' % (module, getattr(code, 'co_qualname',
+                                                  code.co_name))
+            self._names[code] = name
+            return name
+
+    def _enter(self, code, count):
+        name = self._name(code)
+        if name is None: return False
+        if count:
+            entry = self.usage.get(name)
+            if entry is None: entry = self.usage[name] = [0, 0.0]
+            entry[0] += 1
+        self._depth[code] = self._depth.get(code, 0) + 1
+        self._stack.append((code, time.perf_counter()))
+        return True
+
+    def _exit(self, code):
+        if self._name(code) is None: return False
+        now = time.perf_counter()
+        while self._stack:
+            (active, start) = self._stack.pop()
+            self._depth[active] -= 1
+            # (Recursive calls are only timed at the outermost call.)
+            if self._depth[active] == 0:
+                self.usage[self._name(active)][1] += now - start
+            if active is code: break
+        return True
+
+    def start(self):
+        monitoring = getattr(sys, 'monitoring', None)
+        if monitoring is not None:
+            try:
+                monitoring.use_tool_id(monitoring.PROFILER_ID,
+                                       'doctest_driver')
+            except ValueError:
+                monitoring = None # (someone else is profiling.)
+        if monitoring is None:
+            self.method = 'sys.setprofile'
+            sys.setprofile(self._profile)
+            return
+        self.method = 'sys.monitoring'
+        events = monitoring.events
+        DISABLE = monitoring.DISABLE
+        def py_start(code, offset):
+            if not self._enter(code, True): return DISABLE
+        def py_resume(code, offset):
+            if not self._enter(code, False): return DISABLE
+        def py_return(code, offset, value):
+            if not self._exit(code): return DISABLE
+        def py_unwind(code, offset, exception):
+            self._exit(code) # (unwind events can't be disabled.)
+        for (event, callback) in [(events.PY_START, py_start),
+                                  (events.PY_RESUME, py_resume),
+                                  (events.PY_RETURN, py_return),
+                                  (events.PY_YIELD, py_return),
+                                  (events.PY_UNWIND, py_unwind)]:
+            monitoring.register_callback(monitoring.PROFILER_ID, event,
+                                         callback)
+        monitoring.restart_events()
+        monitoring.set_events(monitoring.PROFILER_ID, events.PY_START |
+                              events.PY_RESUME | events.PY_RETURN |
+                              events.PY_YIELD | events.PY_UNWIND)
+
+    GENERATOR_FLAGS = (inspect.CO_GENERATOR | inspect.CO_COROUTINE |
+                       inspect.CO_ASYNC_GENERATOR)
+
+    def _profile(self, frame, event, arg):
+        if event == 'call':
+            # Resuming a generator is also a 'call' event; but only a
+            # new generator is at (or before) its first instruction.
+            code = frame.f_code
+            self._enter(code, not code.co_flags & self.GENERATOR_FLAGS or
+                        frame.f_lasti <= self._first_offset(code))
+        elif event == 'return':
+            self._exit(frame.f_code)
+
+    def _first_offset(self, code):
+        # The offset of a code's first RESUME (Python 3.11+), or -1.
+        try:
+            return self._offsets[code]
+        except KeyError:
+            offset = -1
+            for instruction in dis.get_instructions(code):
+                if instruction.opname == 'RESUME':
+                    offset = instruction.offset
+                    break
+            self._offsets[code] = offset
+            return offset
+
+    def stop(self):
+        if self.method == 'sys.setprofile':
+            sys.setprofile(None)
+        elif self.method == 'sys.monitoring':
+            monitoring = sys.monitoring
+            monitoring.set_events(monitoring.PROFILER_ID, 0)
+            for event in (monitoring.events.PY_START,
+                          monitoring.events.PY_RESUME,
+                          monitoring.events.PY_RETURN,
+                          monitoring.events.PY_YIELD,
+                          monitoring.events.PY_UNWIND):
+                monitoring.register_callback(monitoring.PROFILER_ID, event,
+                                             None)
+            monitoring.free_tool_id(monitoring.PROFILER_ID)
+        self.method = None
+        # Functions that were still active are timed up to now.
+        if self._stack: self._exit(self._stack[0][0])
+
+def test_chapter(test):
+    """The name of the chapter that `test` comes from (e.g. C{ch01},
+    for C{ch01.rst}, or for a section such as C{ch01-3.doctest})."""
+    name = os.path.basename(test.filename or test.name)
+    return re.sub(r'-\d+$', '', os.path.splitext(name)[0])
+
+def merge_api_usage(usage, more):
+    """Add the API usage `more` (chapter -> function -> [calls,
+    seconds]) to `usage`."""
+    for (chapter, functions) in more.items():
+        totals = usage.setdefault(chapter, {})
+        for (name, (calls, seconds)) in functions.items():
+            entry = totals.setdefault(name, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+def write_api_usage(filename, usage):
+    """Write API usage to `filename`, as JSON: for each chapter (and
+    for all chapters together), the number of calls to each nltk
+    function and the (cumulative) seconds spent in it."""
+    total = {}
+    for functions in usage.values():
+        merge_api_usage(total, {'': functions})
+    def summary(functions):
+        return dict((name, {'calls': calls, 'seconds': round(seconds, 6)})
+                    for (name, (calls, seconds)) in functions.items())
+    out = open(filename, 'w')
+    json.dump({'python': sys.version.split()[0],
+               'chapters': dict((chapter, summary(functions))
+                                for (chapter, functions) in usage.items()),
+               'total': summary(total.get('', {}))},
+              out, indent=1, sort_keys=True)
+    out.write('\n')
+    out.close()
+
 ###########################################################################
 # Basic Actions
 ###########################################################################
 
+class ExampleTimeout(BaseException):
+    """
+    Raised (by a SIGALRM handler) in an example that has run for longer
+    than its time limit.  `output` is what the example had printed so
+    far.  (It's not an `Exception`, so that examples that catch
+    `Exception` don't catch it.)
+    """
+    def __init__(self, seconds, output):
+        BaseException.__init__(self, 'timed out after %gs' % seconds)
+        self.seconds = seconds
+        self.output = output
+
+def clear_section_globs(globs):
+    """
+    Delete the values that a section of a test defined from its
+    globals `globs`, so that the memory they use can be reclaimed.
+    Modules, functions & classes are kept, since later sections
+    usually rely on them without re-importing or re-defining them.
+    """
+    keep = (types.ModuleType, types.FunctionType, type)
+    for name in list(globs):
+        if not (name.startswith('__') or isinstance(globs[name], keep)):
+            del globs[name]
+    gc.collect()
+
 class MyDocTestRunner(DocTestRunner):
+    """
+    A doctest runner that reports progress & failures using colors
+    (if the terminal supports them).  By default, progress is written
+    to the process's stderr; but `stderr` can be used to redirect it
+    (in which case `term` and `stderr_term` should be given, to say
+    which colors to use), and `progress=False` turns off the
+    one-line-per-example progress display of verbosity 1.
+
+    If `memory` is true, then the memory allocated & retained by each
+    example is recorded (with tracemalloc) along with its timing.  If
+    `clear_sections` is true, then a test's globals are cleared
+    (except for modules, functions & classes) at the start of each of
+    its sections (see L{split_sections}).
+
+    `timeout` is the number of seconds that an example may run for
+    (unless it has a C{+TIMEOUT(n)} directive); an example that times
+    out is reported as a failure, and the rest of its test is skipped.
+
+    If `trace_api` is true, then the nltk functions that each test
+    calls are traced (see L{ApiTracer}), and recorded in `api_usage`
+    by chapter.
+    """
     def __init__(self, checker=None, verbosity=1, optionflags=0,
-                 kbinterrupt_continue=False):
+                 kbinterrupt_continue=False, term=None, stderr_term=None,
+                 stderr=None, progress=True, memory=False,
+                 clear_sections=False, timeout=None, trace_api=False):
         DocTestRunner.__init__(self, checker, (verbosity>2), optionflags)
         self._verbosity = verbosity
         self._current_test = None
-        self._term = TerminalController()
-        self._stderr_term = TerminalController(sys.__stderr__)
+        self._term = term or TerminalController()
+        self._stderr_term = stderr_term or TerminalController(sys.__stderr__)
+        self._stderr = stderr
+        self._progress = progress
         self._kbinterrupt_continue = kbinterrupt_continue
+        self._example_start = None
+        self._timed_out = None # The ExampleTimeout of the last example.
+        self._memory = memory
+        self._clear_sections = clear_sections
+        self._section_starts = None # (test, [section start line])
+        self._section = None
+        self._timeout = timeout
+        self._trace_api = trace_api
+        self.timings = [] # one dict per example run; see _record_timing.
+        self.api_usage = {} # chapter -> function -> [calls, seconds]
 
     def report_start(self, out, test, example):
-        if 1 <= self._verbosity <= 2:
+        if self._verbosity == 1 and not self._progress:
+            pass
+        elif 1 <= self._verbosity <= 2:
+            stderr = self._stderr or sys.__stderr__
             src = example.source.split('\n')[0]
             if len(src) > 60: src = src[:57]+'...'
             lineno = test.lineno + example.lineno + 1
             if self._verbosity == 1:
                 if self._stderr_term.CLEAR_LINE:
-                    sys.__stderr__.write(self._stderr_term.CLEAR_LINE)
+                    stderr.write(self._stderr_term.CLEAR_LINE)
                 else:
-                    sys.__stderr__.write('\n')
-            sys.__stderr__.write('%s  [Line %s] %s%s' %
-                                 (self._stderr_term.BOLD, lineno,
-                                  self._stderr_term.NORMAL, src))
+                    stderr.write('\n')
+            stderr.write('%s  [Line %s] %s%s' %
+                         (self._stderr_term.BOLD, lineno,
+                          self._stderr_term.NORMAL, src))
             if self._verbosity == 2:
-                sys.__stderr__.write('\n')
+                stderr.write('\n')
 
         else:
             DocTestRunner.report_start(self, out, test, example)
@@ -722,8 +1518,81 @@ class MyDocTestRunner(DocTestRunner):
             example.source = ('try:\n%sexcept KeyboardInterrupt:\n    '
                               'raise ValueError("KEYBOARD-INTERRUPT")\n' %
                               doctest._indent(example.source))
+        # (Sections are only needed for the memory report & clearing;
+        # finding them reads the text of a CachedDocTest's file.)
+        if self._memory or self._clear_sections:
+            section = self._example_section(test, example)
+            if section != self._section:
+                if self._clear_sections and self._section is not None:
+                    clear_section_globs(test.globs)
+                self._section = section
+        if self._memory:
+            tracemalloc.reset_peak()
+            self._example_memory = tracemalloc.get_traced_memory()[0]
+        self._example_start = (time.perf_counter(), time.process_time())
+        seconds = getattr(example, 'timeout', None) or self._timeout
+        self._timed_out = None
+        if seconds:
+            def alarm(signum, frame):
+                # (If the example expects an exception, then doctest
+                # reports this one as a failure, not as unexpected.)
+                self._timed_out = ExampleTimeout(
+                    seconds, self._fakeout.getvalue())
+                raise self._timed_out
+            signal.signal(signal.SIGALRM, alarm)
+            signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    def _cancel_timeout(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def _example_section(self, test, example):
+        """Return the index of the section of `test` that contains
+        `example`.  (For a section's test, from L{find_sections}, this
+        is the index of that section in its file.)"""
+        if getattr(test, 'section', None) is not None:
+            return test.section
+        if self._section_starts is None or self._section_starts[0] is not test:
+            starts = [lineno for (lineno, section)
+                      in split_sections(test.docstring or '')]
+            self._section_starts = (test, starts)
+            self._section = None
+        starts = self._section_starts[1]
+        return max(bisect.bisect_right(starts, example.lineno or 0) - 1, 0)
+
+    def _record_timing(self, test, example, outcome):
+        """Record how long `example` took, from the end of
+        `report_start` to the start of the report of its outcome."""
+        if self._example_start is None: return
+        wall = time.perf_counter() - self._example_start[0]
+        cpu = time.process_time() - self._example_start[1]
+        self._example_start = None
+        if self._memory:
+            current, peak = tracemalloc.get_traced_memory()
+        if test.lineno is not None and example.lineno is not None:
+            lineno = test.lineno + example.lineno + 1
+        else:
+            lineno = None
+        self.timings.append({
+            'file': test.filename, 'line': lineno, 'test': test.name,
+            'source': example.original_source.split('\n')[0],
+            'wall': round(wall, 6), 'cpu': round(cpu, 6),
+            'outcome': outcome, 'section': self._section})
+        if self._memory:
+            self.timings[-1].update(
+                peak=peak - self._example_memory,
+                retained=current - self._example_memory,
+                maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def report_success(self, out, test, example, got):
+        self._cancel_timeout()
+        self._record_timing(test, example, 'pass')
+        DocTestRunner.report_success(self, out, test, example, got)
 
     def report_failure(self, out, test, example, got):
+        self._cancel_timeout()
+        if self._timed_out is not None:
+            return self._report_timeout(out, test, example, self._timed_out)
+        self._record_timing(test, example, 'fail')
         example.source = example.original_source
         if self._verbosity == 1:
             out('\n')
@@ -732,6 +1601,10 @@ class MyDocTestRunner(DocTestRunner):
             self._term.NORMAL)
 
     def report_unexpected_exception(self, out, test, example, exc_info):
+        self._cancel_timeout()
+        if isinstance(exc_info[1], ExampleTimeout):
+            return self._report_timeout(out, test, example, exc_info[1])
+        self._record_timing(test, example, 'error')
         example.source = example.original_source
         if self._verbosity == 1:
             out('\n')
@@ -744,6 +1617,29 @@ class MyDocTestRunner(DocTestRunner):
             out('Exception raised:\n' + self._term.NORMAL +
                 _indent(_exception_traceback(exc_info)))
 
+    def _report_timeout(self, out, test, example, timeout):
+        self._record_timing(test, example, 'timeout')
+        example.source = example.original_source
+        if self._verbosity == 1:
+            out('\n')
+        out(self._failure_header(test, example) + self._term.RED +
+            self._term.BOLD + 'Timed out after %gs' % timeout.seconds)
+        skipped = self._skip_rest(test, example)
+        if skipped:
+            out('; skipping the %d remaining example(s)' % skipped)
+        out(self._term.NORMAL + '\n')
+        if timeout.output:
+            out(self._term.RED + 'Output before the timeout:\n' +
+                self._term.NORMAL + _indent(timeout.output))
+
+    def _skip_rest(self, test, example):
+        """Mark the examples of `test` after `example` to be skipped,
+        and return how many there are."""
+        rest = test.examples[test.examples.index(example)+1:]
+        for later in rest:
+            later.options[SKIP] = True
+        return len(rest)
+
     def _failure_header(self, test, example):
         out = (self._term.CYAN+self._term.BOLD+'*'*75+self._term.NORMAL+'\n')
         out += (self._term.GREEN)
@@ -765,6 +1661,8 @@ class MyDocTestRunner(DocTestRunner):
 
     def run(self, test, compileflags=None, out=None, clear_globs=True):
         save_stderr = sys.stderr
+        if self._stderr is not None:
+            save_stderr = self._stderr
         #sys.stderr = _SpoofOut()
 
         fails = tries = 0
@@ -772,6 +1670,14 @@ class MyDocTestRunner(DocTestRunner):
             print((
                 self._stderr_term.CYAN+self._stderr_term.BOLD+
                 'Testing %s...'%test.name+self._stderr_term.NORMAL), file=save_stderr)
+        if self._memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if getattr(test, 'setup', None):
+            self._replay(test, compileflags, save_stderr)
+        tracer = None
+        if self._trace_api:
+            tracer = ApiTracer()
+            tracer.start()
         try:
             fails, tries = DocTestRunner.run(self, test, compileflags,
                                              out, clear_globs)
@@ -782,6 +1688,22 @@ class MyDocTestRunner(DocTestRunner):
             print((
                 self._stderr_term.RED+self._stderr_term.BOLD+
                 'Keyboard Interrupt!'+self._stderr_term.NORMAL), file=save_stderr)
+            fails += 1 # (so an interrupted test isn't cached as a pass)
+        except ExampleTimeout:
+            # The alarm went off after the example finished, but before
+            # its output was checked.
+            if self._current_test is None: raise
+            print(self._failure_header(*self._current_test), file=save_stderr)
+            print((
+                self._stderr_term.RED+self._stderr_term.BOLD+
+                'Timed out!'+self._stderr_term.NORMAL), file=save_stderr)
+            fails += 1
+        finally:
+            self._cancel_timeout()
+            if tracer is not None:
+                tracer.stop()
+                merge_api_usage(self.api_usage,
+                                {test_chapter(test): tracer.usage})
         if self._verbosity == 1:
             save_stderr.write(self._stderr_term.CLEAR_LINE)
         if self._verbosity > 0:
@@ -794,24 +1716,87 @@ class MyDocTestRunner(DocTestRunner):
                     self._stderr_term.GREEN+self._stderr_term.BOLD+
                     '  All examples passed'+self._stderr_term.NORMAL), file=save_stderr)
         print(file=save_stderr)
-        sys.stderr = save_stderr
+        return fails, tries
+
+    def _replay(self, test, compileflags, stderr):
+        """Run the examples of `test.setup` (see L{find_sections}) in
+        `test.globs`, without checking their output.  An example that
+        raises an exception it wasn't expected to is reported."""
+        if self._verbosity > 1:
+            print('  Replaying %d example(s) from earlier sections' %
+                  len(test.setup), file=stderr)
+        save_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for example in test.setup:
+                try:
+                    exec(compile(example.source, test.filename, 'exec',
+                                 compileflags or COMPILER_FLAGS, True),
+                         test.globs)
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    if example.exc_msg is not None: continue
+                    print((self._stderr_term.YELLOW+
+                           '  Replaying line %s failed -- %s: %s' %
+                           (test.lineno + example.lineno + 1,
+                            e.__class__.__name__, e)+
+                           self._stderr_term.NORMAL), file=stderr)
+        finally:
+            sys.stdout = save_stdout
 
-def run(names, optionflags, verbosity, kbinterrupt_continue):
+    def report_cached(self, test):
+        """Report that `test` passed on an earlier run, and was not
+        run again."""
+        stderr = self._stderr or sys.stderr
+        if self._verbosity > 0:
+            print((
+                self._stderr_term.CYAN+self._stderr_term.BOLD+
+                'Testing %s...'%test.name+self._stderr_term.NORMAL), file=stderr)
+            print((
+                self._stderr_term.GREEN+self._stderr_term.BOLD+
+                '  All examples passed (cached)'+self._stderr_term.NORMAL),
+                file=stderr)
+        print(file=stderr)
+
+def run(names, optionflags, verbosity, kbinterrupt_continue, jobs=1,
+        cache=None, warm_up=None, profile=None, clear_sections=False,
+        timeout=None, split=False, replay=False, only=None):
+    if jobs != 1 or warm_up is not None:
+        return run_parallel(names, optionflags, verbosity,
+                            kbinterrupt_continue, jobs, cache, warm_up,
+                            profile, clear_sections, timeout, split,
+                            replay, only)
     checker = MyOutputChecker()
     runner = MyDocTestRunner(checker=checker, verbosity=verbosity,
                              optionflags=optionflags,
-                             kbinterrupt_continue=kbinterrupt_continue)
+                             kbinterrupt_continue=kbinterrupt_continue,
+                             memory=profile is not None and profile.memory,
+                             clear_sections=clear_sections, timeout=timeout,
+                             trace_api=profile is not None and
+                                       profile.trace_api is not None)
     for name in names:
-        try: tests = find(name)
+        try: tests = find(name, split, replay, only)
         except ValueError as e:
             print(('%s: Error processing %s -- %s' %
                                  (sys.argv[0], name, e)), file=sys.stderr)
             continue
         for test in tests:
-            runner.run(test, COMPILER_FLAGS)
+            key = None
+            if cache is not None:
+                key = cache.key(test)
+            if key is not None and cache.lookup(key):
+                runner.report_cached(test)
+            else:
+                fails, tries = runner.run(test, COMPILER_FLAGS)
+                if key is not None and not fails:
+                    cache.add(key, test)
             if verbosity == 1:
                 sys.stdout.write('.')
             sys.stdout.flush(); sys.stderr.flush()
+    _finish_cache(cache, verbosity)
+    if profile is not None:
+        profile.add(runner.timings, runner.api_usage)
     return runner
 
     # temporary hack:
@@ -830,8 +1815,505 @@ def run(names, optionflags, verbosity, kbinterrupt_continue):
                                  (sys.argv[0], name, e)), file=sys.stderr)
     unittest.TextTestRunner(verbosity=verbosity).run(suite)
 
-def debug(names, optionflags, verbosity, pm=True):
-    debugger = Debugger()
+def _finish_cache(cache, verbosity):
+    if cache is None: return
+    cache.save()
+    if verbosity > 0:
+        cache.report()
+
+###########################################################################
+# Parallel Checking
+###########################################################################
+# Each test (i.e., each file, or each docstring of a module) is run in a
+# worker process, with its own runner and its own globals.  A worker
+# records everything its runner writes to stdout & stderr, and the
+# recordings are played back in the order the tests were given, so the
+# output is the same as for a serial run (except that the progress
+# display of verbosity 1 is turned off).
+
+class _RecordedOutput:
+    """
+    A record of the text written to stdout & stderr, in order.  Use
+    `stream()` to get a file-like object that writes to the record.
+    """
+    def __init__(self):
+        self.chunks = [] # [(stream name, text)]
+        self.timings = [] # the runner's timings (see _record_timing)
+        self.api_usage = {} # the runner's api_usage (see ApiTracer)
+
+    def stream(self, name):
+        record = self
+        class Stream:
+            def write(self, text):
+                record.chunks.append((name, text))
+            def flush(self):
+                pass
+        return Stream()
+
+    def play(self):
+        for (name, text) in self.chunks:
+            getattr(sys, name).write(text)
+        sys.stdout.flush(); sys.stderr.flush()
+
+_worker_settings = None
+
+def _init_worker(optionflags, verbosity, kbinterrupt_continue,
+                 term, stderr_term, memory=False, clear_sections=False,
+                 timeout=None, trace_api=False):
+    global _worker_settings
+    _worker_settings = (optionflags, verbosity, kbinterrupt_continue,
+                        term, stderr_term, memory, clear_sections, timeout,
+                        trace_api)
+
+def _run_job(job):
+    """Run the `index`th test of `name` (or, for a section of a text
+    file, the test itself) in a worker process, and return a
+    `(_RecordedOutput, failures, tries)` tuple."""
+    if isinstance(job, DocTest):
+        return _run_test(job)
+    (name, index) = job
+    return _run_test(find(name)[index])
+
+def _run_test(test, clear_globs=True):
+    """Run `test` with a runner that records its output, and return a
+    `(_RecordedOutput, failures, tries)` tuple."""
+    (optionflags, verbosity, kbinterrupt_continue,
+     term, stderr_term, memory, clear_sections, timeout,
+     trace_api) = _worker_settings
+    record = _RecordedOutput()
+    runner = MyDocTestRunner(checker=MyOutputChecker(), verbosity=verbosity,
+                             optionflags=optionflags,
+                             kbinterrupt_continue=kbinterrupt_continue,
+                             term=term, stderr_term=stderr_term,
+                             stderr=record.stream('stderr'), progress=False,
+                             memory=memory, clear_sections=clear_sections,
+                             timeout=timeout, trace_api=trace_api)
+    fails, tries = runner.run(test, COMPILER_FLAGS,
+                              out=record.stream('stdout').write,
+                              clear_globs=clear_globs)
+    record.timings = runner.timings
+    record.api_usage = runner.api_usage
+    return record, fails, tries
+
+def run_parallel(names, optionflags, verbosity, kbinterrupt_continue, jobs,
+                 cache=None, warm_up=None, profile=None,
+                 clear_sections=False, timeout=None, split=False,
+                 replay=False, only=None):
+    """
+    Run the tests of the given names in a pool of `jobs` worker
+    processes (or one per CPU, if `jobs` is 0), and report the results
+    in the same order as `run()` would.  Return a runner whose
+    `failures` & `tries` are the totals over all the tests.
+
+    If `warm_up` is not None, then it is a list of statements to run
+    first; and then each test is run in a child forked from this
+    process (see L{zygote_map}) instead of in a pool.
+
+    If `split` is true, then text files are split into sections (see
+    L{find_sections}, which is also given `replay` and `only`), and
+    each section is sent to a worker as it is (their globals are
+    empty, so they can be pickled).  With `replay`, sections don't
+    depend on each other, so they can all run at once.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    work = []   # [(test, job, cache key)]; job is None if cached.
+    for name in names:
+        try: tests = find(name, split, replay, only)
+        except ValueError as e:
+            print(('%s: Error processing %s -- %s' %
+                                 (sys.argv[0], name, e)), file=sys.stderr)
+            continue
+        for (i, test) in enumerate(tests):
+            key = job = None
+            if cache is not None:
+                key = cache.key(test)
+            if key is None or not cache.lookup(key):
+                if isinstance(tests, list): job = (name, i)
+                else: job = test
+            work.append((test, job, key))
+
+    # Workers use the parent's terminal capabilities, not their own
+    # (their output isn't a terminal).
+    term = TerminalController()
+    stderr_term = TerminalController(sys.__stderr__)
+    runner = MyDocTestRunner(checker=MyOutputChecker(), verbosity=verbosity,
+                             optionflags=optionflags, term=term,
+                             stderr_term=stderr_term)
+    initargs = (optionflags, verbosity, kbinterrupt_continue,
+                term, stderr_term, profile is not None and profile.memory,
+                clear_sections, timeout,
+                profile is not None and profile.trace_api is not None)
+    jobs_to_run = [job for (test, job, key) in work if job is not None]
+    if warm_up is not None:
+        _init_worker(*initargs)
+        if jobs_to_run:
+            run_warm_up(warm_up, verbosity)
+        executor = None
+        results = zygote_map(_run_job, jobs_to_run, jobs or os.cpu_count())
+    else:
+        # Workers are forked (whatever the platform's default), so
+        # that they inherit the corpus cache (see main()).
+        executor = ProcessPoolExecutor(
+            jobs or None, mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker, initargs=initargs)
+        results = executor.map(_run_job, jobs_to_run)
+    try:
+        for (test, job, key) in work:
+            if job is None:
+                runner.report_cached(test)
+            else:
+                (record, fails, tries) = next(results)
+                record.play()
+                if profile is not None:
+                    profile.add(record.timings, record.api_usage)
+                runner.failures += fails
+                runner.tries += tries
+                if key is not None and not fails:
+                    cache.add(key, test)
+            if verbosity == 1:
+                sys.stdout.write('.')
+            sys.stdout.flush(); sys.stderr.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    _finish_cache(cache, verbosity)
+    return runner
+
+###########################################################################
+# Zygote
+###########################################################################
+# Most of the time it takes to check a short test goes on importing nltk
+# and loading corpora.  In zygote mode, the driver does this once (by
+# running a list of warm-up statements), and then forks a child to run
+# each test.  Each child starts with everything the warm-up imported
+# and loaded, but with a fresh copy of it, and fresh globals.
+
+WARM_UP = ['import nltk, re, pprint',
+           'from nltk import word_tokenize']
+"""The default warm-up statements: the imports at the top of each
+   section written by doctest_split.py."""
+
+def run_warm_up(statements, verbosity):
+    """Run the given warm-up statements in a scratch namespace.  A
+    statement that fails is reported, and doesn't stop the others."""
+    namespace = {}
+    start = time.time()
+    for statement in statements:
+        try:
+            exec(compile(statement, '<warm-up>', 'exec', COMPILER_FLAGS, 1),
+                 namespace)
+        except Exception as e:
+            print('%s: Warm-up statement %r failed -- %s' %
+                  (sys.argv[0], statement, e), file=sys.stderr)
+    if verbosity > 0:
+        print('Warmed up in %.2fs' % (time.time() - start), file=sys.stderr)
+
+def zygote_map(func, args, max_children):
+    """
+    Like C{map(func, args)}, except that each call is made in a child
+    forked from this process, with up to `max_children` children running
+    at once.  `func` must return a picklable value.  If a child dies
+    without returning one, then its value is a `_RecordedOutput` that
+    reports the problem, with one failure.
+    """
+    running = [] # [(pid, fd to read the result from, arg)], in order.
+    args = iter(args)
+    while True:
+        while len(running) < max_children:
+            try: arg = next(args)
+            except StopIteration: break
+            running.append(_fork_call(func, arg) + (arg,))
+        if not running: return
+        pid, fd, arg = running.pop(0)
+        yield _child_result(pid, fd, arg)
+
+def _fork_call(func, arg):
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush(); sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read_fd)
+            data = pickle.dumps(func(arg))
+            out = os.fdopen(write_fd, 'wb')
+            out.write(data)
+            out.close()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    return pid, read_fd
+
+def _child_result(pid, fd, arg):
+    f = os.fdopen(fd, 'rb')
+    try: data = f.read()
+    finally: f.close()
+    (pid, status) = os.waitpid(pid, 0)
+    if data:
+        return pickle.loads(data)
+    if os.WIFSIGNALED(status):
+        how = 'was killed by signal %d' % os.WTERMSIG(status)
+    else:
+        how = 'exited with status %d' % os.WEXITSTATUS(status)
+    if isinstance(arg, DocTest): # (a section; see find_sections)
+        running = arg.name
+    else:
+        running = '%s (test %d)' % arg
+    record = _RecordedOutput()
+    record.stream('stderr').write('%s: The child running %s %s\n'
+                                  % (sys.argv[0], running, how))
+    return record, 1, 0
+
+def benchmark_zygote(names, warm_up):
+    """
+    Compare the time it takes to check each of the given names in a
+    process of its own (as running the driver once per file does) with
+    the time it takes to check them all in zygote mode.  Each
+    configuration is run in a separate driver process, with the cache
+    turned off and serially (so the cost per test is comparable).
+    """
+    import subprocess
+    driver = [sys.executable, os.path.abspath(sys.argv[0]),
+              '-q', '--no-cache']
+    warm_up_args = []
+    for statement in warm_up:
+        warm_up_args += ['--warm-up', statement]
+    devnull = open(os.devnull, 'w')
+    def timed(commands):
+        start = time.time()
+        for command in commands:
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+        return time.time() - start
+    t_process = timed([driver + [name] for name in names])
+    t_zygote = timed([driver + ['--zygote'] + warm_up_args + names])
+    devnull.close()
+    n = len(names)
+    print('process per test: %d test(s) in %6.2fs (%.3fs/test)' %
+          (n, t_process, t_process/n))
+    print('zygote:           %d test(s) in %6.2fs (%.3fs/test)' %
+          (n, t_zygote, t_zygote/n))
+    print('speedup:          %.1fx' % (t_process/max(t_zygote, 1e-9)))
+
+###########################################################################
+# Checkpoints
+###########################################################################
+# The sections of a chapter share one set of globals, so a late section
+# can't be checked without running all the sections before it.  With
+# --checkpoints, a file is run a section at a time: each section is run
+# in a child forked from a process that is parked just before that
+# section (a "checkpoint"), and the child then parks itself as the
+# checkpoint before the next section.  Once the file has been run, any
+# section can be re-run (e.g., after fixing one of its examples) by
+# forking from its checkpoint.  Only the sections from the first one
+# that has changed onwards ever need to be run again.
+
+SECTION_RE = re.compile(r"\n(?=-+\n.+\n-+\n)")
+"""The pattern that doctest_split.py uses to split a file into
+   sections: a newline followed by an overlined section title."""
+
+SECTION_PRELUDE = """
+    >>> import nltk, re, pprint
+    >>> from nltk import word_tokenize
+"""
+"""The examples that doctest_split.py puts at the start of each
+   section, so that sections can be checked independently."""
+
+def split_sections(text):
+    """
+    Split `text` into sections, as doctest_split.py does, and return a
+    list of `(lineno, section)` pairs, where `lineno` is the (0-based)
+    line of `text` that the section starts on.
+    """
+    sections = []
+    lineno = 0
+    for section in SECTION_RE.split(text):
+        sections.append((lineno, section))
+        lineno += section.count('\n') + 1 # (+1 for the split newline)
+    return sections
+
+def _park_checkpoint(address, conn, index, globs):
+    """
+    Park this process as the checkpoint before section `index` (whose
+    globals are `globs`).  Each command from the controller (received
+    over `conn`) is a section to run; for each, fork a child that
+    reports the section's results & then parks itself as the next
+    checkpoint.  Return only (by exiting) when the controller hangs up.
+    """
+    # Children that become checkpoints are never waited for.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            (filename, lineno, text) = conn.recv()
+        except EOFError:
+            os._exit(0)
+        sys.stdout.flush(); sys.stderr.flush()
+        if os.fork() == 0:
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            _run_section(address, index, filename, lineno, text, globs)
+
+def _run_section(address, index, filename, lineno, text, globs):
+    from multiprocessing.connection import Client
+    try:
+        conn = Client(address)
+        name = '%s, section %d' % (os.path.basename(filename), index+1)
+        test = MyDocTestParser().get_doctest(text, {}, name,
+                                             filename, lineno)
+        test.globs = globs # (not a copy, so it reaches the next section)
+        conn.send(_run_test(test, clear_globs=False))
+        _park_checkpoint(address, conn, index+1, globs)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(1)
+
+class CheckpointSession:
+    """
+    The controller for a set of checkpoints in one file.  The
+    controller doesn't run any examples itself: `checkpoints[k]` is a
+    connection to the process that is parked before section `k`, and
+    `sections[k]` is the text of section `k` that was run to reach
+    `checkpoints[k+1]`.
+    """
+    def __init__(self, filename, warm_up=None):
+        from multiprocessing.connection import Listener, Client
+        self.filename = filename
+        self.listener = Listener(family='AF_UNIX')
+        self.checkpoints = []
+        self.sections = []
+        sys.stdout.flush(); sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                if warm_up is not None:
+                    run_warm_up(warm_up, 0)
+                address = self.listener.address
+                _park_checkpoint(address, Client(address), 0, {})
+            finally:
+                os._exit(1)
+        self.checkpoints.append(self.listener.accept())
+
+    def invalidate(self, sections):
+        """Discard the checkpoints that were reached by running a
+        section that is not the same in `sections`."""
+        for (k, section) in enumerate(self.sections):
+            if k >= len(sections) or sections[k] != section:
+                self._discard(k+1)
+                break
+
+    def _discard(self, index):
+        for conn in self.checkpoints[index:]:
+            conn.close()
+        del self.checkpoints[index:]
+        del self.sections[max(index-1, 0):]
+
+    def run(self, index, sections):
+        """
+        Run `sections[index]`, starting from the nearest checkpoint
+        before it; any sections between that checkpoint and `index` are
+        run first, to reach `index`'s checkpoint.  Return a list of
+        `(section index, _RecordedOutput, failures, tries)`, for each
+        section that was run.
+        """
+        self.invalidate(sections)
+        return [self._step(k, sections[k])
+                for k in range(min(len(self.checkpoints)-1, index),
+                               index+1)]
+
+    def _step(self, index, section):
+        # Any later checkpoints are replaced by the ones this reaches.
+        self._discard(index+1)
+        self.checkpoints[index].send((self.filename,) + section)
+        conn = self.listener.accept()
+        try:
+            (record, fails, tries) = conn.recv()
+        except EOFError:
+            record = _RecordedOutput()
+            record.stream('stderr').write(
+                '%s: The child running section %d died\n' %
+                (sys.argv[0], index+1))
+            return (index, record, 1, 0)
+        self.checkpoints.append(conn)
+        self.sections.append(section)
+        return (index, record, fails, tries)
+
+    def close(self):
+        self._discard(0)
+        self.listener.close()
+        os.waitpid(self.pid, 0)
+
+def run_checkpointed(filename, section, optionflags, verbosity,
+                     kbinterrupt_continue, warm_up=None, timeout=None):
+    """
+    Check the given file a section at a time, parking a checkpoint
+    before each section; and then prompt for sections to re-run.  If
+    `section` is given, then only that section (numbered from 1, as
+    doctest_split.py numbers them) is reported; earlier sections are
+    run to reach it, but only their failure counts are reported.
+    """
+    term = TerminalController()
+    stderr_term = TerminalController(sys.__stderr__)
+    _init_worker(optionflags, verbosity, kbinterrupt_continue,
+                 term, stderr_term, timeout=timeout)
+    session = CheckpointSession(filename, warm_up)
+    try:
+        sections = _read_sections(filename)
+        if section is None:
+            for k in range(len(sections)):
+                _report_sections(session.run(k, sections), k, verbosity)
+            section = len(sections)
+        else:
+            if not 1 <= section <= len(sections):
+                raise ValueError('%s has %d sections' %
+                                 (filename, len(sections)))
+            _report_sections(session.run(section-1, sections),
+                             section-1, verbosity)
+        while True:
+            sys.stdout.write('Section to run [%d], "all" or "quit": '
+                             % section)
+            sys.stdout.flush()
+            answer = sys.stdin.readline()
+            if not answer or answer.strip() in ('q', 'quit'):
+                break
+            sections = _read_sections(filename)
+            if answer.strip() == 'all':
+                for k in range(len(sections)):
+                    _report_sections(session.run(k, sections), k, verbosity)
+                continue
+            if answer.strip():
+                try: section = int(answer)
+                except ValueError: continue
+            if 1 <= section <= len(sections):
+                _report_sections(session.run(section-1, sections),
+                                 section-1, verbosity)
+            else:
+                print('%s has %d sections' % (filename, len(sections)))
+    finally:
+        session.close()
+
+def _read_sections(filename):
+    return split_sections(codecs.open(filename, encoding="utf-8").read())
+
+def _report_sections(results, index, verbosity):
+    """Report the results of running a section, and the failure count
+    of the sections that were run to reach it."""
+    replayed = [r for r in results if r[0] != index]
+    if replayed and verbosity > 0:
+        first, last = replayed[0][0]+1, replayed[-1][0]+1
+        if first == last: ran = 'section %d' % first
+        else: ran = 'sections %d-%d' % (first, last)
+        print('Ran %s to reach section %d: %d failure(s)' %
+              (ran, index+1, sum(r[2] for r in replayed)), file=sys.stderr)
+    for (k, record, fails, tries) in results:
+        if k == index:
+            record.play()
+
+def debug(names, optionflags, verbosity, pm=True, start_at=None):
+    debugger = Debugger(optionflags=optionflags, start_at=start_at)
     for name in names:
         try:
             for test in find(name):
@@ -841,8 +2323,10 @@ def debug(names, optionflags, verbosity, pm=True):
             print(('%s: Error processing %s -- %s' %
                                  (sys.argv[0], name, e)), file=sys.stderr)
 
-def update(names, optionflags, verbosity):
-    runner = UpdateRunner(verbose=True)
+def update(names, optionflags, verbosity, jobs=1, patch=None, yes=False):
+    if patch is not None or yes or jobs != 1:
+        return update_batch(names, optionflags, verbosity, jobs, patch, yes)
+    runner = UpdateRunner(verbose=True, optionflags=optionflags)
     for name in names:
         try:
             # Make sure we're running on a text file.
@@ -880,6 +2364,89 @@ def update(names, optionflags, verbosity):
             print(('%s: Error processing %s -- %s' %
                                  (sys.argv[0], name, e)), file=sys.stderr)
 
+def update_batch(names, optionflags, verbosity, jobs=1, patch=None,
+                 yes=False):
+    """
+    Run the updater over the given text files (in `jobs` worker
+    processes, or one per CPU if `jobs` is 0), without asking for
+    confirmation.  The proposed changes are written as a unified diff
+    to the file `patch` (or to stdout, if `patch` is None or C{'-'}).
+    If `yes` is true, then the changes are also written back to the
+    files.  (If a patch file was written, then it's the record of the
+    changes; otherwise, each original is kept with a C{.bak} suffix.)
+    """
+    work = [(name, optionflags, verbosity > 1) for name in names]
+    executor = None
+    if jobs == 1:
+        results = map(_update_file, work)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        executor = ProcessPoolExecutor(
+            jobs or None, mp_context=multiprocessing.get_context('fork'))
+        results = executor.map(_update_file, work)
+    diff = []
+    changed = [] # [(filename, new contents)]
+    updates = 0
+    try:
+        for (filename, old, new, failures, report) in results:
+            sys.stderr.write(report)
+            if failures and new != old:
+                diff += _unified_diff(old, new, os.path.relpath(filename))
+                changed.append((filename, new))
+                updates += failures
+    finally:
+        if executor is not None: executor.shutdown()
+
+    if patch is None or patch == '-':
+        sys.stdout.write(''.join(diff))
+    else:
+        out = codecs.open(patch, 'w', encoding='utf-8')
+        out.write(''.join(diff))
+        out.close()
+    print('%d example(s) updated in %d file(s)' % (updates, len(changed)),
+          file=sys.stderr)
+    if not yes:
+        return
+    for (filename, new) in changed:
+        if patch is None or patch == '-':
+            os.rename(filename, filename+'.bak')
+        print('Writing updated version to %s' % filename, file=sys.stderr)
+        out = codecs.open(filename, 'w', encoding='utf-8')
+        out.write(new)
+        out.close()
+
+def _update_file(job):
+    """Run the updater over a text file (in a worker process), and
+    return C{(filename, old contents, new contents, updates, report)}."""
+    (name, optionflags, verbose) = job
+    report = StringIO()
+    try:
+        tests = find(name)
+        if len(tests) != 1 or tests[0].lineno != 0:
+            raise ValueError('update can only be used with text files')
+    except ValueError as e:
+        report.write('%s: Error processing %s -- %s\n' %
+                     (sys.argv[0], name, e))
+        return (name, None, None, 0, report.getvalue())
+    test = tests[0]
+    old = test.docstring
+    runner = UpdateRunner(verbose=verbose, optionflags=optionflags)
+    (failures, tries) = runner.run(test, COMPILER_FLAGS, out=report.write)
+    return (test.filename, old, test.docstring, failures, report.getvalue())
+
+def _unified_diff(old, new, path):
+    """Return the lines of a unified diff between two versions of the
+    file at `path` (as C{patch -p1} expects)."""
+    lines = []
+    for line in difflib.unified_diff(old.splitlines(True),
+                                     new.splitlines(True),
+                                     'a/'+path, 'b/'+path):
+        if not line.endswith('\n'):
+            line += '\n\\ No newline at end of file\n'
+        lines.append(line)
+    return lines
+
 ######################################################################
 ## Terminal Controler
 ## Ruthlessly stolen from epydoc:
@@ -1007,7 +2574,21 @@ UPDATE_OPT   = Option("--update", "-u",
                     "be asked to verify the changes before they are "
                     "written back to the file; be sure to check them over "
                     "carefully, to ensure that you don't accidentally "
-                    "create broken test cases.")
+                    "create broken test cases.  (With --patch, --yes "
+                    "or --jobs, the files are updated in a batch, "
+                    "without asking: see --patch.)")
+
+PATCH_OPT    = Option("--patch",
+               action="store", dest="patch", metavar="FILE",
+               help="With --update, don't ask about each file: write the "
+                    "proposed changes to all the files to FILE, as a "
+                    "unified diff (use 'patch -p1' to apply it).  Without "
+                    "--patch, a batch update writes its diff to stdout.")
+
+YES_OPT      = Option("--yes", "-y",
+               action="store_true", dest="yes", default=False,
+               help="With --update, write the proposed changes back to "
+                    "the files without asking.")
 
 DEBUG_OPT    = Option("--debug",
                action="store_const", dest="action", const="debug",
@@ -1015,6 +2596,12 @@ DEBUG_OPT    = Option("--debug",
                     "given files.  If any example fails, then enter the "
                     "python debugger.")
 
+START_AT_OPT = Option("--start-at",
+               action="store", type="int", dest="start_at", metavar="LINE",
+               help="With --debug, run the examples before the one on "
+                    "line LINE silently, without checking their output; "
+                    "and start debugging at that example.")
+
 # Reporting options
 VERBOSE_OPT  = Option("-v", "--verbose",
                action="count", dest="verbosity", default=1,
@@ -1041,6 +2628,118 @@ CONTINUE_OPT = Option("--continue", dest='kbinterrupt_continue',
                       help="If a test is interrupted by a keyboard "
                       "interrupt, then report the interrupt and continue")
 
+# Execution options
+JOBS_OPT     = Option("--jobs", "-j",
+               action="store", type="int", dest="jobs", default=1,
+               help="Run the tests (files, or docstrings of modules) in "
+                    "JOBS worker processes; 0 means one per CPU.  Failures "
+                    "are reported in the same order as for a serial run.")
+
+CORPUS_CACHE_OPT = Option("--corpus-cache",
+               action="store", dest="corpus_cache", metavar="DIR",
+               help="Cache the results of nltk corpus reader calls (such "
+                    "as brown.words()) in DIR, and use them on later runs "
+                    "while the corpus files are unchanged.  (See "
+                    "corpus_cache.py.)")
+
+TIMEOUT_OPT  = Option("--timeout",
+               action="store", type="float", dest="timeout", metavar="SECONDS",
+               help="Stop any example that runs for longer than SECONDS, "
+                    "report it as a failure, and skip the rest of its test.  "
+                    "(An example's \"# doctest: +TIMEOUT(n)\" directive "
+                    "overrides this.)")
+
+NO_CACHE_OPT = Option("--no-cache",
+               action="store_false", dest="use_cache", default=True,
+               help="Run every test, even if it passed on an earlier run "
+                    "(the results of passing tests in text files are "
+                    "recorded in %s, and tests whose examples and "
+                    "environment, including nltk's source, haven't "
+                    "changed are not run again)." % CACHE_FILE)
+
+ZYGOTE_OPT   = Option("--zygote",
+               action="store_true", dest="zygote", default=False,
+               help="Run the warm-up statements (see --warm-up) once, and "
+                    "then fork a child to run each test, so that tests "
+                    "don't each pay for importing nltk and loading "
+                    "corpora.  Up to JOBS children are run at once.")
+
+WARM_UP_OPT  = Option("--warm-up",
+               action="append", dest="warm_up", metavar="STATEMENT",
+               help="A statement to run before forking the children in "
+                    "--zygote mode (may be repeated).  The default is: %s."
+                    % '; '.join(WARM_UP))
+
+BENCHMARK_ZYGOTE_OPT = Option("--benchmark-zygote",
+               action="store_true", dest="benchmark_zygote", default=False,
+               help="Time checking each file in a process of its own, "
+                    "and checking them all in --zygote mode.")
+
+CHECKPOINTS_OPT = Option("--checkpoints",
+               action="store_true", dest="checkpoints", default=False,
+               help="Check a single file a section at a time (splitting it "
+                    "as doctest_split.py does), keeping a forked "
+                    "checkpoint of the globals before each section; and "
+                    "then prompt for sections to re-run.  A section is "
+                    "re-run from its checkpoint, after re-reading the file.")
+
+SECTION_OPT  = Option("--section",
+               action="store", type="int", dest="section", metavar="N",
+               help="With --checkpoints, only report section N (the "
+                    "sections before it are run, but not reported).  "
+                    "With --split-sections, only check section N.")
+
+REPLAY_OPT   = Option("--replay",
+               action="store_true", dest="replay", default=False,
+               help="With --split-sections, start each section by "
+                    "re-running (without checking) just the examples of "
+                    "earlier sections that define the names it uses, as "
+                    "found by analysing the examples' source.")
+
+SPLIT_SECTIONS_OPT = Option("--split-sections",
+               action="store_true", dest="split", default=False,
+               help="Check each section of a text file separately, as if "
+                    "it had been split by doctest_split.py (starting each "
+                    "section with its imports); but report failures "
+                    "against the lines of the original file.")
+
+# Profiling options
+PROFILE_OPT  = Option("--profile",
+               action="store", dest="profile", metavar="FILE",
+               help="Write the wall & CPU time taken by each example, and "
+                    "its file & line, to FILE as JSON lines.")
+
+SLOWEST_OPT  = Option("--slowest",
+               action="store", type="int", dest="slowest", default=0,
+               metavar="N",
+               help="List the N slowest examples at the end of the run.")
+
+MEMORY_OPT   = Option("--memory",
+               action="store_true", dest="memory", default=False,
+               help="Record the memory allocated & retained by each "
+                    "example (with tracemalloc), and list the examples "
+                    "that allocate the most & the sections that retain "
+                    "the most.")
+
+TRACE_API_OPT = Option("--trace-api",
+               action="store", dest="trace_api", metavar="FILE",
+               help="Count the calls to each nltk function made by each "
+                    "chapter's examples, and the time spent in them; and "
+                    "write the counts to FILE as JSON.  (Uses "
+                    "sys.monitoring on Python 3.12+, which makes the "
+                    "overhead low; or sys.setprofile.)")
+
+CLEAR_SECTIONS_OPT = Option("--clear-sections",
+               action="store_true", dest="clear_sections", default=False,
+               help="Clear a test's globals (except modules, functions "
+                    "and classes) at the start of each of its sections.")
+
+TIME_BUDGET_OPT = Option("--time-budget",
+               action="store", type="float", dest="time_budget",
+               metavar="SECONDS",
+               help="Fail the run (with exit status 1) if any example "
+                    "takes longer than SECONDS (wall time).")
+
 # Output Comparison options
 IGNORE_EXCEPTION_DETAIL_OPT = Option("--ignore_exception_detail",
                action="store_const", dest="ignore_exception_detail", const=1, default=0,
@@ -1061,7 +2760,8 @@ def main():
                                      "version %s" % __version__)
 
     action_group = OptionGroup(optparser, 'Actions (default=check)')
-    action_group.add_options([CHECK_OPT, UPDATE_OPT, DEBUG_OPT])
+    action_group.add_options([CHECK_OPT, UPDATE_OPT, PATCH_OPT, YES_OPT,
+                              DEBUG_OPT, START_AT_OPT])
     optparser.add_option_group(action_group)
 
     reporting_group = OptionGroup(optparser, 'Reporting')
@@ -1070,6 +2770,20 @@ def main():
                                  CONTINUE_OPT])
     optparser.add_option_group(reporting_group)
 
+    execution_group = OptionGroup(optparser, 'Execution')
+    execution_group.add_options([JOBS_OPT, TIMEOUT_OPT, NO_CACHE_OPT,
+                                 CORPUS_CACHE_OPT, ZYGOTE_OPT, WARM_UP_OPT,
+                                 BENCHMARK_ZYGOTE_OPT,
+                                 SPLIT_SECTIONS_OPT, REPLAY_OPT,
+                                 CHECKPOINTS_OPT, SECTION_OPT])
+    optparser.add_option_group(execution_group)
+
+    profiling_group = OptionGroup(optparser, 'Profiling')
+    profiling_group.add_options([PROFILE_OPT, SLOWEST_OPT, TIME_BUDGET_OPT,
+                                 MEMORY_OPT, CLEAR_SECTIONS_OPT,
+                                 TRACE_API_OPT])
+    optparser.add_option_group(profiling_group)
+
     compare_group = OptionGroup(optparser, 'Output Comparison')
     compare_group.add_options([IGNORE_EXCEPTION_DETAIL_OPT, ELLIPSIS_OPT, NORMWS_OPT])
     optparser.add_option_group(compare_group)
@@ -1085,15 +2799,76 @@ def main():
                    optionvals.normws * NORMALIZE_WHITESPACE)
 
 
+    warm_up = None
+    if optionvals.zygote or optionvals.benchmark_zygote:
+        if not hasattr(os, 'fork'):
+            optparser.error('--zygote needs os.fork()')
+        warm_up = optionvals.warm_up or WARM_UP
+
+    if optionvals.checkpoints:
+        if not hasattr(os, 'fork'):
+            optparser.error('--checkpoints needs os.fork()')
+        if len(names) != 1 or optionvals.action != 'check':
+            optparser.error('--checkpoints checks a single file')
+    elif optionvals.section is not None and not optionvals.split:
+        optparser.error('--section can only be used with --checkpoints '
+                        'or --split-sections')
+    if optionvals.replay and not optionvals.split:
+        optparser.error('--replay can only be used with --split-sections')
+    if ((optionvals.patch is not None or optionvals.yes) and
+        optionvals.action != 'update'):
+        optparser.error('--patch and --yes can only be used with --update')
+    if optionvals.start_at is not None and optionvals.action != 'debug':
+        optparser.error('--start-at can only be used with --debug')
+
+    # Worker processes are forked (see run_parallel & update), so they
+    # inherit the corpus cache.
+    if optionvals.corpus_cache:
+        try:
+            import corpus_cache
+            corpus_cache.install(optionvals.corpus_cache)
+        except (ImportError, OSError) as e:
+            print('%s: Corpus cache disabled -- %s' % (sys.argv[0], e),
+                  file=sys.stderr)
+
     # Perform the requested action.
-    if optionvals.action == 'check':
-        run(names, optionflags, optionvals.verbosity,
-            optionvals.kbinterrupt_continue)
-    elif optionvals.action == 'update':
-        update(names, optionflags, optionvals.verbosity)
-    elif optionvals.action == 'debug':
-        debug(names, optionflags, optionvals.verbosity)
-    else:
-        optparser.error('INTERNAL ERROR: Bad action %s' % optionvals.action)
+    try:
+        if optionvals.benchmark_zygote:
+            benchmark_zygote(names, warm_up)
+        elif optionvals.checkpoints:
+            run_checkpointed(names[0], optionvals.section, optionflags,
+                             optionvals.verbosity,
+                             optionvals.kbinterrupt_continue, warm_up,
+                             optionvals.timeout)
+        elif optionvals.action == 'check':
+            cache = profile = None
+            if optionvals.use_cache:
+                cache = ResultCache(optionflags, optionvals.timeout)
+            if (optionvals.profile or optionvals.slowest or
+                optionvals.memory or optionvals.trace_api or
+                optionvals.time_budget is not None):
+                profile = ExampleProfile(optionvals.profile,
+                                         optionvals.slowest,
+                                         optionvals.time_budget,
+                                         optionvals.memory,
+                                         optionvals.trace_api)
+            run(names, optionflags, optionvals.verbosity,
+                optionvals.kbinterrupt_continue, optionvals.jobs, cache,
+                warm_up, profile, optionvals.clear_sections,
+                optionvals.timeout, optionvals.split, optionvals.replay,
+                optionvals.section)
+            if profile is not None and profile.finish():
+                sys.exit(1)
+        elif optionvals.action == 'update':
+            update(names, optionflags, optionvals.verbosity,
+                   optionvals.jobs, optionvals.patch, optionvals.yes)
+        elif optionvals.action == 'debug':
+            debug(names, optionflags, optionvals.verbosity,
+                  start_at=optionvals.start_at)
+        else:
+            optparser.error('INTERNAL ERROR: Bad action %s' %
+                            optionvals.action)
+    finally:
+        PARSE_CACHE.save()
 
 if __name__ == '__main__': main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+# Natural Language Toolkit: text escaping for the book writers
+#
+# Copyright (C) 2001-2012 NLTK Project
+# URL: <http://www.nltk.org/>
+# For license information, see LICENSE.TXT
+
+"""
+Escaping functions shared by the DocBook, HTML and LaTeX writers.
+The escapers use whichever of `str.replace` and `str.translate` (with
+a table built once, at import time) is fastest on the book's text:
+most text nodes contain no XML special characters, so guarded
+replaces win there; but the LaTeX and entity escapers have too many
+special characters, so they use a translation table.
+
+Run this module as a script to benchmark the escapers against the
+text of the book::
+
+    python escaping.py book/ch01.rst book/ch02.rst ...
+"""
+
+import re, html.entities
+
+######################################################################
+#{ Translation tables
+######################################################################
+
+XML_ESCAPES = [('&', '&amp;'), ('<', '&lt;'), ('"', '&quot;'), ('>', '&gt;')]
+"""Characters that must be escaped in XML text (`&` must come first)."""
+
+HTML_ESCAPES = XML_ESCAPES + [('@', '&#64;')]
+"""Characters that must be escaped in HTML text.  (`@` is escaped to
+   make email addresses harder to harvest, as docutils does.)"""
+
+ENTITY_TABLE = dict((codepoint, '&%s;' % name) for (codepoint, name)
+                    in html.entities.codepoint2name.items())
+"""Every character that has a named HTML entity, mapped to that
+   entity (e.g. `\\xe9` -> `&eacute;`)."""
+
+LATEX_TABLE = {ord('\\'): '\\textbackslash{}', ord('{'): '\\{',
+               ord('}'): '\\}', ord('#'): '\\#', ord('$'): '\\$',
+               ord('%'): '\\%', ord('&'): '\\&',
+               ord('~'): '\\textasciitilde{}', ord('_'): '\\_',
+               ord('^'): '\\textasciicircum{}',
+               ord('"'): '\\textquotedbl{}', ord('['): '{[}',
+               ord(']'): '{]}', 0xad: '\\-'}
+"""Characters with a special meaning in LaTeX, mapped to escaped
+   equivalents (the same escapes used by the docutils LaTeX writer)."""
+
+LATEX_LIGATURE_CHARS = '-'
+LATEX_LITERAL_LIGATURE_CHARS = '-,`\'"<>'
+"""Characters that form input ligatures when doubled (e.g. ``--``) in
+   normal text & in monospace (literal) text respectively."""
+
+######################################################################
+#{ Escapers
+######################################################################
+
+def escape_xml(text):
+    """Escape XML special characters in `text`."""
+    for (char, escape) in XML_ESCAPES:
+        if char in text:
+            text = text.replace(char, escape)
+    return text
+
+def escape_html(text):
+    """Escape HTML special characters in `text`."""
+    for (char, escape) in HTML_ESCAPES:
+        if char in text:
+            text = text.replace(char, escape)
+    return text
+
+def escape_nonascii(text):
+    """Replace each non-ASCII character in `text` with a numeric
+    character reference (for XML attribute values)."""
+    return text.encode('ascii', 'xmlcharrefreplace').decode('ascii')
+
+def escape_entities(text):
+    """Replace every character in `text` that has a named HTML entity
+    with that entity (including `&`, `<`, `>` and `"`)."""
+    return text.translate(ENTITY_TABLE)
+
+def escape_latex(text, literal=False):
+    """
+    Escape LaTeX special characters in `text`, and break up doubled
+    characters that would otherwise form ligatures.  If `literal` is
+    true, then `text` will be typeset in a monospace font: more
+    ligatures are broken up, and runs of spaces are preserved.
+    """
+    text = text.translate(LATEX_TABLE)
+    if literal:
+        separate_chars = LATEX_LITERAL_LIGATURE_CHARS
+    else:
+        separate_chars = LATEX_LIGATURE_CHARS
+    # Do it twice, because otherwise '---' would become '-{}--'.
+    for char in separate_chars * 2:
+        if char+char in text:
+            text = text.replace(char+char, char+'{}'+char)
+    if literal:
+        text = text.replace('  ', ' ~')
+    return text
+
+######################################################################
+#{ Callouts
+######################################################################
+
+CALLOUT_MARKER_RE = re.compile(r'# *\[_([\w-]+)\]')
+"""A callout marker in a doctest block (e.g. ``# [_foo]``); the group
+   is the callout name."""
+
+def replace_callouts(text, names, replacement):
+    """
+    Replace each callout marker in `text` whose name is in `names` with
+    ``replacement % name``.  Markers for other names are left alone.
+    """
+    if not names or '[_' not in text: return text
+    def repl(m):
+        if m.group(1) in names: return replacement % m.group(1)
+        else: return m.group()
+    return CALLOUT_MARKER_RE.sub(repl, text)
+
+######################################################################
+#{ Benchmarks
+######################################################################
+
+def _old_escape_xml(text):
+    text = text.replace("&", "&amp;")
+    text = text.replace("<", "&lt;")
+    text = text.replace('"', "&quot;")
+    text = text.replace(">", "&gt;")
+    return text
+
+def _old_escape_nonascii(text):
+    buff = []
+    for c in text:
+        if ord(c) >= 128:
+            buff.append('&#%d;' % ord(c))
+        else:
+            buff.append(c)
+    return ''.join(buff)
+
+def _old_escape_entities(text):
+    def replace_html_entity(c):
+        try:
+            return str("&%s;" % html.entities.codepoint2name[ord(c)])
+        except KeyError:
+            return c
+    return ''.join(map(replace_html_entity, text))
+
+def _old_replace_callouts(text, names, replacement):
+    for name in names:
+        text = re.sub("# *\\[_%s\\]" % name, replacement % name, text)
+    return text
+
+def _book_text(filenames):
+    """Return a list of the text nodes and a list of the doctest
+    blocks in the given rst files."""
+    import docutils.core, docutils.nodes, docutils.io
+    try:
+        import rst
+        reader = rst.CustomizedReader()
+    except Exception:
+        reader = None # (unknown directives just become errors.)
+    texts, blocks = [], []
+    for filename in filenames:
+        doctree = docutils.core.publish_doctree(
+            source=None, source_path=filename,
+            source_class=docutils.io.FileInput, reader=reader,
+            settings_overrides={'report_level': 5, 'halt_level': 5})
+        for node in doctree.findall(docutils.nodes.Text):
+            if isinstance(node.parent, docutils.nodes.doctest_block):
+                blocks.append(str(node))
+            else:
+                texts.append(str(node))
+    return texts, blocks
+
+def _docutils_latex_encoders():
+    """Return the docutils LaTeX writer's encode method, for normal &
+    for literal text."""
+    import docutils.utils, docutils.frontend
+    from docutils.writers.latex2e import Writer, LaTeXTranslator
+    settings = docutils.frontend.get_default_settings(Writer)
+    settings.font_encoding = 'C10,T1'
+    normal = LaTeXTranslator(docutils.utils.new_document('', settings))
+    literal = LaTeXTranslator(docutils.utils.new_document('', settings))
+    literal.literal = True
+    return normal.encode, literal.encode
+
+def benchmark(filenames, repeat=5):
+    import timeit
+    texts, blocks = _book_text(filenames)
+    print('%d text nodes (%d chars); %d doctest blocks (%d chars)' % (
+        len(texts), sum(map(len, texts)), len(blocks),
+        sum(map(len, blocks))))
+    # The LaTeX escaper is only used for ASCII text (see rst.py).
+    ascii_texts = [t for t in texts if t.isascii()]
+    latex, latex_literal = _docutils_latex_encoders()
+    callout_names = [set(CALLOUT_MARKER_RE.findall(b)) for b in blocks]
+    co = '<co id="ref-%s"/>'
+    cases = [
+        ('xml', texts, _old_escape_xml, escape_xml),
+        ('nonascii', texts, _old_escape_nonascii, escape_nonascii),
+        ('entities', blocks, _old_escape_entities, escape_entities),
+        ('latex', ascii_texts, latex, escape_latex),
+        ('latex-lit', ascii_texts, latex_literal,
+         lambda t: escape_latex(t, True)),
+        ('callouts', list(zip(blocks, callout_names)),
+         lambda b_n: _old_replace_callouts(b_n[0], b_n[1], co),
+         lambda b_n: replace_callouts(b_n[0], b_n[1], co)),
+        ]
+    for (name, data, old, new) in cases:
+        assert [old(t) for t in data] == [new(t) for t in data], name
+        t_old = min(timeit.repeat(lambda: [old(t) for t in data],
+                                  number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: [new(t) for t in data],
+                                  number=1, repeat=repeat))
+        print('%-10s old %8.2fms  new %8.2fms  (%.1fx)' % (
+            name, t_old*1000, t_new*1000, t_old/max(t_new, 1e-9)))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s FILE.rst...' % sys.argv[0])
+    benchmark(sys.argv[1:])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Natural Language Toolkit: image size cache for the book writers
+#
+# Copyright (C) 2001-2012 NLTK Project
+# URL: <http://www.nltk.org/>
+# For license information, see LICENSE.TXT
+
+"""
+Read the dimensions of PNG, JPEG, GIF and PDF images from their
+headers, without decoding the images; and remember the results in a
+cache file, keyed by path, modification time and size.  This is
+used by the HTML, LaTeX and DocBook writers whenever they need to
+know how big an image is (e.g., to scale it).  Usage::
+
+    info = image_info('../images/chart_intro1.png')
+    print(info.width, info.height, info.dpi)
+
+Bitmap dimensions are in pixels; PDF dimensions are in points (the
+size of the first page's MediaBox).  `dpi` is the resolution recorded
+in the image, or None if it does not record one.
+"""
+
+import os, re, pickle, struct, atexit
+
+CACHE_FILE = 'imageinfo.cache'
+"""The file that image information is saved to (in the current
+   directory, i.e. next to the .ref files)."""
+
+PDF_SCAN_LIMIT = 1<<20
+"""How far into a PDF file to look for the first page's MediaBox."""
+
+class ImageInfo:
+    def __init__(self, format, width, height, dpi=None):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+    def __repr__(self):
+        return '<ImageInfo %s %sx%s>' % (self.format, self.width, self.height)
+
+    def natural_size(self):
+        """The image's size in points, as pdflatex would render it
+        (assuming 72 dpi for bitmaps with no recorded resolution)."""
+        if self.format == 'pdf':
+            return self.width, self.height
+        dpi = self.dpi or 72.0
+        return self.width*72.0/dpi, self.height*72.0/dpi
+
+######################################################################
+#{ Header readers
+######################################################################
+
+def read_image_info(path):
+    """
+    Return an `ImageInfo` for the image file at `path`, reading as
+    little of the file as possible.  Raise `IOError` if the file can't
+    be read, and `ValueError` if its format isn't recognized.
+    """
+    f = open(path, 'rb')
+    try:
+        head = f.read(32)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return _read_png(f, head)
+        elif head[:2] == b'\xff\xd8':
+            return _read_jpeg(f)
+        elif head[:6] in (b'GIF87a', b'GIF89a'):
+            width, height = struct.unpack('<HH', head[6:10])
+            return ImageInfo('gif', width, height)
+        elif head[:5] == b'%PDF-':
+            return _read_pdf(f)
+        else:
+            raise ValueError('%s: unknown image format' % path)
+    finally:
+        f.close()
+
+def _read_png(f, head):
+    # The IHDR chunk always comes first.
+    width, height = struct.unpack('>II', head[16:24])
+    dpi = None
+    # Look for a pHYs chunk, which must come before the image data.
+    f.seek(8)
+    while True:
+        chunk_head = f.read(8)
+        if len(chunk_head) < 8: break
+        length, typ = struct.unpack('>I4s', chunk_head)
+        if typ in (b'IDAT', b'IEND'): break
+        if typ == b'pHYs':
+            xppu, yppu, unit = struct.unpack('>IIB', f.read(9))
+            if unit == 1 and xppu: # pixels per metre
+                dpi = xppu * 0.0254
+            break
+        f.seek(length+4, 1) # skip chunk data & crc
+    return ImageInfo('png', width, height, dpi)
+
+def _read_jpeg(f):
+    f.seek(2)
+    dpi = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            raise ValueError('bad jpeg marker')
+        code = marker[1]
+        if code == 0xff: # padding
+            f.seek(-1, 1)
+            continue
+        length, = struct.unpack('>H', f.read(2))
+        if code == 0xe0: # APP0 (JFIF): may record a resolution
+            data = f.read(length-2)
+            if data[:5] == b'JFIF\0' and len(data) >= 12:
+                units, xdensity = struct.unpack('>BH', data[7:10])
+                if units == 1 and xdensity: dpi = float(xdensity)
+                elif units == 2 and xdensity: dpi = xdensity * 2.54
+        elif 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            # A start-of-frame marker: precision, height, width.
+            height, width = struct.unpack('>xHH', f.read(5))
+            return ImageInfo('jpeg', width, height, dpi)
+        else:
+            f.seek(length-2, 1)
+
+_MEDIABOX_RE = re.compile(
+    br'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]')
+
+def _read_pdf(f):
+    # Scan forwards a block at a time, keeping a little overlap in case
+    # the MediaBox straddles a block boundary.
+    f.seek(0)
+    data = b''
+    scanned = 0
+    while scanned < PDF_SCAN_LIMIT:
+        block = f.read(1<<14)
+        if not block: break
+        scanned += len(block)
+        data = data[-64:] + block
+        m = _MEDIABOX_RE.search(data)
+        if m:
+            x0, y0, x1, y1 = [float(v) for v in m.groups()]
+            return ImageInfo('pdf', abs(x1-x0), abs(y1-y0))
+    raise ValueError('no MediaBox found in pdf')
+
+######################################################################
+#{ Cache
+######################################################################
+
+class ImageInfoCache:
+    """
+    A persistent mapping from image paths to `ImageInfo`s.  An entry is
+    only used if the file's modification time and size are unchanged.
+    The cache is saved when the process exits, if it was modified.
+    """
+    def __init__(self, filename=CACHE_FILE):
+        self.filename = filename
+        self._entries = None # path -> (mtime, size, info)
+        self._dirty = False
+
+    def _load(self):
+        self._entries = {}
+        if os.path.exists(self.filename):
+            try:
+                f = open(self.filename, 'rb')
+                try: self._entries = pickle.load(f)
+                finally: f.close()
+            except Exception:
+                pass # a stale or corrupt cache is just discarded.
+        atexit.register(self.save)
+
+    def get(self, path):
+        if self._entries is None: self._load()
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry[:2] == (st.st_mtime, st.st_size):
+            return entry[2]
+        info = read_image_info(path)
+        self._entries[key] = (st.st_mtime, st.st_size, info)
+        self._dirty = True
+        return info
+
+    def save(self):
+        if not self._dirty: return
+        try:
+            f = open(self.filename, 'wb')
+            try: pickle.dump(self._entries, f)
+            finally: f.close()
+            self._dirty = False
+        except IOError:
+            pass # don't fail a build because the cache can't be written.
+
+_cache = ImageInfoCache()
+
+def image_info(path):
+    """Return the (cached) `ImageInfo` for the image file at `path`."""
+    return _cache.get(path)
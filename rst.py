@@ -37,15 +37,20 @@ import operator, numbers, collections
 operator.isNumberType = lambda x:isinstance(x, numbers.Number)
 operator.isSequenceType = lambda x:isinstance(x, collections.Sequence)
 
-import re, os.path, textwrap, sys, pickle
+import re, os.path, textwrap, sys, pickle, tempfile, json, shlex
+import time, hashlib, subprocess, concurrent.futures
 from optparse import OptionParser
 from tree2image import tree_to_image
+from imageinfo import image_info
+from escaping import escape_html, escape_latex
 
-import docutils.core, docutils.nodes, docutils.io
+import docutils.core, docutils.nodes, docutils.io, docutils.utils
+from docutils import languages
 from docutils.writers import Writer
 from docutils.writers.html4css1 import HTMLTranslator, Writer as HTMLWriter
 from docutils.writers.latex2e import LaTeXTranslator, Writer as LaTeXWriter
 from docutils.parsers.rst import directives, roles
+from docutils.parsers.rst.directives.images import Image, Figure
 from docutils.readers.standalone import Reader as StandaloneReader
 from docutils.transforms import Transform
 import docutils.writers.html4css1
@@ -53,6 +58,8 @@ from doctest import DocTestParser
 import docutils.statemachine
 try: import PIL.Image
 except: pass
+try: import resource
+except: resource = None
 
 LATEX_VALIGN_IS_BROKEN = True
 """Set to true to compensate for a bug in the latex writer.  I've
@@ -188,6 +195,37 @@ def doctest_directive(name, arguments, options, content, lineno,
 doctest_directive.content = True
 directives.register_directive('doctest-ignore', doctest_directive)
 
+SCALE_FORMATS = {'html': 0, 'ref': 0, 'latex': 1, 'docbook': 2}
+"""For per-format scale options (``:scale: html:latex:docbook``), a
+   dictionary mapping each output format to the index of its scale."""
+
+def format_scale_option(converter):
+    """
+    Return an option converter for ``:scale:`` options that accepts
+    either a single scale, or one scale per output format, separated
+    by colons (see L{SCALE_FORMATS}).  E.g.::
+
+        .. image:: ../images/tally.png
+           :scale: 50:80:60
+
+    The scale for the current L{OUTPUT_FORMAT} is checked & converted
+    using C{converter}.
+    """
+    def scale_option(argument):
+        if argument and ':' in argument:
+            scales = argument.split(':')
+            if len(scales) != len(set(SCALE_FORMATS.values())):
+                raise ValueError('expected one scale per output format '
+                                 '(html:latex:docbook); got %r' % argument)
+            argument = scales[SCALE_FORMATS.get(OUTPUT_FORMAT, 0)]
+        return converter(argument)
+    return scale_option
+
+# Allow per-format scales for the builtin image & figure directives.
+for _directive in (Image, Figure):
+    _directive.option_spec = dict(_directive.option_spec, scale=
+        format_scale_option(_directive.option_spec['scale']))
+
 _treenum = 0
 def tree_directive(name, arguments, options, content, lineno,
                    content_offset, block_text, state, state_machine):
@@ -231,9 +269,13 @@ def tree_directive(name, arguments, options, content, lineno,
 
 tree_directive.arguments = (1,0,1)
 tree_directive.content = True
-tree_directive.options = {'scale': directives.nonnegative_int}
+tree_directive.options = {'scale': format_scale_option(directives.nonnegative_int)}
 directives.register_directive('tree', tree_directive)
 
+class avm(docutils.nodes.General, docutils.nodes.FixedTextElement):
+    """A feature structure (for output formats that render its source
+    text, rather than a table or LaTeX markup)."""
+
 def avm_directive(name, arguments, options, content, lineno,
                       content_offset, block_text, state, state_machine):
     text = '\n'.join(content)
@@ -246,9 +288,9 @@ def avm_directive(name, arguments, options, content, lineno,
             return [parse_avm(textwrap.dedent(text)).as_table()]
         elif OUTPUT_FORMAT == 'ref':
             return [docutils.nodes.paragraph()]
-        # pass through for now
         elif OUTPUT_FORMAT == 'docbook':
-            return [docutils.nodes.literal_block('', textwrap.dedent(text))]
+            parse_avm(textwrap.dedent(text)) # (check that it parses)
+            return [avm('', textwrap.dedent(text))]
     except ValueError as e:
         if isinstance(e.args[0], int):
             warning('Error parsing avm on line %s' % (lineno+e.args[0]))
@@ -1653,12 +1695,412 @@ class CustomizedHTMLTranslator(HTMLTranslator):
             self.body.append('</td></tr>')
         HTMLTranslator.depart_caption(self, node)
 
+    def encode(self, text):
+        """Encode special characters in `text` & return."""
+        return escape_html(str(text))
+
+    def visit_image(self, node):
+        # Fill in the image's size from the image info cache, so our
+        # parent class can scale it without opening the image with PIL.
+        if 'scale' in node and ('width' not in node or 'height' not in node):
+            try:
+                info = image_info(node['uri'])
+            except (IOError, ValueError):
+                pass # let our parent class report the problem.
+            else:
+                if 'width' not in node: node['width'] = '%dpx' % info.width
+                if 'height' not in node: node['height'] = '%dpx' % info.height
+        HTMLTranslator.visit_image(self, node)
+
     def starttag(self, node, tagname, suffix='\n', empty=0, **attributes):
         if node.get('mimetype'):
             attributes['type'] = node.get('mimetype')
         return HTMLTranslator.starttag(self, node, tagname, suffix,
                                        empty, **attributes)
-        
+
+class StreamingHTMLWriter(CustomizedHTMLWriter):
+    """
+    An HTML writer for very large documents (such as book.rst, which
+    includes every chapter).  Rather than accumulating the entire
+    body in memory and joining it at the end, the translator spools
+    each finished top-level section to a temporary file, and releases
+    that section's subtree.  The head and footer are only known once
+    the whole document has been visited, so they are rendered
+    separately and the spooled body is copied between them.  (The
+    whole doctree is still built before it's written, so releasing
+    sections frees memory for the rest of the build, but doesn't
+    lower the peak; the body's strings are what streaming saves.)
+    """
+    BODY_MARKER = '\0STREAMING-HTML-BODY\0'
+    COPY_BUFSIZE = 1<<16
+
+    def __init__(self):
+        CustomizedHTMLWriter.__init__(self)
+        self.translator_class = StreamingHTMLTranslator
+
+    def write(self, document, destination):
+        self.document = document
+        self.language = languages.get_language(
+            document.settings.language_code)
+        self.destination = destination
+        settings = document.settings
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        try:
+            self.visitor = visitor = self.translator_class(document, spool)
+            document.walkabout(visitor)
+            visitor.flush_body()
+
+            # Render everything except the body, and split it at the
+            # point where the body belongs.
+            visitor.body = [self.BODY_MARKER]
+            for attr in self.visitor_attributes:
+                setattr(self, attr, getattr(visitor, attr))
+            if hasattr(self, 'apply_template'):
+                page = self.apply_template()
+            else:
+                page = visitor.astext()
+            head, foot = page.split(self.BODY_MARKER)
+            if visitor.spooled.endswith('\n') and foot.startswith('\n'):
+                foot = foot[1:] # (the template expects a stripped body)
+
+            if destination.destination_path:
+                out = open(destination.destination_path, 'w',
+                           encoding=settings.output_encoding,
+                           errors=settings.output_encoding_error_handler)
+            else:
+                out = sys.stdout
+            try:
+                out.write(head)
+                spool.seek(0)
+                while True:
+                    chunk = spool.read(self.COPY_BUFSIZE)
+                    if not chunk: break
+                    out.write(chunk)
+                out.write(foot)
+            finally:
+                if out is not sys.stdout: out.close()
+        finally:
+            spool.close()
+        self.output = None
+
+class StreamingHTMLTranslator(CustomizedHTMLTranslator):
+    def __init__(self, document, spool):
+        CustomizedHTMLTranslator.__init__(self, document)
+        self.spool = spool
+        self.spooled = '' # the last string written to the spool
+
+    def depart_section(self, node):
+        CustomizedHTMLTranslator.depart_section(self, node)
+        if isinstance(node.parent, docutils.nodes.document):
+            self.flush_body()
+            self.release(node)
+
+    def flush_body(self):
+        text = ''.join(self.body)
+        if text:
+            self.spool.write(text)
+            self.spooled = text[-1:]
+        del self.body[:]
+
+    # The document's maps from names (or ids) to a node, or to a list
+    # of nodes; and its lists of nodes.
+    DOCUMENT_NODE_MAPS = ['ids', 'names', 'substitution_defs']
+    DOCUMENT_NODE_LIST_MAPS = ['refnames', 'refids', 'footnote_refs',
+                               'citation_refs']
+    DOCUMENT_NODE_LISTS = ['footnotes', 'citations', 'autofootnotes',
+                           'autofootnote_refs', 'symbol_footnotes',
+                           'symbol_footnote_refs', 'indirect_targets',
+                           'anonymous_targets', 'anonymous_refs',
+                           'parse_messages', 'transform_messages']
+
+    def release(self, node):
+        """
+        Free a section that has already been written.  The document
+        refers to many of its nodes (by id, name, reference name, and
+        in its lists of footnotes, citations, messages, etc.), so those
+        references are dropped; and every node's parent pointer is
+        cleared, since any node that is still referenced (e.g. by the
+        translator) would otherwise keep all of its ancestors, and so
+        the whole section, alive.
+        """
+        findall = getattr(node, 'findall', node.traverse)
+        descendants = list(findall(include_self=False))
+        released = set(map(id, descendants))
+        document = self.document
+        for name in self.DOCUMENT_NODE_MAPS:
+            mapping = getattr(document, name, {})
+            for key in [k for (k, v) in mapping.items() if id(v) in released]:
+                del mapping[key]
+        for name in self.DOCUMENT_NODE_LIST_MAPS:
+            mapping = getattr(document, name, {})
+            for (key, nodes) in list(mapping.items()):
+                nodes[:] = [n for n in nodes if id(n) not in released]
+                if not nodes: del mapping[key]
+        for name in self.DOCUMENT_NODE_LISTS:
+            nodes = getattr(document, name, [])
+            nodes[:] = [n for n in nodes if id(n) not in released]
+        node.clear()
+        # (Targets just before a section are also referred to by it.)
+        for name in ('expect_referenced_by_name', 'expect_referenced_by_id'):
+            if hasattr(node, name): setattr(node, name, {})
+        for descendant in descendants:
+            descendant.parent = None
+            if isinstance(descendant, docutils.nodes.Element):
+                del descendant.children[:]
+
+class HTMLPage:
+    """
+    One page of the chunked HTML edition: either the front page (the
+    document minus its split sections) or a single split section.
+    """
+    def __init__(self, filename, root, sectnum=None, title=''):
+        self.filename = filename
+        self.root = root
+        self.sectnum = sectnum
+        self.title = title
+    def label(self):
+        if self.sectnum: return '%s %s' % (self.sectnum, self.title)
+        else: return self.title
+
+def section_title_text(section):
+    """The title of a section, without its generated section number."""
+    return ''.join(c.astext() for c in section[0].children
+                   if not isinstance(c, docutils.nodes.generated)).strip()
+
+class ChunkedHTMLWriter(CustomizedHTMLWriter):
+    """
+    An HTML writer that splits the document into one page per section,
+    down to a depth of `split_depth` (1 = one page per chapter).
+    Sections above that depth keep their introductory text on their
+    own page.  Each page gets prev/next links derived from the section
+    numbers assigned by `NumberNodes`, and references that cross a
+    page boundary are rewritten to point at the right page.  A search
+    index for the pages is written to the `SEARCH_INDEX_DIR`
+    subdirectory of the directory that the pages are written to.
+    """
+    split_depth = 1
+
+    def write(self, document, destination):
+        self.document = document
+        self.destination = destination
+        path = destination.destination_path
+        if not path or path in ('-', '<stdout>'):
+            # The pages are separate files, so they can't be written to
+            # stdout: name them after the source instead.
+            source = document.get('source', '')
+            if not os.path.isfile(source):
+                raise ValueError('--chunked needs an output file when '
+                                 'reading from stdin')
+            path = os.path.splitext(source)[0] + '.html'
+        basename = os.path.splitext(path)[0]
+
+        front = HTMLPage(path, document,
+                         title=document.get('title', ''))
+        pages = [front]
+        self.page_of = {}   # id -> page filename
+        self.references = [] # (reference, page filename)
+        self.split(document, 0, front, pages, basename)
+        self.link_pages()
+
+        self.search_dir = os.path.join(os.path.dirname(path),
+                                       SEARCH_INDEX_DIR)
+        search_index = SearchIndex(os.path.split(basename)[-1],
+                                   self.search_dir)
+        for pagenum, page in enumerate(pages):
+            search_index.add_page(pagenum, page, document)
+        search_index.write(pages)
+
+        for pagenum, page in enumerate(pages):
+            self.write_page(pages, pagenum)
+            page.root = None # release it
+        self.output = None
+
+    def assemble_parts(self):
+        # Each page has its own parts; there are no parts for the whole.
+        Writer.assemble_parts(self)
+
+    def page_filename(self, basename, section, pagenum):
+        sectnum = section.get('sectnum') or ('%s' % pagenum)
+        return '%s-%s.html' % (basename, re.sub(r'\W', '_', sectnum))
+
+    def split(self, node, depth, page, pages, basename):
+        for child in list(node.children):
+            if (isinstance(child, docutils.nodes.section) and
+                depth < self.split_depth):
+                node.remove(child)
+                subpage = HTMLPage(
+                    self.page_filename(basename, child, len(pages)), child,
+                    child.get('sectnum'), section_title_text(child))
+                pages.append(subpage)
+                for node_id in child.get('ids', ()):
+                    self.page_of[node_id] = subpage.filename
+                self.split(child, depth+1, subpage, pages, basename)
+            else:
+                self.note_page_contents(child, page)
+
+    def note_page_contents(self, node, page):
+        findall = getattr(node, 'findall', node.traverse)
+        for elt in findall(docutils.nodes.Element):
+            for node_id in elt.get('ids', ()):
+                self.page_of[node_id] = page.filename
+            if (isinstance(elt, (docutils.nodes.reference,
+                                 docutils.nodes.title)) and 'refid' in elt):
+                self.references.append( (elt, page.filename) )
+
+    def link_pages(self):
+        """Rewrite any reference to a target on a different page.  (Section
+        titles that link back to the table of contents just lose their
+        link, since the HTML writer can only link titles locally.)"""
+        for ref, filename in self.references:
+            target_page = self.page_of.get(ref['refid'])
+            if target_page is None or target_page == filename:
+                continue
+            if isinstance(ref, docutils.nodes.reference):
+                ref['refuri'] = '%s#%s' % (os.path.split(target_page)[-1],
+                                           ref['refid'])
+            del ref['refid']
+        self.references = []
+
+    def write_page(self, pages, pagenum):
+        page = pages[pagenum]
+        settings = self.document.settings
+        if page.root is self.document:
+            doc = self.document
+        else:
+            doc = docutils.utils.new_document(
+                self.document.get('source', ''), settings)
+            doc['title'] = page.label()
+            doc.append(page.root)
+        doc.insert(0, self.navigation(pages, pagenum, 'navigation-top'))
+        doc.append(self.navigation(pages, pagenum, 'navigation-bottom'))
+
+        output = docutils.io.FileOutput(
+            destination_path=page.filename,
+            encoding=settings.output_encoding,
+            error_handler=settings.output_encoding_error_handler)
+        CustomizedHTMLWriter().write(doc, output)
+
+    def navigation(self, pages, pagenum, cls):
+        links = []
+        def link(page, text):
+            return docutils.nodes.reference(
+                '', text, refuri=os.path.split(page.filename)[-1])
+        if pagenum > 0:
+            links.append(link(pages[pagenum-1],
+                              '\u2190 ' + pages[pagenum-1].label()))
+            links.append(docutils.nodes.Text(' | '))
+            links.append(link(pages[0], 'Contents'))
+        if pagenum+1 < len(pages):
+            if links: links.append(docutils.nodes.Text(' | '))
+            links.append(link(pages[pagenum+1],
+                              pages[pagenum+1].label() + ' \u2192'))
+        nav = docutils.nodes.paragraph('', '', *links, classes=[cls])
+        if cls == 'navigation-top':
+            # The index's url, relative to the page.
+            search_dir = os.path.relpath(
+                self.search_dir, os.path.dirname(pages[pagenum].filename)
+                or os.curdir)
+            search_base = '/'.join(search_dir.split(os.sep) + [
+                os.path.split(os.path.splitext(pages[0].filename)[0])[-1]])
+            search = docutils.nodes.raw(
+                '', SEARCH_FORM_HTML % search_base, format='html')
+            return docutils.nodes.compound('', nav, search)
+        return nav
+
+######################################################################
+#{ Search Index
+######################################################################
+
+SEARCH_INDEX_DIR = 'search'
+"""The directory that the chunked HTML search index is written to,
+   relative to the directory of the pages."""
+
+SEARCH_STOPWORDS = set('''
+    a an and are as at be but by for from has have if in into is it its
+    not of on or that the their then there these they this to was we
+    were which will with you'''.split())
+"""Words that are too common to be worth indexing."""
+
+class SearchIndex:
+    """
+    An inverted index from words and index terms to pages, for
+    client-side searching of the chunked HTML edition.  Words are
+    taken from the prose of each page (code is not indexed), and terms
+    from its ``:dt:``, ``:idx:`` and ``:topic:`` roles.  The index is
+    sharded by the first character of each key, so that a search only
+    has to fetch the shards for the words it contains.  Each shard is
+    a compact JSON object::
+
+        {"w": {word: [[page, count], ...]},
+         "t": {term: [[page, anchor], ...]}}
+
+    and the page list is written to a separate ``-pages.json`` file.
+    """
+    WORD_RE = re.compile(r'\w\w+', re.UNICODE)
+
+    def __init__(self, basename, directory=SEARCH_INDEX_DIR):
+        self.basename = basename
+        self.directory = directory
+        self.words = {} # word -> {page: count}
+        self.terms = {} # term -> [(page, anchor)]
+
+    def add_page(self, pagenum, page, document):
+        visitor = SearchIndexVisitor(document)
+        page.root.walk(visitor)
+        for word, count in visitor.words.items():
+            self.words.setdefault(word, {})[pagenum] = count
+        for term, anchor in visitor.terms:
+            self.terms.setdefault(term, []).append( (pagenum, anchor) )
+
+    def shard(self, key):
+        c = key[:1]
+        if 'a' <= c <= 'z' or '0' <= c <= '9': return c
+        else: return '_'
+
+    def write(self, pages):
+        if not os.path.exists(self.directory):
+            os.mkdir(self.directory)
+        shards = {}
+        for word, counts in self.words.items():
+            shard = shards.setdefault(self.shard(word), {'w':{}, 't':{}})
+            shard['w'][word] = sorted(counts.items())
+        for term, anchors in self.terms.items():
+            shard = shards.setdefault(self.shard(term), {'w':{}, 't':{}})
+            shard['t'][term] = anchors
+        for key, shard in shards.items():
+            self._write_json('%s-%s.json' % (self.basename, key), shard)
+        self._write_json('%s-pages.json' % self.basename,
+                         [[os.path.split(p.filename)[-1], p.label()]
+                          for p in pages])
+
+    def _write_json(self, filename, value):
+        out = open(os.path.join(self.directory, filename), 'w',
+                   encoding='utf-8')
+        json.dump(value, out, separators=(',', ':'), sort_keys=True,
+                  ensure_ascii=False)
+        out.close()
+
+class SearchIndexVisitor(docutils.nodes.SparseNodeVisitor):
+    def __init__(self, document):
+        docutils.nodes.NodeVisitor.__init__(self, document)
+        self.words = {}
+        self.terms = []
+    def unknown_visit(self, node): pass
+    def unknown_departure(self, node): pass
+
+    def visit_Text(self, node):
+        for word in SearchIndex.WORD_RE.findall(node.astext().lower()):
+            if word not in SEARCH_STOPWORDS:
+                self.words[word] = self.words.get(word, 0) + 1
+
+    def visit_idxterm(self, node):
+        self.terms.append( (node.astext().lower(), node['name']) )
+
+    def skip(self, node):
+        raise docutils.nodes.SkipNode
+    visit_doctest_block = visit_literal_block = skip
+    visit_raw = visit_comment = visit_generated = skip
+
 COPY_CLIPBOARD_JS = '''
 <script language="javascript" type="text/javascript">
 
@@ -1789,6 +2231,109 @@ function copy_text_to_clipboard(data)
 </script>
 '''
 
+# The search form for the chunked HTML edition.  %s is the basename of
+# the search index files (see SearchIndex).
+SEARCH_FORM_HTML = '''
+<form class="search" action="" onsubmit="return book_search(this, '%s');">
+<input type="text" name="q" size="24" />
+<input type="submit" value="Search" />
+</form>
+<div id="search-results"></div>
+<script language="javascript" type="text/javascript">
+
+var search_cache = {};
+
+function search_fetch(url, callback)
+{
+    if (url in search_cache) {
+        callback(search_cache[url]);
+        return;
+    }
+    var req = new XMLHttpRequest();
+    req.onreadystatechange = function() {
+        if (req.readyState != 4) return;
+        var value = null;
+        if (req.responseText) value = JSON.parse(req.responseText);
+        search_cache[url] = value;
+        callback(value);
+    };
+    req.open("GET", url, true);
+    req.send(null);
+}
+
+function search_shard(key)
+{
+    var c = key.charAt(0);
+    return /[a-z0-9]/.test(c) ? c : "_";
+}
+
+function book_search(form, base)
+{
+    var query = form.q.value.toLowerCase().replace(/^\\s+|\\s+$/g, "");
+    var words = query.match(/\\w\\w+/g) || [];
+    var box = document.getElementById("search-results");
+    box.innerHTML = "";
+    if (!words.length) return false;
+
+    var urls = [base+"-pages.json"];
+    for (var i=0; i<words.length; i++)
+        urls.push(base+"-"+search_shard(words[i])+".json");
+    urls.push(base+"-"+search_shard(query)+".json");
+
+    var pending = urls.length;
+    for (var i=0; i<urls.length; i++) {
+        search_fetch(urls[i], function() {
+            if (--pending == 0) search_show(box, base, query, words);
+        });
+    }
+    return false;
+}
+
+function search_show(box, base, query, words)
+{
+    var pages = search_cache[base+"-pages.json"];
+    var score = {}, hits = {}, anchor = {};
+
+    // Index terms that match the whole query rank first.
+    var shard = search_cache[base+"-"+search_shard(query)+".json"];
+    var terms = (shard && shard.t[query]) || [];
+    for (var i=0; i<terms.length; i++) {
+        var page = terms[i][0];
+        score[page] = (score[page] || 0) + 1000;
+        hits[page] = words.length;
+        if (!(page in anchor)) anchor[page] = terms[i][1];
+    }
+
+    // Otherwise, a page must contain every word in the query.
+    var counts = {};
+    for (var i=0; i<words.length; i++) {
+        shard = search_cache[base+"-"+search_shard(words[i])+".json"];
+        var postings = (shard && shard.w[words[i]]) || [];
+        for (var j=0; j<postings.length; j++) {
+            var page = postings[j][0];
+            counts[page] = (counts[page] || 0) + 1;
+            score[page] = (score[page] || 0) + postings[j][1];
+        }
+    }
+    for (var page in counts)
+        if (counts[page] == words.length) hits[page] = words.length;
+
+    var results = [];
+    for (var page in hits) results.push(page);
+    results.sort(function(a, b) { return score[b] - score[a]; });
+
+    var html = "<p><b>" + results.length + " page(s) found</b></p><ul>";
+    for (var i=0; i<results.length && i<50; i++) {
+        var href = pages[results[i]][0];
+        if (results[i] in anchor) href += "#" + anchor[results[i]];
+        html += "<li><a href=\\"" + href + "\\">" + pages[results[i]][1]
+                .replace(/&/g, "&amp;").replace(/</g, "&lt;") + "</a></li>";
+    }
+    box.innerHTML = html + "</ul>";
+}
+</script>
+'''
+
 ######################################################################
 #{ Docbook Output
 ######################################################################
@@ -1798,8 +2343,26 @@ import docbook
 
 DOCBOOK_ROOT_NODE = "chapter"
 
+DOCBOOK_REPORT_FILE = None
+"""If not None, then a report of any nodes that the DocBook writer
+   doesn't handle is appended to this file: one line per source file
+   & node type, giving the number of nodes and their line numbers."""
+
 APPENDIX_TITLE_RE = re.compile("^Appendix: (.*)$")
 
+def docbook_root_node(filename):
+    """Return the DocBook root element for the given rst file:
+    'preface' (if its source uses the preface directive), 'appendix'
+    or 'chapter'."""
+    basename = os.path.basename(filename)
+    with open(filename, 'rb') as f: # (not all the sources are UTF-8.)
+        if any(b'preface::' in line.lower() for line in f):
+            return "preface"
+    if basename.startswith("app"):
+        return "appendix"
+    else:
+        return "chapter"
+
 class CustomizedDocBookWriter(DocBookWriter):
     def translate(self):
         # what's the correct way to generate this??  why isn't it
@@ -1811,17 +2374,52 @@ class CustomizedDocBookWriter(DocBookWriter):
         visitor = CustomizedDocBookTranslator(self.document)
         self.document.walkabout(visitor)
         self.output = visitor.astext()
+        if DOCBOOK_REPORT_FILE and visitor.unhandled:
+            self.write_report(visitor.unhandled, DOCBOOK_REPORT_FILE)
+
+    def write_report(self, unhandled, filename):
+        source = self.document.get('source', '')
+        with open(filename, 'a') as out:
+            for typ in sorted(unhandled):
+                lines = unhandled[typ]
+                out.write('%s\t%s\t%d\t%s\n' % (source, typ, len(lines),
+                    ','.join('%s' % line for line in lines)))
 
 class CustomizedDocBookTranslator(DocBookTranslator):
     def __init__(self, document):
         DocBookTranslator.__init__(self, document)
+        self.unhandled = {} # node type -> list of source lines
 
+    # DocBook has no equivalent of a compound paragraph, so just
+    # render its contents.
     def visit_compound(self, node):
-        # Does compound need to be handled at all?
-        warning('compound not handled yet')
+        pass
     def depart_compound(self, node):
         pass
 
+    def visit_gloss(self, node):
+        cols = max([len(row) for row in node] or [1])
+        self.body.append('<informaltable tabstyle="orm:glossed-text-padding">'
+                         '<tgroup cols="%d"><tbody>\n' % cols)
+    def depart_gloss(self, node):
+        self.body.append('</tbody></tgroup></informaltable>\n')
+
+    def visit_glossrow(self, node):
+        self.body.append('<row>')
+        for child in node:
+            self.body.append('<entry>')
+            child.walkabout(self)
+            self.body.append('</entry>')
+        self.body.append('</row>\n')
+        raise docutils.nodes.SkipNode
+
+    def visit_avm(self, node):
+        self.body.append(self.starttag(node, 'programlisting', '',
+                                       role='avm'))
+        self.body.append(self.encode(node.astext()))
+        self.body.append('</programlisting>\n')
+        raise docutils.nodes.SkipNode
+
     # the standard writer doesn't like node['ids'] = []
     _next_id = 0
     def visit_target(self, node):
@@ -1962,7 +2560,11 @@ class CustomizedDocBookTranslator(DocBookTranslator):
         if typ not in self._not_handled:
             warning('not handled: %s' % typ)
             self._not_handled.add(typ)
-        self.body.append('<!-- unknown visit: %s -->' % node)
+        # Record the node for the report (see DOCBOOK_REPORT_FILE),
+        # and leave a short marker in the output.
+        line = docutils.utils.get_source_line(node)[1]
+        self.unhandled.setdefault(typ, []).append(line)
+        self.body.append('<!-- unknown visit: %s -->' % typ)
 
         # display as literal
         #self.body.append('\n\n'+self.starttag(node, 'programlisting'))
@@ -1972,9 +2574,79 @@ class CustomizedDocBookTranslator(DocBookTranslator):
         #self.body.append('<!-- unknown visit: %s -->' % node)
         raise docutils.nodes.SkipNode
     def unknown_departure(self, node):
-        self.body.append('<!-- unknown depart: %s -->' % node)
         pass
 
+######################################################################
+#{ DocBook Books
+######################################################################
+# Build the whole book as a single flattened DocBook document, in one
+# process: each xi:include in the book's skeleton file (book.xml) is
+# replaced by the chapter it names, rendered directly from its rst
+# source (or, for files that aren't chapters, such as the
+# bibliography, by the contents of the included file).
+
+XINCLUDE_RE = re.compile(r'<xi:include href="(.*?)".*/>')
+XINCLUDE_NAMESPACE = ' xmlns:xi="http://www.w3.org/2001/XInclude"'
+XML_PROLOG_RE = re.compile(r'^\s*(<\?xml[^>]*\?>\s*)?(<!DOCTYPE .*?>\s*)?',
+                           re.DOTALL)
+
+def render_docbook(in_file, settings):
+    """Render the given rst file as DocBook, and return the result
+    as a (unicode) string."""
+    global DOCBOOK_ROOT_NODE, OUTPUT_BASENAME, _treenum
+    DOCBOOK_ROOT_NODE = docbook_root_node(in_file)
+    # As for a separate --docbook run on the chapter: its tree images
+    # are named after it (and numbered from 1), and its own .ref file
+    # isn't used to resolve its references.
+    OUTPUT_BASENAME = os.path.splitext(in_file)[0]
+    _treenum = 0
+    with open(in_file, 'rb') as f:
+        source = f.read()
+    return docutils.core.publish_string(
+        source, source_path=in_file, writer=CustomizedDocBookWriter(),
+        reader=CustomizedReader(),
+        settings_overrides=dict(settings, output_encoding='unicode'))
+
+def write_docbook_book(skeleton, chapters, out_file, settings, split=False):
+    """
+    Write a flattened DocBook book to `out_file`, by expanding the
+    xi:includes in `skeleton`.  An include whose .rst source is one
+    of `chapters` is rendered directly; other includes are copied from
+    the included file.  Chapters are written out as soon as they are
+    rendered.  If `split` is true, then also write each chapter to its
+    own .xml file.
+    """
+    chapters = dict((os.path.splitext(os.path.basename(c))[0], c)
+                    for c in chapters)
+    skeleton_dir = os.path.dirname(skeleton)
+    out = open(out_file, 'w', encoding='utf-8')
+    try:
+        for line in open(skeleton, encoding='utf-8'):
+            m = XINCLUDE_RE.search(line)
+            if m is None:
+                out.write(line.replace(XINCLUDE_NAMESPACE, ''))
+                continue
+            href = m.group(1)
+            name = os.path.splitext(os.path.basename(href))[0]
+            if name in chapters:
+                logger.start_progress()
+                contents = render_docbook(chapters[name], settings)
+                logger.end_progress()
+                if split:
+                    xml_file = os.path.splitext(chapters[name])[0]+'.xml'
+                    with open(xml_file, 'w', encoding='utf-8') as f:
+                        f.write(contents)
+            elif os.path.exists(os.path.join(skeleton_dir, href)):
+                path = os.path.join(skeleton_dir, href)
+                contents = open(path, encoding='utf-8').read()
+            else:
+                warning('%s: no source for included file %s' %
+                        (skeleton, href))
+                continue
+            out.write(XML_PROLOG_RE.sub('', contents, 1))
+    finally:
+        out.close()
+
 ######################################################################
 #{ LaTeX Output
 ######################################################################
@@ -1992,13 +2664,30 @@ class CustomizedLaTeXWriter(LaTeXWriter):
         'use_latex_toc': True,
         })
     
+    postprocessors = []
+    """A list of functions that are applied, in order, to the LaTeX
+       output string once it has been generated.  Use
+       L{latex_postprocessor} to register new ones."""
+
     def __init__(self):
         LaTeXWriter.__init__(self)
         self.translator_class = CustomizedLaTeXTranslator
 
-    #def translate(self):
-    #    postprocess(self.document)
-    #    LaTeXWriter.translate(self)
+    def translate(self):
+        LaTeXWriter.translate(self)
+        for postprocess in self.postprocessors:
+            self.output = postprocess(self.output)
+
+def latex_postprocessor(func):
+    """A decorator that registers C{func} as a LaTeX post-processing
+    stage (see L{CustomizedLaTeXWriter.postprocessors})."""
+    CustomizedLaTeXWriter.postprocessors.append(func)
+    return func
+
+@latex_postprocessor
+def unnumbered_subsections(latex):
+    """Don't number subsections (or subsubsections) in LaTeX output."""
+    return re.sub(r'subsection{', r'subsection*{', latex)
         
 class CustomizedLaTeXTranslator(LaTeXTranslator):
     
@@ -2050,6 +2739,22 @@ class CustomizedLaTeXTranslator(LaTeXTranslator):
                             if ('{tabularx}' not in l and
                                 r'{\extrarowheight}' not in l)]
 
+    def encode(self, text):
+        """Encode special characters in `text` & return."""
+        # docutils rebuilds its translation table on every call, and
+        # scans the text for characters that need extra packages.
+        # Plain ASCII text never needs those, so use the shared escaper
+        # unless we're in one of the special modes (verbatim, alltt,
+        # etc.) that change the escapes.
+        if (text.isascii() and not (self.verbatim or self.alltt or
+                                    self.insert_newline or
+                                    self.insert_non_breaking_blanks or
+                                    self.inside_citation_reference_label or
+                                    self.is_xetex or
+                                    self.font_encoding in ('OT1', ''))):
+            return escape_latex(text, self.literal)
+        return LaTeXTranslator.encode(self, text)
+
     def bookmark(self, node):
         # this seems broken; just use the hyperref package's
         # "bookmarks" option instead.
@@ -2132,10 +2837,20 @@ class CustomizedLaTeXTranslator(LaTeXTranslator):
         # Images are rendered using \includegraphics from the graphicx
         # package.  By default, it assumes that bitmapped images
         # should be rendered at 72 DPI; but we'd rather use a
-        # different scale.  So adjust the scale attribute & then
-        # delegate to our parent class.
-        node.attributes['scale'] = (node.attributes.get('scale', 100) *
-                                    72.0/LATEX_DPI)
+        # different scale.  So give the image an explicit width, using
+        # its size from the image info cache, & then delegate to our
+        # parent class.  If we can't read the image's size, then fall
+        # back on adjusting the scale attribute instead.
+        if 'width' in node or 'height' in node:
+            return LaTeXTranslator.visit_image(self, node)
+        scale = node.get('scale', 100) * 72.0/LATEX_DPI
+        try:
+            width, height = image_info(node['uri']).natural_size()
+        except (IOError, ValueError):
+            node['scale'] = scale
+        else:
+            node['width'] = '%.3fin' % (width/72.0 * scale/100.0)
+            if 'scale' in node: del node['scale']
         return LaTeXTranslator.visit_image(self, node)
         
     def visit_example(self, node):
@@ -2271,6 +2986,222 @@ class CustomizedLaTeXTranslator(LaTeXTranslator):
     #    else:
     #        LaTeXTranslator.visit_reference(self, node)
 
+######################################################################
+#{ PDF Build Driver
+######################################################################
+# This replaces the old "%.pdf" make rule, which always ran pdflatex
+# three times (deciding whether to run the middle pass by grepping
+# the log for "Rerun"), and deleted the auxiliary files afterwards.
+# Instead, we keep the auxiliary files between builds, and only rerun
+# pdflatex until the .aux/.toc/.idx files stop changing.  Since those
+# files are usually unchanged from the previous build, a typical
+# rebuild needs just one pass.
+
+PDFLATEX_COMMAND = ['pdflatex', '-halt-on-error', '-interaction=batchmode']
+"""The command used to run pdflatex (unless --pdflatex is given)."""
+
+BIBTEX_COMMAND = ['bibtex', '-terse']
+"""The command used to run bibtex."""
+
+MAKEINDEX_COMMAND = ['makeindex', '-q']
+"""The command used to run makeindex."""
+
+LATEX_TEXINPUTS = '.:..:ucs:'
+"""The directories added to the front of TEXINPUTS.  The trailing
+   colon keeps TeX's default search path when TEXINPUTS isn't set."""
+
+PDF_MAX_PASSES = 5
+"""The maximum number of pdflatex passes to run on a single file
+   before giving up on reaching a fixed point."""
+
+PDF_TIMINGS_FILE = 'pdf-timings.json'
+"""The file where per-chapter timing records are kept."""
+
+class PDFBuildError(Exception):
+    pass
+
+def split_command(command):
+    """Split a shell-style command string (such as the Makefile's
+    PDFLATEX) into a dict of the environment variables that are
+    assigned before the command name, and the command's arguments."""
+    words = shlex.split(command)
+    env = {}
+    while words and re.match(r'[A-Za-z_]\w*=', words[0]):
+        name, value = words.pop(0).split('=', 1)
+        env[name] = value
+    return env, words
+
+def _file_digest(filename, pattern=None):
+    """Return an md5 digest of the given file's contents (or of the
+    lines that match `pattern`), or None if the file doesn't exist."""
+    if not os.path.exists(filename): return None
+    with open(filename, 'rb') as f:
+        contents = f.read()
+    if pattern is not None:
+        contents = b'\n'.join(re.findall(pattern, contents, re.MULTILINE))
+    return hashlib.md5(contents).hexdigest()
+
+class PDFBuild:
+    """
+    The state of a single pdflatex build: runs pdflatex (plus bibtex
+    and makeindex when they're needed) until the auxiliary files reach
+    a fixed point, and records how long each step took.  `pdflatex`
+    is the command used to run pdflatex, as a string (see
+    L{split_command}); any variables it assigns are set for every step
+    of the build.
+    """
+    FIXED_POINT_EXTENSIONS = ('.aux', '.toc', '.idx')
+
+    BIBTEX_AUX_RE = br'^\\(?:citation|bibdata|bibstyle)\{.*$'
+    """Lines in the .aux file that affect bibtex's output."""
+
+    def __init__(self, tex_file, pdflatex=None):
+        self.directory, filename = os.path.split(os.path.abspath(tex_file))
+        self.basename = os.path.splitext(filename)[0]
+        self.tex_file = filename
+        self.steps = [] # list of (command, seconds)
+        self.env = dict(os.environ)
+        if pdflatex is None:
+            self.pdflatex_command = PDFLATEX_COMMAND
+        else:
+            settings, self.pdflatex_command = split_command(pdflatex)
+            self.env.update(settings)
+        self.env['TEXINPUTS'] = (LATEX_TEXINPUTS +
+                                 self.env.get('TEXINPUTS', ''))
+
+    def path(self, ext):
+        return os.path.join(self.directory, self.basename+ext)
+
+    def digests(self):
+        return [_file_digest(self.path(ext))
+                for ext in self.FIXED_POINT_EXTENSIONS]
+
+    def run(self, command, failure_log=None):
+        start = time.time()
+        status = subprocess.call(command, cwd=self.directory, env=self.env,
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL)
+        self.steps.append((command[0], time.time()-start))
+        if status != 0:
+            if failure_log and os.path.exists(failure_log):
+                with open(failure_log, errors='replace') as f:
+                    sys.stderr.write(f.read())
+            raise PDFBuildError('%s failed on %s' %
+                                (command[0], self.tex_file))
+
+    def bib_files(self):
+        """Return a list of the .bib files named by the .aux file."""
+        if not os.path.exists(self.path('.aux')): return []
+        with open(self.path('.aux'), 'rb') as f:
+            m = re.search(br'^\\bibdata\{(.*)\}', f.read(), re.MULTILINE)
+        if m is None: return []
+        return [os.path.join(self.directory, name+'.bib')
+                for name in m.group(1).decode('utf-8').split(',')]
+
+    def bbl_is_stale(self):
+        if not os.path.exists(self.path('.bbl')): return True
+        bbl_mtime = os.path.getmtime(self.path('.bbl'))
+        return any(os.path.exists(bib) and os.path.getmtime(bib) > bbl_mtime
+                   for bib in self.bib_files())
+
+    def pdflatex(self):
+        try:
+            self.run(self.pdflatex_command + [self.tex_file],
+                     self.path('.log'))
+        except PDFBuildError:
+            if os.path.exists(self.path('.pdf')): os.remove(self.path('.pdf'))
+            raise
+
+    def build(self):
+        bib_digest = _file_digest(self.path('.aux'), self.BIBTEX_AUX_RE)
+        idx_digest = _file_digest(self.path('.idx'))
+        for passnum in range(1, PDF_MAX_PASSES+1):
+            before = self.digests()
+            self.pdflatex()
+            after = self.digests()
+            changed = (before != after)
+            # Run bibtex if the citations have changed.
+            new_bib_digest = _file_digest(self.path('.aux'),
+                                          self.BIBTEX_AUX_RE)
+            if self.bib_files() and (new_bib_digest != bib_digest or
+                                     self.bbl_is_stale()):
+                self.run(BIBTEX_COMMAND + [self.basename], self.path('.blg'))
+                bib_digest = new_bib_digest
+                changed = True
+            # Run makeindex if the index entries have changed.
+            new_idx_digest = after[2]
+            if new_idx_digest is not None and (
+                new_idx_digest != idx_digest or
+                not os.path.exists(self.path('.ind'))):
+                self.run(MAKEINDEX_COMMAND + [self.basename+'.idx'],
+                         self.path('.ilg'))
+                idx_digest = new_idx_digest
+                changed = True
+            if not changed:
+                return passnum
+        warning('%s: no fixed point after %d pdflatex passes' %
+                (self.tex_file, PDF_MAX_PASSES))
+        return PDF_MAX_PASSES
+
+    def record(self):
+        """Return a JSON-able record of this build's timings."""
+        return dict(passes=sum(1 for (cmd, t) in self.steps
+                               if cmd == self.pdflatex_command[0]),
+                    seconds=round(sum(t for (cmd, t) in self.steps), 2),
+                    steps=[[cmd, round(t, 2)] for (cmd, t) in self.steps],
+                    built=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def build_pdfs(filenames, jobs=None, timings_file=PDF_TIMINGS_FILE,
+               force=False, pdflatex=None):
+    """
+    Build a pdf file for each of the given .tex (or .rst) files, running
+    up to `jobs` builds concurrently.  Files whose pdf is newer than
+    their .tex file are skipped, unless `force` is true.  Per-chapter
+    timings are added to `timings_file`.  `pdflatex` is the command
+    used to run pdflatex (see L{PDFBuild}).  Return the number of
+    builds that failed.
+    """
+    tex_files = [os.path.splitext(f)[0]+'.tex' for f in filenames]
+    builds = []
+    for tex_file in tex_files:
+        if not os.path.exists(tex_file):
+            error('%s does not exist' % tex_file)
+            return 1
+        pdf_file = os.path.splitext(tex_file)[0]+'.pdf'
+        if (not force and os.path.exists(pdf_file) and
+            os.path.getmtime(pdf_file) >= os.path.getmtime(tex_file)):
+            sys.stderr.write('%s is up to date\n' % pdf_file)
+            continue
+        builds.append(PDFBuild(tex_file, pdflatex))
+
+    def build(b):
+        passes = b.build()
+        sys.stderr.write('pdflatex %s -> %s.pdf (%d pass%s, %.1fs)\n' % (
+            b.tex_file, b.basename, passes, '' if passes == 1 else 'es',
+            sum(t for (cmd, t) in b.steps)))
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as ex:
+        futures = [(b, ex.submit(build, b)) for b in builds]
+        for (b, future) in futures:
+            try:
+                future.result()
+            except (PDFBuildError, OSError) as e:
+                error(str(e))
+                failures += 1
+
+    if builds and timings_file:
+        timings = {}
+        if os.path.exists(timings_file):
+            try:
+                with open(timings_file) as f: timings = json.load(f)
+            except ValueError:
+                pass
+        for b in builds:
+            if b.steps: timings[b.basename] = b.record()
+        with open(timings_file, 'w') as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+    return failures
+
 ######################################################################
 #{ Source Code Highlighting
 ######################################################################
@@ -2588,6 +3519,14 @@ def error(s):
     s = ('%s' % s)
     if s.strip(): logger.log(ERROR, s.strip())
 
+def peak_rss():
+    """Return the peak resident set size of this process in kilobytes,
+    or None if it can't be determined on this platform."""
+    if resource is None: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': rss //= 1024 # reported in bytes on OS X
+    return rss
+
 class WarningStream:
     isatty = False
     closed = False
@@ -2616,6 +3555,53 @@ def parse_args():
     optparser.add_option("--ref",
         action="store_const", dest="action", const="ref",
         help="Generate references linking file.")
+    optparser.add_option("--pdf",
+        action="store_const", dest="action", const="pdf",
+        help="Run pdflatex (and bibtex/makeindex) on the .tex files "
+        "for the given files, until their auxiliary files stop changing.")
+    optparser.add_option("--jobs", "-j",
+        action="store", type="int", dest="jobs",
+        help="Number of pdf files to build concurrently (--pdf only; "
+        "default: one per cpu).")
+    optparser.add_option("--timings",
+        action="store", dest="timings",
+        help="File to record per-chapter build timings in (--pdf only).")
+    optparser.add_option("--pdflatex",
+        action="store", dest="pdflatex", metavar="COMMAND",
+        help="The command used to run pdflatex, which may start with "
+        "variable assignments, as in a shell (--pdf only; default: %s)."
+        % ' '.join(PDFLATEX_COMMAND))
+    optparser.add_option("--force",
+        action="store_const", dest="force", const=True,
+        help="Rebuild pdf files even if they're up to date (--pdf only).")
+    optparser.add_option("--stream",
+        action="store_const", dest="stream", const=True,
+        help="Stream HTML output one top-level section at a time "
+        "(for very large documents, such as the whole book).")
+    optparser.add_option("--chunked",
+        action="store_const", dest="chunked", const=True,
+        help="Split HTML output into one page per section, with "
+        "prev/next links and a client-side search index.")
+    optparser.add_option("--split-depth",
+        action="store", type="int", dest="split_depth",
+        help="Section depth at which --chunked splits pages "
+        "(1 = chapters).")
+    optparser.add_option("--report-memory",
+        action="store_const", dest="report_memory", const=True,
+        help="Report the peak memory usage (resident set size).")
+    optparser.add_option("--docbook-book",
+        action="store", dest="docbook_book", metavar="SKELETON",
+        help="Write the whole book as a single DocBook file, by "
+        "rendering each chapter that is xi:included by SKELETON (e.g. "
+        "book.xml).  Output goes to SKELETON-flat.xml (or -o).")
+    optparser.add_option("--split-chapters",
+        action="store_const", dest="split_chapters", const=True,
+        help="With --docbook-book, also write each chapter to its "
+        "own .xml file.")
+    optparser.add_option("--docbook-report",
+        action="store", dest="docbook_report",
+        help="Append a report of nodes that the DocBook writer doesn't "
+        "handle to this file.")
     optparser.add_option("--documentclass",
         action="store", dest="documentclass", 
         help="Document class for latex output (article, book).")
@@ -2639,29 +3625,43 @@ def parse_args():
     optparser.set_defaults(action='html', documentclass='report',
                            papersize='letterpaper',
                            bibliography=False,
+                           stream=False,
+                           chunked=False,
+                           split_depth=1,
+                           report_memory=False,
+                           jobs=None,
+                           timings=PDF_TIMINGS_FILE,
+                           force=False,
+                           docbook_report=None,
+                           docbook_book=None,
+                           split_chapters=False,
                            outputfile=None,
                            bibtex_file=BIBTEX_FILE,
                            css=CSS_STYLESHEET,
                            latex_stylesheet=LATEX_STYLESHEET_PATH)
 
     options, filenames = optparser.parse_args()
-    if options.outputfile is not None and len(filenames)>1:
+    if (options.outputfile is not None and not options.docbook_book and
+        len([f for f in filenames if not f.endswith(REF_EXTENSION)]) > 1):
         optparser.error('-o can only be used with one filename')
 
     return options, filenames
 
 def main():
     global OUTPUT_FORMAT, OUTPUT_BASENAME, EXTERN_REFERENCE_FILES
-    global LOCAL_BIBLIOGRAPHY
+    global LOCAL_BIBLIOGRAPHY, DOCBOOK_REPORT_FILE
     options, filenames = parse_args()
 
+    if options.action == 'pdf':
+        filenames = [f for f in filenames if not f.endswith(REF_EXTENSION)]
+        sys.exit(build_pdfs(filenames, options.jobs, options.timings,
+                            options.force, options.pdflatex) and 1)
+
     if not os.path.exists(TREE_IMAGE_DIR):
         os.mkdir(TREE_IMAGE_DIR)
 
-    if (getattr(docutils.writers.html4css1, 'PIL', None) is None and
-        getattr(docutils.writers.html4css1, 'Image', None) is None):
-        warning('Cannot scale images in HTML unless Python '
-             'Imaging\n         Library (PIL) is installed!')
+    if options.docbook_report:
+        DOCBOOK_REPORT_FILE = options.docbook_report
 
     if options.css:
         CustomizedHTMLWriter.settings_defaults.update({
@@ -2692,7 +3692,14 @@ def main():
             os.path.splitext(options.bibtex_file)[0]]
 
     OUTPUT_FORMAT = options.action
-    if options.action == 'html':
+    if options.action == 'html' and options.chunked:
+        writer = ChunkedHTMLWriter()
+        writer.split_depth = options.split_depth
+        output_ext = '.html'
+    elif options.action == 'html' and options.stream:
+        writer = StreamingHTMLWriter()
+        output_ext = '.html'
+    elif options.action == 'html':
         writer = CustomizedHTMLWriter()
         output_ext = '.html'
     elif options.action == 'latex':
@@ -2711,6 +3718,24 @@ def main():
 
     settings = { 'warning_stream': WarningStream(), }
 
+    if options.docbook_book:
+        OUTPUT_FORMAT = 'docbook'
+        skeleton = options.docbook_book
+        if not filenames:
+            # Render every included file that has an rst source.
+            skeleton_dir = os.path.dirname(skeleton)
+            for line in open(skeleton, encoding='utf-8'):
+                m = XINCLUDE_RE.search(line)
+                if m:
+                    rst_file = os.path.join(skeleton_dir, os.path.splitext(
+                        m.group(1))[0]+'.rst')
+                    if os.path.exists(rst_file): filenames.append(rst_file)
+        out_file = (options.outputfile or
+                    os.path.splitext(skeleton)[0] + '-flat.xml')
+        write_docbook_book(skeleton, filenames, out_file, settings,
+                           options.split_chapters)
+        return
+
     for in_file in filenames:
         OUTPUT_BASENAME = os.path.splitext(in_file)[0]
         if options.outputfile != None:
@@ -2731,16 +3756,20 @@ def main():
         # For .tex and .html files:
         else:
             global DOCBOOK_ROOT_NODE
-            if in_file == "ch00.rst" or in_file == "ch12.rst":
-                DOCBOOK_ROOT_NODE="preface"
-            if in_file.startswith("app"):
-                DOCBOOK_ROOT_NODE="appendix"
+            DOCBOOK_ROOT_NODE = docbook_root_node(in_file)
             docutils.core.publish_file(source_path=in_file, writer=writer,
                                        destination_path=out_file,
                                        reader=CustomizedReader(),
                                        settings_overrides=settings)
         logger.end_progress()
 
+    if options.report_memory:
+        rss = peak_rss()
+        if rss is None:
+            warning('Peak memory usage is not available on this platform')
+        else:
+            sys.stderr.write('Peak RSS: %.1f MB\n' % (rss/1024.0))
+
 if __name__ == '__main__':
     try:
         main()
@@ -7,29 +7,268 @@
 # URL: <http://www.nltk.org/>
 # For license information, see LICENSE.TXT
 
-import sys
-import re
+"""
+Flatten the XIncludes of an XML document.  Each ``<xi:include>``
+element is replaced by the contents of the file it names (minus its
+XML declaration and DOCTYPE), and included files are themselves
+flattened.  ``parse="text"`` includes are copied in as (escaped)
+text; and an ``xpointer`` attribute selects the element with the
+given id (``xpointer="ch01-intro"`` or ``xpointer="xpointer(id('ch01-intro'))"``).
+
+Files are copied a line at a time, so memory use does not depend on
+the size of the document.  Alongside ``book-flat.xml``, a line map is
+written to ``book-flat.xml.map``, giving the source file & line of
+each run of output lines.  Use it to trace an error that xmllint
+reports in the flattened file back to its source::
+
+    xincluder.py book.xml
+    xincluder.py --lookup book-flat.xml 12345
+"""
+
+import sys, os, re, bisect
+from optparse import OptionParser
 
 EXT = "-flat"              # output filename extension
-XI1 = r'<xi:include href="(.*?)".*/>'
-DOC = r'(?s)<!DOCTYPE .*?>'
-NAMESPACE = r' xmlns:xi="http://www.w3.org/2001/XInclude"'
-
-for filename in sys.argv[1:]:
-    basename, suffix = filename.split('.')
-    output_filename = basename + EXT + "." + suffix
-    output = open(output_filename, "w")
-    for line in open(filename):
-        m = re.search(XI1, line)
-        if m:
-            contents = open(m.group(1)).read()
-            if re.search(DOC, contents):
-                contents = re.split(DOC, contents)[1]
-            output.write(contents)
+MAP_EXT = ".map"           # line map filename extension
+NAMESPACE = ' xmlns:xi="http://www.w3.org/2001/XInclude"'
+XI_START = '<xi:include'
+XI_RE = re.compile(r'<xi:include\b([^>]*?)(?:/>|>.*?</xi:include>)',
+                   re.DOTALL)
+ATTR_RE = re.compile(r'([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+PROLOG_RE = re.compile(r'\s*(?:<\?xml\b.*?\?>\s*)?(?:<!--.*?-->\s*)*'
+                       r'(?:<!DOCTYPE\b[^\[>]*(?:\[.*?\]\s*)?>\s*)?',
+                       re.DOTALL)
+ELEMENT_START_RE = re.compile(r'<[A-Za-z_]')
+XPOINTER_ID_RE = re.compile(r'''^(?:xpointer\(id\(['"](.*)['"]\)\)|'''
+                            r'''element\(([^/()]+)\)|([^()/]+))$''')
+
+class XIncludeError(Exception):
+    pass
+
+######################################################################
+#{ Output & Line Map
+######################################################################
+
+class LineMappedOutput:
+    """
+    A wrapper for an output file that records, for each run of output
+    lines that come from consecutive lines of one source file, the
+    output line where the run starts, the source file, and the source
+    line.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.line = 1            # current output line
+        self.at_line_start = True
+        self.blank = True        # is the current line blank so far?
+        self.runs = []           # [(out_line, src, src_line)]
+
+    def write(self, text, src, src_line):
+        if not text: return
+        # A line is attributed to the source of its first non-blank
+        # text (so indented includes map to the included file).
+        if self.at_line_start or (self.blank and text.strip()):
+            if self.runs and self.runs[-1][0] == self.line:
+                del self.runs[-1]
+            if not self.runs or self.runs[-1][1:] != (
+                src, src_line - (self.line - self.runs[-1][0])):
+                self.runs.append((self.line, src, src_line))
+        self.out.write(text)
+        newlines = text.count('\n')
+        self.line += newlines
+        self.at_line_start = text.endswith('\n')
+        if newlines:
+            self.blank = not text[text.rindex('\n')+1:].strip()
         else:
-            if NAMESPACE in line:
-                line = re.sub(NAMESPACE, '', line)
-            output.write(line)
-    output.close()
+            self.blank = self.blank and not text.strip()
+
+    def write_map(self, filename):
+        out = open(filename, 'w')
+        for (line, src, src_line) in self.runs:
+            out.write('%d\t%s\t%d\n' % (line, src, src_line))
+        out.close()
+
+def read_map(filename):
+    runs = []
+    for line in open(filename):
+        out_line, src, src_line = line.rstrip('\n').split('\t')
+        runs.append((int(out_line), src, int(src_line)))
+    return runs
+
+def lookup(runs, out_line):
+    """Return the (source file, source line) for the given line of
+    the flattened output."""
+    i = bisect.bisect_right([r[0] for r in runs], out_line) - 1
+    if i < 0: raise ValueError('line %d is not mapped' % out_line)
+    start, src, src_line = runs[i]
+    return src, src_line + (out_line - start)
+
+######################################################################
+#{ Reading Included Files
+######################################################################
+
+def numbered_lines(filename):
+    """Generate (line number, line) pairs for the given file."""
+    f = open(filename, encoding='utf-8')
+    try:
+        for lineno, line in enumerate(f, 1):
+            yield lineno, line
+    finally:
+        f.close()
+
+def split_lines(text, lineno):
+    """Generate (line number, line) pairs for a string that starts
+    on line `lineno`."""
+    for line in text.splitlines(True):
+        yield lineno, line
+        lineno += 1
+
+def strip_prolog(lines):
+    """
+    Strip the XML declaration and DOCTYPE (and any comments between
+    them) from the start of a document, given as (line number, line)
+    pairs.  Only the prolog is buffered.
+    """
+    head, first = '', None
+    for lineno, line in lines:
+        if first is None: first = lineno
+        head += line
+        m = ELEMENT_START_RE.search(head)
+        if m and not _in_doctype(head, m.start()):
+            break
+    else:
+        return
+    end = PROLOG_RE.match(head).end()
+    for item in split_lines(head[end:], first + head[:end].count('\n')):
+        yield item
+    for item in lines:
+        yield item
+
+def _in_doctype(head, pos):
+    # Is `pos` inside the internal subset of a DOCTYPE?
+    start = head.rfind('<!DOCTYPE', 0, pos)
+    return start >= 0 and head.count('[', start, pos) > head.count(
+        ']', start, pos)
+
+def select_element(lines, ident, filename):
+    """
+    Generate just the element whose id is `ident`, given a document
+    as (line number, line) pairs.  (Start and end tags for the
+    element's name are counted to find its end, so they are assumed
+    not to be split across lines.)
+    """
+    start_re = re.compile(r'<([\w:.-]+)\b[^>]*?\b(?:xml:)?id\s*=\s*'
+                          r'''["']%s["']''' % re.escape(ident))
+    tag_re = None
+    depth = 0
+    for lineno, line in lines:
+        pos = 0
+        if tag_re is None:
+            m = start_re.search(line)
+            if m is None: continue
+            pos = m.start()
+            tag_re = re.compile(r'<(/?)%s\b[^>]*?(/?)>' % re.escape(m.group(1)))
+        for m in tag_re.finditer(line, pos):
+            if m.group(1): depth -= 1
+            elif not m.group(2): depth += 1
+            if depth == 0:
+                yield lineno, line[pos:m.end()]
+                return
+        yield lineno, line[pos:]
+    raise XIncludeError('%s: no element with id %r' % (filename, ident))
+
+######################################################################
+#{ Flattening
+######################################################################
+
+def flatten(filename, out, stack=(), lines=None):
+    """
+    Write `filename` to `out` (a L{LineMappedOutput}), replacing each
+    ``<xi:include>`` with the (flattened) file it includes.
+    """
+    if lines is None:
+        lines = numbered_lines(filename)
+    stack = stack + (os.path.abspath(filename),)
+    lines = iter(lines)
+    for lineno, line in lines:
+        if XI_START not in line:
+            if NAMESPACE in line: line = line.replace(NAMESPACE, '')
+            out.write(line, filename, lineno)
+            continue
+        # An include element may be split across several lines.
+        while XI_RE.search(line) is None:
+            try:
+                line += next(lines)[1]
+            except StopIteration:
+                raise XIncludeError('%s:%d: unterminated xi:include' %
+                                    (filename, lineno))
+        pos = 0
+        for m in XI_RE.finditer(line):
+            out.write(line[pos:m.start()], filename, lineno)
+            include(m.group(1), filename, lineno, out, stack)
+            pos = m.end()
+        rest = line[pos:]
+        if NAMESPACE in rest: rest = rest.replace(NAMESPACE, '')
+        out.write(rest, filename, lineno)
+
+def include(attribs, filename, lineno, out, stack):
+    attribs = dict((m.group(1), m.group(2) if m.group(2) is not None
+                    else m.group(3)) for m in ATTR_RE.finditer(attribs))
+    if 'href' not in attribs:
+        raise XIncludeError('%s:%d: xi:include without href' %
+                            (filename, lineno))
+    href = os.path.join(os.path.dirname(filename), attribs['href'])
+    if os.path.abspath(href) in stack:
+        raise XIncludeError('%s:%d: recursive include of %s' %
+                            (filename, lineno, href))
+    if attribs.get('parse', 'xml') == 'text':
+        for (src_line, line) in numbered_lines(href):
+            out.write(line.replace('&', '&amp;').replace('<', '&lt;')
+                      .replace('>', '&gt;'), href, src_line)
+        return
+    lines = strip_prolog(numbered_lines(href))
+    if 'xpointer' in attribs:
+        m = XPOINTER_ID_RE.match(attribs['xpointer'].strip())
+        if m is None:
+            raise XIncludeError('%s:%d: unsupported xpointer %r' %
+                                (filename, lineno, attribs['xpointer']))
+        ident = [g for g in m.groups() if g is not None][0]
+        lines = select_element(lines, ident, href)
+    flatten(href, out, stack, lines)
+
+def flatten_file(filename, write_map=True):
+    basename, suffix = os.path.splitext(filename)
+    output_filename = basename + EXT + suffix
+    output = open(output_filename, 'w', encoding='utf-8')
+    try:
+        out = LineMappedOutput(output)
+        flatten(filename, out)
+    finally:
+        output.close()
+    if write_map:
+        out.write_map(output_filename + MAP_EXT)
+    return output_filename
 
+def main():
+    parser = OptionParser(usage='%prog [options] FILE.xml...\n'
+                          '       %prog --lookup FLAT.xml LINE...')
+    parser.add_option('--no-map', action='store_false', dest='map',
+                      default=True, help="Don't write a line map.")
+    parser.add_option('--lookup', action='store_true', dest='lookup',
+                      default=False, help='Print the source file & line '
+                      'for the given lines of a flattened file.')
+    options, args = parser.parse_args()
+    if options.lookup:
+        if len(args) < 2: parser.error('expected a file and line numbers')
+        runs = read_map(args[0] + MAP_EXT)
+        for line in args[1:]:
+            print('%s:%s: %s:%d' % ((args[0], line) + lookup(runs, int(line))))
+        return
+    try:
+        for filename in args:
+            flatten_file(filename, options.map)
+    except (XIncludeError, IOError) as e:
+        sys.exit('xincluder: %s' % e)
 
+if __name__ == '__main__':
+    main()
@@ -13,73 +13,226 @@ Redistribution and use in source and binary forms, with or without modification,
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 (Minor modifications by Steven Bird)
-"""
-import sys
 
-def usage(this_file):
-    return """SYNOPSIS: pretty print an XML document
-USAGE: python %s <filename> or use stdin as input\n""" % this_file
-
-def pprint(indent_level, line):
-    if line.strip():
-        sys.stdout.write(" " * indent_level +  line + "\n")
+The document is read a block at a time and tokenized with a cursor
+into the current block, so time is linear and memory is constant in
+the size of the document.  Comments, CDATA sections, processing
+instructions and the DOCTYPE are printed unchanged.  Every element is
+reindented, as before, unless it is named with --preserve; those are
+copied verbatim, so that their whitespace survives::
+
+    python xmlpp.py book-flat.xml > book-pp.xml
+    python xmlpp.py --preserve programlisting --preserve screen \
+        book-flat.xml > book-pp.xml
+    python xmlpp.py --benchmark 50
+"""
+import sys, re, time
+from optparse import OptionParser
 
-def get_next_elem(data):
-    start_pos = data.find("<")
-    end_pos = data.find(">") + 1
-    retval = data[start_pos:end_pos]
-    stopper = retval.find("/")
-    single = (stopper > -1 and ((retval.find(">") - stopper) < (stopper - retval.find("<"))))
+INDENT = 2
+BUFSIZE = 1<<16
 
-    ignore_excl = retval.find("<!") > -1
-    ignore_question =  retval.find("<?") > -1
+TEXT, START, END, EMPTY, OTHER = range(5)
+"""Token types: character data; start, end & empty-element tags; and
+   markup that is printed unchanged (comments, CDATA, PIs, DOCTYPE)."""
 
-    if ignore_excl:
-        cdata = retval.find("<![CDATA[") > -1
-        if cdata:
-            end_pos = data.find("]]>")
-            if end_pos > -1:
-                end_pos = end_pos + len("]]>")
+TERMINATORS = [('<!--', '-->'), ('<![CDATA[', ']]>'), ('<?', '?>')]
+DOCTYPE_RE = re.compile(r'<!DOCTYPE\b[^\[>]*(?:\[.*?\]\s*)?>', re.DOTALL)
+TAG_NAME_RE = re.compile(r'</?([^\s/>]+)')
 
-    elif ignore_question:
-        end_pos = data.find("?>") + len("?>")
-    ignore = ignore_excl or ignore_question
-    
-    no_indent = ignore or single
+def usage(this_file):
+    return """SYNOPSIS: pretty print an XML document
+USAGE: python %s <filename> or use stdin as input\n""" % this_file
 
-    #print retval, end_pos, start_pos, no_indent
-    return start_pos, \
-           end_pos, \
-           stopper > -1, \
-           no_indent
+######################################################################
+#{ Tokenizer
+######################################################################
+
+def tokenize(infile, bufsize=BUFSIZE):
+    """
+    Generate (type, text) pairs for the XML document read from
+    `infile`.  Only the unconsumed tail of the current block is kept
+    between reads, and each search starts from the cursor (or from
+    where the previous search gave up), so every character is examined
+    a bounded number of times.
+    """
+    buf, pos = '', 0
+    eof = False
+    while True:
+        # Character data, up to the next '<'.
+        start = pos
+        i = buf.find('<', pos)
+        while i < 0 and not eof:
+            scanned = len(buf) - pos
+            buf, pos, eof = _refill(infile, buf, pos, bufsize)
+            start = 0
+            i = buf.find('<', scanned)
+        if i < 0:
+            if pos < len(buf): yield TEXT, buf[pos:]
+            return
+        if i > start: yield TEXT, buf[start:i]
+        pos = i
+        # Make sure the markup's opening is in the buffer, so that we
+        # can tell what kind of markup it is.
+        while len(buf) - pos < 9 and not eof:
+            buf, pos, eof = _refill(infile, buf, pos, bufsize)
+        # Find the end of the markup.
+        if buf.startswith('<!DOCTYPE', pos):
+            m = DOCTYPE_RE.match(buf, pos)
+            while m is None and not eof:
+                buf, pos, eof = _refill(infile, buf, pos, bufsize)
+                m = DOCTYPE_RE.match(buf, pos)
+            end = m and m.end() or -1
+        else:
+            for (opener, term) in TERMINATORS:
+                if buf.startswith(opener, pos): break
+            else:
+                opener, term = '<', '>'
+            j = buf.find(term, pos + len(opener))
+            while j < 0 and not eof:
+                scanned = max(len(buf) - pos - len(term), len(opener))
+                buf, pos, eof = _refill(infile, buf, pos, bufsize)
+                j = buf.find(term, pos + scanned)
+            end = j < 0 and -1 or j + len(term)
+        if end < 0:
+            # Unterminated markup: pass the rest through as text.
+            yield TEXT, buf[pos:]
+            return
+        markup = buf[pos:end]
+        pos = end
+        if opener != '<' or markup.startswith('<!'):
+            yield OTHER, markup
+        elif markup.startswith('</'):
+            yield END, markup
+        elif markup.endswith('/>'):
+            yield EMPTY, markup
+        else:
+            yield START, markup
+
+def _refill(infile, buf, pos, bufsize):
+    """Discard the consumed part of `buf`, and append the next block
+    of `infile`.  Return the new buffer & cursor, and whether the end
+    of the file was reached."""
+    block = infile.read(bufsize)
+    return buf[pos:] + block, 0, not block
+
+def tag_name(markup):
+    return TAG_NAME_RE.match(markup).group(1)
+
+######################################################################
+#{ Pretty Printer
+######################################################################
+
+def pretty_print(infile, out, indent=INDENT, preserve=()):
+    """
+    Write the XML document read from `infile` to `out`, with each tag
+    and each (stripped) text node on its own line, indented by the
+    depth of its element.  The contents of elements whose names are in
+    `preserve` are copied verbatim.
+    """
+    write = out.write
+    level = 0
+    tokens = tokenize(infile)
+    for (kind, text) in tokens:
+        if kind == TEXT:
+            text = text.strip()
+            if text: write(' ' * level + text + '\n')
+        elif kind == START:
+            name = tag_name(text)
+            if name in preserve:
+                write(' ' * level + _copy_element(name, text, tokens) + '\n')
+            else:
+                write(' ' * level + text + '\n')
+                level += indent
+        elif kind == END:
+            level -= indent
+            write(' ' * level + text + '\n')
+        else:
+            write(' ' * level + text + '\n')
+
+def _copy_element(name, start_tag, tokens):
+    """Return the element that starts with `start_tag`, exactly as it
+    appears in the document, consuming its tokens from `tokens`."""
+    parts = [start_tag]
+    depth = 1
+    for (kind, text) in tokens:
+        parts.append(text)
+        if kind == START and tag_name(text) == name:
+            depth += 1
+        elif kind == END and tag_name(text) == name:
+            depth -= 1
+            if depth == 0: break
+    return ''.join(parts)
+
+######################################################################
+#{ Benchmark
+######################################################################
+
+SYNTHETIC_SECTION = """<section id="sec-%d"><title>Section %d</title>
+<para>The <emphasis>quick</emphasis> brown fox jumps over the <literal>lazy</literal>
+dog &amp; the cat.<footnote><para>A footnote.</para></footnote></para>
+<!-- comment %d -->
+<programlisting>&gt;&gt;&gt; for word in text:
+...     print(word)<co id="co-%d"/>
+</programlisting>
+<figure><title>A figure</title><mediaobject><imageobject>
+<imagedata fileref="images/fig%d.png"/></imageobject></mediaobject></figure>
+<?dbfo keep-together="always"?><screen><![CDATA[if a < b: pass]]></screen>
+</section>
+"""
 
+def write_synthetic_docbook(out, size):
+    """Write a DocBook book of (at least) `size` characters to `out`."""
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<!DOCTYPE book PUBLIC "-//OASIS//DTD DocBook XML V4.5//EN" '
+              '"http://www.oasis-open.org/docbook/xml/4.5/docbookx.dtd">\n'
+              '<book><chapter id="ch01"><title>Chapter</title>\n')
+    written, i = 0, 0
+    while written < size:
+        section = SYNTHETIC_SECTION % ((i,) * 5)
+        out.write(section)
+        written += len(section)
+        i += 1
+    out.write('</chapter></book>\n')
+
+def benchmark(megabytes=50):
+    import os, tempfile, resource
+    fd, filename = tempfile.mkstemp(suffix='.xml')
+    try:
+        out = os.fdopen(fd, 'w')
+        write_synthetic_docbook(out, megabytes * (1<<20))
+        out.close()
+        size = os.path.getsize(filename)
+        start = time.time()
+        infile = open(filename)
+        pretty_print(infile, open(os.devnull, 'w'))
+        infile.close()
+        elapsed = time.time() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('%.1f MB in %.2fs (%.1f MB/s); max rss %.1f MB' % (
+            size / 1e6, elapsed, size / 1e6 / elapsed, rss / 1024.0))
+    finally:
+        os.remove(filename)
 
 if __name__ == "__main__":
-    if "-h" in sys.argv or "--help" in sys.argv:
-        sys.stderr.write(usage(sys.argv[0]))
-        sys.exit(1)
-    if len(sys.argv) < 2:
-        data = sys.stdin.read()
+    parser = OptionParser(usage=usage(sys.argv[0]).strip())
+    parser.add_option('--indent', type='int', dest='indent', default=INDENT,
+                      help='Spaces per level of indentation (default %d).'
+                      % INDENT)
+    parser.add_option('--preserve', action='append', dest='preserve',
+                      default=[], metavar='ELEMENT', help='Copy the '
+                      'contents of ELEMENT verbatim, e.g. programlisting '
+                      '(may be repeated; by default every element is '
+                      'reindented).')
+    parser.add_option('--benchmark', type='int', dest='benchmark',
+                      metavar='MB', help='Time the pretty printer on a '
+                      'synthetic DocBook file of MB megabytes.')
+    options, args = parser.parse_args()
+    if options.benchmark:
+        benchmark(options.benchmark)
+        sys.exit(0)
+    if args:
+        infile = open(args[0])
     else:
-        filename = sys.argv[1]
-        data = open(filename).read()
-
-    INDENT = 2
-    
-    indent_level = 0
-
-    start_pos, end_pos, is_stop, no_indent  = get_next_elem(data)
-    while ((start_pos > -1 and end_pos > -1)):
-        pprint(indent_level, data[:start_pos].strip())
-        data = data[start_pos:]
-        if is_stop and not no_indent:
-            indent_level = indent_level - INDENT
-        pprint(indent_level, data[:end_pos - start_pos])
-        data = data[end_pos - start_pos:]
-        if not is_stop and not no_indent :
-            indent_level = indent_level + INDENT
-
-        if not data:
-            break
-        else:
-            start_pos, end_pos, is_stop, no_indent  = get_next_elem(data)
+        infile = sys.stdin
+    pretty_print(infile, sys.stdout, options.indent, set(options.preserve))